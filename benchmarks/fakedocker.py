@@ -0,0 +1,254 @@
+# In process stand-in for docker.DockerClient, for benchmarks.
+#
+# Keeps images and containers in memory, answers builds with a builder-like stream
+# and records every call that would have been a round trip to the daemon.
+import hashlib
+import itertools
+import tarfile
+import threading
+from collections import Counter
+from typing import Dict, List
+import docker
+from docker.models.containers import ExecResult
+from containedenv.context import DOCKERFILE, logical_lines
+
+_ids = itertools.count()
+
+
+def _new_id(kind:str) -> str:
+	return "sha256:" + hashlib.sha256(f"{kind}-{next(_ids)}".encode("utf-8")).hexdigest()
+
+
+class Recorder(object):
+	def __init__(self) -> None:
+		self.calls:List[str] = []
+		self.__lock = threading.Lock()
+
+	def record(self, call:str) -> None:
+		with self.__lock:
+			self.calls.append(call)
+
+	def mark(self) -> int:
+		return len(self.calls)
+
+	def since(self, mark:int) -> Counter:
+		return Counter(self.calls[mark:])
+
+
+class FakeImage(object):
+	def __init__(self, tags:List[str] = None, labels:Dict[str, str] = None) -> None:
+		self.id:str = _new_id("image")
+		self.tags:List[str] = tags or []
+		self.labels:Dict[str, str] = labels or {}
+		self.attrs:dict = {"Id" : self.id, "RepoDigests" : [], "Config" : {"Labels" : self.labels}}
+
+
+class FakeContainer(object):
+	def __init__(self, recorder:Recorder, owner:"FakeContainers", name:str, image:str, labels:Dict[str, str] = None) -> None:
+		self.__recorder = recorder
+		self.__owner = owner
+		self.id:str = _new_id("container")
+		self.name:str = name
+		self.image:str = image
+		self.labels:Dict[str, str] = labels or {}
+		self.status:str = "running"
+		self.attrs:dict = {"Id" : self.id, "Name" : name}
+		# Commands run in the container, and archives put in it (path, size)
+		self.execs:List = []
+		self.archives:List = []
+
+	def exec_run(self, cmd, **kwargs) -> ExecResult:
+		self.__recorder.record("containers.exec_run")
+		self.execs.append(cmd)
+		# Repositories are configured from the url they were cloned from
+		if "remote.origin.url" in str(cmd):
+			return ExecResult(0, b"file:///srv/git/origin.git\n")
+		return ExecResult(0, b"")
+
+	def put_archive(self, path:str, data:bytes) -> bool:
+		self.__recorder.record("containers.put_archive")
+		self.archives.append((path, len(data)))
+		return True
+
+	def commit(self, repository:str = None, tag:str = None, changes:List[str] = None, **kwargs) -> "FakeImage":
+		self.__recorder.record("containers.commit")
+		labels = dict(self.__owner.image_labels(self.image))
+		for change in changes or []:
+			if change.startswith("LABEL "):
+				key, _, value = change[len("LABEL "):].partition("=")
+				labels[key] = value
+		return self.__owner.commit(FakeImage([f"{repository}:{tag or 'latest'}"] if repository else [], labels))
+
+	def rename(self, name:str) -> None:
+		self.__recorder.record("containers.rename")
+		self.__owner.rename(self, name)
+
+	def reload(self) -> None:
+		self.__recorder.record("containers.reload")
+
+	def remove(self, force:bool = False, **kwargs) -> None:
+		self.__recorder.record("containers.remove")
+		self.__owner.forget(self)
+
+
+class FakeImages(object):
+	def __init__(self, recorder:Recorder) -> None:
+		self.__recorder = recorder
+		self.__lock = threading.Lock()
+		self.images:Dict[str, FakeImage] = {}
+
+	def add(self, image:FakeImage) -> FakeImage:
+		with self.__lock:
+			# A tag moves to the newest image
+			for other in self.images.values():
+				other.tags = [t for t in other.tags if t not in image.tags]
+			self.images[image.id] = image
+		return image
+
+	def find(self, name:str) -> FakeImage:
+		with self.__lock:
+			for image in self.images.values():
+				if image.id == name or name in image.tags:
+					return image
+		raise docker.errors.ImageNotFound(f"No such image: {name}")
+
+	def get(self, name:str) -> FakeImage:
+		self.__recorder.record("images.get")
+		return self.find(name)
+
+	def get_registry_data(self, name:str):
+		self.__recorder.record("images.get_registry_data")
+		raise docker.errors.APIError("No registry in benchmarks")
+
+	def pull(self, repository:str, tag:str = None, **kwargs) -> FakeImage:
+		self.__recorder.record("images.pull")
+		name = repository if tag is None else f"{repository}:{tag}"
+		try:
+			return self.find(name)
+		except docker.errors.ImageNotFound:
+			return self.add(FakeImage([name]))
+
+	def list(self, filters:dict = None, **kwargs) -> List[FakeImage]:
+		self.__recorder.record("images.list")
+		label = (filters or {}).get("label")
+		with self.__lock:
+			images = list(self.images.values())
+		if label is None:
+			return images
+		key, _, value = label.partition("=")
+		return [i for i in images if key in i.labels and (value == "" or i.labels[key] == value)]
+
+	def remove(self, image:str, force:bool = False, **kwargs) -> None:
+		self.__recorder.record("images.remove")
+		with self.__lock:
+			self.images.pop(image, None)
+
+
+class FakeContainers(object):
+	def __init__(self, recorder:Recorder, images:FakeImages) -> None:
+		self.__recorder = recorder
+		self.__images = images
+		self.__lock = threading.Lock()
+		self.containers:Dict[str, FakeContainer] = {}
+
+	def get(self, name:str) -> FakeContainer:
+		self.__recorder.record("containers.get")
+		with self.__lock:
+			for container in self.containers.values():
+				if container.name == name or container.id == name:
+					return container
+		raise docker.errors.NotFound(f"No such container: {name}")
+
+	def run(self, image:str, command = None, name:str = None, labels:dict = None, **kwargs) -> FakeContainer:
+		self.__recorder.record("containers.run")
+		self.__images.find(image)
+		with self.__lock:
+			if name is not None and any(c.name == name for c in self.containers.values()):
+				raise docker.errors.APIError(f"Conflict, name {name} in use")
+			container = FakeContainer(self.__recorder, self, name or _new_id("name")[7:19], image, labels)
+			self.containers[container.id] = container
+		return container
+
+	def list(self, all:bool = False, filters:dict = None, **kwargs) -> List[FakeContainer]:
+		self.__recorder.record("containers.list")
+		label = (filters or {}).get("label")
+		with self.__lock:
+			containers = list(self.containers.values())
+		if label is None:
+			return containers
+		key, _, value = label.partition("=")
+		return [c for c in containers if key in c.labels and (value == "" or c.labels[key] == value)]
+
+	def rename(self, container:FakeContainer, name:str) -> None:
+		with self.__lock:
+			if any(c.name == name for c in self.containers.values()):
+				raise docker.errors.APIError(f"Conflict, name {name} in use")
+			container.name = name
+
+	def image_labels(self, name:str) -> Dict[str, str]:
+		return self.__images.find(name).labels
+
+	def commit(self, image:FakeImage) -> FakeImage:
+		return self.__images.add(image)
+
+	def forget(self, container:FakeContainer) -> None:
+		with self.__lock:
+			self.containers.pop(container.id, None)
+
+
+class FakeAPI(object):
+	def __init__(self, recorder:Recorder, images:FakeImages, containers:FakeContainers) -> None:
+		self.__recorder = recorder
+		self.__images = images
+		self.__containers = containers
+		# Instructions already built, the layer cache of the fake builder
+		self.__cache = set()
+		self.__lock = threading.Lock()
+
+	def build(self, fileobj = None, custom_context:bool = False, dockerfile:str = DOCKERFILE, tag:str = None, labels:dict = None, **kwargs):
+		self.__recorder.record("api.build")
+		with tarfile.open(fileobj = fileobj, mode = "r") as tar:
+			text = tar.extractfile(dockerfile or DOCKERFILE).read().decode("utf-8")
+		return self.__stream(text, tag, labels)
+
+	def images(self, **kwargs) -> List[dict]:
+		self.__recorder.record("api.images")
+		return [
+			{"Id" : i.id, "RepoTags" : i.tags, "RepoDigests" : [], "Labels" : i.labels}
+			for i in list(self.__images.images.values())
+		]
+
+	def containers(self, all:bool = False, **kwargs) -> List[dict]:
+		self.__recorder.record("api.containers")
+		return [
+			{"Id" : c.id, "Names" : [f"/{c.name}"], "Image" : c.image, "Labels" : c.labels}
+			for c in list(self.__containers.containers.values())
+		]
+
+	def __stream(self, text:str, tag:str, labels:dict):
+		instructions = logical_lines(text)
+		# Cache key of a step is every instruction up to it, like the builder does
+		prefix = hashlib.sha256()
+		for i, instruction in enumerate(instructions):
+			prefix.update(instruction.encode("utf-8"))
+			yield {"stream" : f"Step {i + 1}/{len(instructions)} : {instruction}\n"}
+			with self.__lock:
+				cached = prefix.hexdigest() in self.__cache
+				self.__cache.add(prefix.hexdigest())
+			if cached:
+				yield {"stream" : " ---> Using cache\n"}
+			yield {"stream" : f" ---> {_new_id('layer')[7:19]}\n"}
+		image = self.__images.add(FakeImage([tag] if tag is not None else [], dict(labels or {})))
+		yield {"aux" : {"ID" : image.id}}
+		yield {"stream" : f"Successfully built {image.id[7:19]}\n"}
+
+
+class FakeDockerClient(object):
+	def __init__(self, base_images:List[str] = None) -> None:
+		self.recorder = Recorder()
+		self.images = FakeImages(self.recorder)
+		self.containers = FakeContainers(self.recorder, self.images)
+		self.api = FakeAPI(self.recorder, self.images, self.containers)
+		# Base images are already pulled
+		for name in base_images or []:
+			self.images.add(FakeImage([name]))
@@ -0,0 +1,80 @@
+# Cold start time of the containedenv command line.
+#
+# Each scenario runs in fresh interpreters, the best run is compared to its budget.
+# Exits with 1 past a budget, or when a scenario imports a module it must not need.
+#
+#   python benchmarks/startup.py [--runs 10] [--cli-budget-ms 50] [--config-budget-ms 50] [--plan-budget-ms 300]
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules that must stay out of the way until a command talks to the daemon
+FORBIDDEN = ["docker", "pyrc", "distutils"]
+
+DEFAULT_CONFIG = os.path.join(ROOT, "config", "default.yml")
+
+# Name -> code, modules it must not import
+SCENARIOS = {
+	# --help and argument parsing
+	"cli" : ("import containedenv.__main__ as m; m.get_argparser()", FORBIDDEN),
+	# Config inspection, from a compiled config
+	"config" : (f"from containedenv.config import compile_config; compile_config({DEFAULT_CONFIG!r})", FORBIDDEN),
+	# --no-build plan against the state files. The dockerfile is rendered (pyrc) and the engine
+	# reads the state through an offline client raising docker's errors, both are imported.
+	"plan" : (
+		"import containedenv.__main__ as m; "
+		f"a = m.get_argparser().parse_args(['--no-build', '--config', {DEFAULT_CONFIG!r}]); m.run(a, a.config)",
+		["distutils"]
+	),
+}
+# Scenarios needing a module, skipped without it
+REQUIRES = {"plan" : "pyrc"}
+
+
+def run(code:str) -> dict:
+	probe = (
+		"import json, sys, time\n"
+		"start = time.perf_counter()\n"
+		f"{code}\n"
+		"elapsed = time.perf_counter() - start\n"
+		"print(json.dumps({'ms' : elapsed * 1000, 'modules' : sorted(sys.modules)}))\n"
+	)
+	env = dict(os.environ, PYTHONPATH = ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+	result = subprocess.run([sys.executable, "-c", probe], capture_output = True, text = True, env = env, cwd = ROOT)
+	if result.returncode != 0:
+		raise RuntimeError(result.stderr)
+	return json.loads(result.stdout.splitlines()[-1])
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description = "Cold start time of the containedenv command line")
+	parser.add_argument("--runs", type = int, default = 10)
+	parser.add_argument("--cli-budget-ms", dest = "cli", type = float, default = 50.0)
+	parser.add_argument("--config-budget-ms", dest = "config", type = float, default = 50.0)
+	parser.add_argument("--plan-budget-ms", dest = "plan", type = float, default = 300.0)
+	args = parser.parse_args()
+
+	failed = False
+	for name, (code, modules) in SCENARIOS.items():
+		if name in REQUIRES and importlib.util.find_spec(REQUIRES[name]) is None:
+			print(f"{name:<8} skipped, {REQUIRES[name]} is not installed")
+			continue
+		runs = [run(code) for _ in range(max(1, args.runs))]
+		best = min(r["ms"] for r in runs)
+		budget = getattr(args, name)
+		forbidden = sorted(set(
+			m for r in runs for m in r["modules"] if m.split(".")[0] in modules
+		))
+		status = "ok" if best <= budget and len(forbidden) == 0 else "FAIL"
+		failed = failed or status != "ok"
+		print(f"{name:<8} best {best:7.1f}ms  median {sorted(r['ms'] for r in runs)[len(runs) // 2]:7.1f}ms  budget {budget:.0f}ms  {status}")
+		if len(forbidden) > 0:
+			print(f"         imports {', '.join(forbidden)}")
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,141 @@
+# Scaling benchmarks of containedenv on synthetic configs, without a docker daemon.
+#
+# Config loading, package resolution, dockerfile generation, plans and the build_image / run_container
+# flow run against an in process fake docker client (benchmarks/fakedocker.py).
+# Each stage reports wall time, peak traced memory and the daemon round trips it made.
+# Memory tracing slows python code down noticeably, --no-trace gives untraced wall times.
+#
+#   python benchmarks/suite.py [--packages 2000] [--depth 50] [--projects 200] [--sources 1] [--no-trace] [--json report.json]
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.realpath(__file__))]
+
+from synthetic import write_config
+from fakedocker import FakeDockerClient
+from containedenv.__main__ import get_argparser
+from containedenv.config import compile_config
+from containedenv.packages import PackageGraph, PackageManager2
+from containedenv.tiers import BASE_TOOLING
+from containedenv.engine import ContainedEnv
+from containedenv.plan import plan_app
+from containedenv.state import OfflineClient, State
+
+
+TRACE = True
+
+
+def measure(name:str, fn, client:FakeDockerClient = None) -> dict:
+	gc.collect()
+	mark = client.recorder.mark() if client is not None else 0
+	if TRACE:
+		tracemalloc.start()
+	start = time.perf_counter()
+	# Build tables and setup messages are not what is measured
+	with contextlib.redirect_stdout(io.StringIO()):
+		fn()
+	elapsed = time.perf_counter() - start
+	peak = None
+	if TRACE:
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+	calls = client.recorder.since(mark) if client is not None else Counter()
+	return {"stage" : name, "ms" : elapsed * 1000, "peak_mb" : peak / 2**20 if peak is not None else None, "calls" : dict(calls)}
+
+def environment(path:str, cache:str, argv:list, client:FakeDockerClient) -> ContainedEnv:
+	config = compile_config(path, cache)
+	config.args = get_argparser().parse_args(argv + [a for p in config.projects for a in ("-p", p.name)])
+	# State files are written in the temporary directory, never in the home directory
+	statedir = os.path.join(os.path.dirname(cache), "state") if isinstance(client, FakeDockerClient) else None
+	return ContainedEnv(config, dockerclient = client, statedir = statedir)
+
+def table(results:list) -> str:
+	lines = [f"{'stage':<28}{'wall ms':>10}{'peak MB':>10}{'calls':>8}  breakdown"]
+	for r in results:
+		breakdown = ", ".join(f"{k} {v}" for k, v in sorted(r["calls"].items()))
+		peak = f"{r['peak_mb']:10.1f}" if r["peak_mb"] is not None else f"{'-':>10}"
+		lines.append(f"{r['stage']:<28}{r['ms']:10.1f}{peak}{sum(r['calls'].values()):8d}  {breakdown}")
+	return "\n".join(lines)
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description = "Scaling benchmarks on synthetic configs")
+	parser.add_argument("--packages", type = int, default = 2000)
+	parser.add_argument("--depth", type = int, default = 50, help = "Length of requirement chains")
+	parser.add_argument("--projects", type = int, default = 200)
+	parser.add_argument("--sources", type = int, default = 1, help = "Repositories per project")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--no-trace", dest = "trace", action = "store_false", help = "Do not trace memory")
+	parser.add_argument("--json", type = str, default = None, help = "Write the results to this file")
+	args = parser.parse_args()
+	global TRACE
+	TRACE = args.trace
+
+	results = []
+	with tempfile.TemporaryDirectory(prefix = "containedenv-bench.") as tmp:
+		path = write_config(
+			os.path.join(tmp, "synthetic.yml"),
+			packages = args.packages, depth = args.depth, projects = args.projects,
+			sources = args.sources, seed = args.seed
+		)
+		cache = os.path.join(tmp, "cache")
+
+		# Config: parse and validate, then reload the compiled config
+		results.append(measure("config (parse)", lambda: compile_config(path, cache)))
+		results.append(measure("config (compiled)", lambda: compile_config(path, cache)))
+		config = compile_config(path, cache)
+
+		# Resolution: requirement graph and layer plan of every project
+		def resolve():
+			PackageManager2(config, None).plan(config.projects, base = BASE_TOOLING)
+		results.append(measure("resolve (graph)", lambda: PackageGraph(config.packages)))
+		results.append(measure("resolve (plan)", resolve))
+
+		# Dockerfile generation and the daemon flow, against the fake client
+		client = FakeDockerClient(base_images = [config.app.imgfrom])
+		env = environment(path, cache, [], client)
+		results.append(measure("dockerfile", env._ContainedEnv__build_dockerfile, client))
+		results.append(measure("build_image (cold)", env.build_image, client))
+		env = environment(path, cache, [], client)
+		results.append(measure("build_image (up to date)", env.build_image, client))
+		results.append(measure("run_container", env.run_container, client))
+
+		# Plans: one listing of the daemon, then nothing but the state
+		def plan():
+			state = State.from_daemon(client)
+			plan_app(environment(path, cache, [], OfflineClient(state)), state)
+		results.append(measure("plan (daemon listing)", plan, client))
+
+		client.containers.get(env.config.containername()).remove(force = True)
+		env = environment(path, cache, ["--batch"], client)
+		with contextlib.redirect_stdout(io.StringIO()):
+			env.build_image()
+		results.append(measure("run_container (batch)", env.run_container, client))
+
+		# Snapshot of the setup, then a container started from it
+		client.containers.get(env.config.containername()).remove(force = True)
+		env = environment(path, cache, ["--batch", "--snapshot"], client)
+		with contextlib.redirect_stdout(io.StringIO()):
+			env.build_image()
+		results.append(measure("run_container (snapshot)", env.run_container, client))
+		client.containers.get(env.config.containername()).remove(force = True)
+		results.append(measure("run_container (from snapshot)", env.run_container, client))
+
+	print(f"{args.packages} packages (chains of {args.depth}), {args.projects} projects, {args.sources} source(s) each")
+	print(table(results))
+	if args.json is not None:
+		with open(args.json, "w") as f:
+			json.dump({"parameters" : vars(args), "results" : results}, f, indent = 2)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,55 @@
+# Synthetic containedenv configs, shaped like config/default.yml but much larger.
+import random
+import yaml
+
+
+def synthetic_config(
+		packages:int = 2000,
+		depth:int = 50,
+		projects:int = 200,
+		sources:int = 1,
+		seed:int = 0
+	) -> dict:
+	rng = random.Random(seed)
+	apt = [f"lib{i}-dev" for i in range(300)]
+
+	pkgs = []
+	for i in range(packages):
+		requires = []
+		# Chains of 'depth' packages, each requiring the previous one
+		if i % depth != 0:
+			requires.append(f"$pkg{i - 1}")
+		# Plus a few requirements on older packages, which keeps the graph acyclic
+		if i > 0:
+			requires += [f"$pkg{rng.randrange(i)}" for _ in range(rng.randint(0, 2))]
+		pkgs.append({
+			"name" : f"pkg{i}",
+			"requires" : requires,
+			"apt_packages" : rng.sample(apt, rng.randint(0, 3)),
+			"image" : [f"ENV PKG{i}_HOME /opt/pkg{i}", f"RUN echo pkg{i} > /opt/pkg{i}.txt"]
+		})
+
+	projs = []
+	for i in range(projects):
+		projs.append({
+			"name" : f"project{i}",
+			"workspace" : "$PROJECTS",
+			"requires" : [f"$pkg{rng.randrange(packages)}" for _ in range(rng.randint(1, 5))],
+			"image" : [f"ENV PROJECT{i} /home/bench/projects/project{i}"],
+			"sources" : [f"file:///srv/git/project{i}-{j}.git" for j in range(sources)],
+			"container" : [f"echo setup project{i} step {j}" for j in range(rng.randint(1, 3))],
+			# Some projects wait for the previous one
+			"depends" : [f"project{i - 1}"] if i > 0 and rng.random() < 0.2 else []
+		})
+
+	return {
+		"app" : {"name" : "bench", "user" : "bench", "from" : "ubuntu:22.04"},
+		"github_profile" : {"user" : "bench", "mail" : "bench@example.com", "token" : "0000"},
+		"packages" : pkgs,
+		"projects" : projs
+	}
+
+def write_config(path:str, **kwargs) -> str:
+	with open(path, "w") as f:
+		yaml.safe_dump(synthetic_config(**kwargs), f, sort_keys = False)
+	return path
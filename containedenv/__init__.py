@@ -1,3 +1,27 @@
-from .config import *
-from .dockerfile import *
-from .engine import *
\ No newline at end of file
+import importlib
+
+# Public names and the module defining them. Modules are imported on first use:
+# the engine pulls docker and pyrc, which the command line does not always need.
+_EXPORTS = {
+    "AppContainer" : "containedenv.config",
+    "GithubProfile" : "containedenv.config",
+    "Package" : "containedenv.config",
+    "Project" : "containedenv.config",
+    "Config" : "containedenv.config",
+    "Resources" : "containedenv.config",
+    "config_dir" : "containedenv.config",
+    "load_config" : "containedenv.config",
+    "find_config" : "containedenv.config",
+    "compile_config" : "containedenv.config",
+    "UbuntuDockerFile" : "containedenv.dockerfile",
+    "ContainedEnv" : "containedenv.engine",
+    "AsyncEngine" : "containedenv.aioengine",
+    "AsyncDockerClient" : "containedenv.aioengine",
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name:str):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name]), name)
+    raise AttributeError(f"module 'containedenv' has no attribute '{name}'")
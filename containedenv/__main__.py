@@ -1,9 +1,6 @@
 import argparse
 import sys
-from containedenv.engine import ContainedEnv
-from containedenv.config import *
-
-from pyrc.remote import create_default_sshconnectors
+from containedenv.mirrors import default_mirror_dir
 
 def get_argparser():
     parser = argparse.ArgumentParser(
@@ -15,7 +12,20 @@ def get_argparser():
         dest="nobuild",
         action="store_true",
         help=(
-            "Do not actually build the image. Useful in conjunction " "with --debug."
+            "Do not build nor run anything, print what a run would do: the steps of the image built again "
+            "and the setup steps run in the container. Existing images and containers are taken from the "
+            "state file of the app, which runs keep up to date. With --debug, print the dockerfile and "
+            "setup scripts too"
+        )
+    )
+
+    parser.add_argument(
+        "--query-daemon",
+        dest="query_daemon",
+        action="store_true",
+        help=(
+            "With --no-build, list the images and containers of the daemon (one query each) "
+            "instead of relying on the state file alone"
         )
     )
 
@@ -40,8 +50,20 @@ def get_argparser():
     parser.add_argument(
         "--config",
         type=str,
-        default="config/default.yml",
-        help="Path to config file for containedenv"
+        nargs="+",
+        default=["config/default.yml"],
+        help=(
+            "Path to config file for containedenv, or name of a config in the config directory. "
+            "When several configs are given, their images are built concurrently and no container is run."
+        )
+    )
+
+    parser.add_argument(
+        "--max-builds",
+        dest="max_builds",
+        type=int,
+        default=2,
+        help="Maximum number of images built at the same time when several configs are given"
     )
 
     parser.add_argument(
@@ -98,10 +120,291 @@ def get_argparser():
         )
     )
 
+    parser.add_argument(
+        "--workers",
+        "-w",
+        dest="workers",
+        type=int,
+        default=4,
+        help=(
+            "Maximum number of projects setup concurrently in the container"
+        )
+    )
+
+    parser.add_argument(
+        "--batch",
+        "-b",
+        dest="batch",
+        action="store_true",
+        help=(
+            "Run each project setup as a single script in the container instead of "
+            "one docker exec per command"
+        )
+    )
+
+    parser.add_argument(
+        "--asyncio",
+        dest="asyncio",
+        action="store_true",
+        help=(
+            "Like --batch, with every project script run from one asyncio event loop talking to "
+            "the daemon socket instead of one thread per project (unix socket endpoints only)"
+        )
+    )
+
+    parser.add_argument(
+        "--build-report",
+        dest="build_report",
+        type=str,
+        default=None,
+        help=(
+            "Path of a JSON file where the duration of each build step is written"
+        )
+    )
+
+    parser.add_argument(
+        "--optimize",
+        dest="optimize",
+        action="store_true",
+        help=(
+            "Merge adjacent RUN and ENV instructions of each package or project, drop package caches "
+            "in the layer that filled them and report constructs that defeat the layer cache"
+        )
+    )
+
+    parser.add_argument(
+        "--size-report",
+        dest="size_report",
+        action="store_true",
+        help="After a build, print the image size added by each package and project"
+    )
+
+    parser.add_argument(
+        "--multistage",
+        dest="multistage",
+        action="store_true",
+        help=(
+            "Build independent packages declaring 'outputs' in their own stages, "
+            "built concurrently and copied into the final image"
+        )
+    )
+
+    parser.add_argument(
+        "--tiers",
+        dest="tiers",
+        action="store_true",
+        help=(
+            "Start images from shared base image tiers. When several configs are given, "
+            "the package prefixes they share are built as tiers first"
+        )
+    )
+
+    parser.add_argument(
+        "--git-mirrors",
+        dest="git_mirrors",
+        type=str,
+        nargs="?",
+        const=default_mirror_dir(),
+        default=None,
+        help=(
+            "Keep bare mirrors of project sources in this host directory "
+            f"(default {default_mirror_dir()}), mounted read only in the container "
+            "and used as clone references"
+        )
+    )
+
+    parser.add_argument(
+        "--pool",
+        dest="pool",
+        type=int,
+        default=0,
+        help=(
+            "Keep this many ready (already setup) containers of the image. "
+            "A new container is then handed out from the pool, which is topped up in the background"
+        )
+    )
+
+    parser.add_argument(
+        "--pool-refill",
+        dest="pool_refill",
+        action="store_true",
+        help=argparse.SUPPRESS
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        dest="snapshot",
+        action="store_true",
+        help=(
+            "Commit the container once its projects are setup into a snapshot image. "
+            "New containers of the same image and setup start from it and skip the setup"
+        )
+    )
+
+    parser.add_argument(
+        "--cache-mounts",
+        dest="cache_mounts",
+        action="store_true",
+        help=(
+            "Keep apt and pip downloads in BuildKit cache mounts across builds. "
+            "Images are then built with BuildKit through the docker command line"
+        )
+    )
+
+    parser.add_argument(
+        "--package-proxy",
+        dest="package_proxy",
+        type=str,
+        default=None,
+        help=(
+            "URL of a (caching) proxy used by package managers, during builds and container setup"
+        )
+    )
+
+    parser.add_argument(
+        "--docker-host",
+        dest="docker_hosts",
+        action="append",
+        default=None,
+        metavar="URL",
+        help=(
+            "Docker endpoint to build images and run containers on (unix://, tcp:// or ssh:// url, "
+            "'local' for the daemon of the environment). Given several times, each build goes to the "
+            "endpoint with the least load, preferring endpoints already holding its tiers or image"
+        )
+    )
+
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        type=str,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Record the time spent in each phase (config, dockerfile, build, setup, ...) "
+            "and write it to PATH as a Chrome trace, to open in chrome://tracing or ui.perfetto.dev"
+        )
+    )
+
+    parser.add_argument(
+        "--lock",
+        dest="lock",
+        action="store_true",
+        help=(
+            "Resolve the digest of the base image and the versions of the apt packages missing from "
+            "the lockfile next to the config (<config>.lock.json), write it and exit. "
+            "Images of a locked config use the pinned versions"
+        )
+    )
+
+    parser.add_argument(
+        "--update-lock",
+        dest="update_lock",
+        action="store_true",
+        help=(
+            "Like --lock, but resolve the base image and every apt package again, "
+            "to move the lockfile to the current versions"
+        )
+    )
+
+    parser.add_argument(
+        "--no-config-cache",
+        dest="no_config_cache",
+        action="store_true",
+        help="Always parse the config file instead of loading its compiled version"
+    )
+
     return parser
 
-if __name__ == "__main__":
+def _refill_argv(argv, endpoint):
+    # Never rebuild from the background process, nor overwrite the trace of this one.
+    # The pool is filled on the endpoint the image was placed on.
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a in ("--trace", "--docker-host"):
+            skip = True
+        elif a not in ("--rebuild", "-r") and not a.startswith(("--trace=", "--docker-host=")):
+            out.append(a)
+    return out + (["--docker-host", endpoint.url] if endpoint is not None else [])
+
+def main():
     containedenvargs, otherargs = get_argparser().parse_known_args(sys.argv[1:])
-    c = ContainedEnv(Config.from_args(containedenvargs))
+    configs = containedenvargs.config
+
+    if containedenvargs.trace is not None:
+        from containedenv import trace
+        trace.enable()
+    try:
+        run(containedenvargs, configs)
+    finally:
+        if containedenvargs.trace is not None:
+            trace.tracer().write(containedenvargs.trace)
+
+def run(containedenvargs, configs):
+    # Docker and pyrc are only imported once a command needs the daemon
+    from containedenv.config import Config
+    from containedenv.trace import span
+
+    if containedenvargs.lock or containedenvargs.update_lock:
+        import copy
+        from containedenv.engine import ContainedEnv
+        from containedenv.endpoints import LOCAL_ENDPOINT, Endpoint
+        endpoint = Endpoint((containedenvargs.docker_hosts or [LOCAL_ENDPOINT])[0])
+        for path in configs:
+            envargs = copy.copy(containedenvargs)
+            envargs.config = path
+            env = ContainedEnv(Config.from_args(envargs), endpoint = endpoint)
+            changes = env.lock(update = containedenvargs.update_lock)
+            print(f"{env.config.lockfile().path}: {len(changes)} change(s)")
+            [print(f"  {change}") for change in changes]
+        return
+
+    if containedenvargs.nobuild:
+        from containedenv.plan import plan_configs, plan_text
+        from containedenv.state import State
+        daemon = None
+        if containedenvargs.query_daemon:
+            from containedenv.endpoints import LOCAL_ENDPOINT, docker_client
+            daemon = State.from_daemon(docker_client((containedenvargs.docker_hosts or [LOCAL_ENDPOINT])[0]))
+        with span("plan"):
+            print(plan_text(plan_configs(containedenvargs, configs, daemon), verbose = containedenvargs.debug))
+        return
+
+    if len(configs) > 1:
+        from containedenv.fleet import build_many, summary_table
+        summaries = build_many(containedenvargs, configs, containedenvargs.max_builds)
+        print(summary_table(summaries))
+        sys.exit(1 if any(s.status == "failed" for s in summaries) else 0)
+
+    from containedenv.engine import ContainedEnv
+    containedenvargs.config = configs[0]
+    with span("config.load", path = configs[0], cached = not containedenvargs.no_config_cache):
+        config = Config.from_args(containedenvargs)
+    endpoint = None
+    if containedenvargs.docker_hosts:
+        # An existing container stays where it is, otherwise the image goes where it is cheapest
+        from containedenv.endpoints import Scheduler
+        scheduler = Scheduler.from_urls(containedenvargs.docker_hosts)
+        if len(scheduler.endpoints) > 1:
+            scheduler.probe()
+        endpoint = scheduler.place([config.imagename()], container = config.containername())
+        if len(scheduler.endpoints) > 1:
+            print(f"Using docker endpoint {endpoint.url}")
+    c = ContainedEnv(config, endpoint = endpoint)
+    if containedenvargs.pool_refill:
+        # Never builds, a refill for an out of date image stops there
+        c.refill_pool()
+        return
+
     c.build_image()
-    c.run_container()
\ No newline at end of file
+    c.run_container()
+    if containedenvargs.pool > 0:
+        from containedenv.pool import refill_log, spawn_refill
+        log = refill_log(config.appname())
+        spawn_refill(_refill_argv(sys.argv[1:], endpoint), log)
+        print(f"Pool of {config.appname()} refilled in the background, log in {log}")
+
+if __name__ == "__main__":
+    main()
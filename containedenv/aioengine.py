@@ -0,0 +1,361 @@
+import asyncio
+import codecs
+import json
+import os
+import struct
+import urllib.parse
+from typing import AsyncIterator, Callable, Dict, List, Tuple, Union
+from containedenv.buildlog import BuildLog
+from containedenv.config import config_dir, parse_size
+from containedenv.context import DOCKERFILE, build_context, context_files
+
+# Default daemon socket, DOCKER_HOST (unix://...) takes precedence
+DOCKER_SOCKET = "/var/run/docker.sock"
+# Names of the streams multiplexed in exec output
+_STREAMS = {0 : "stdin", 1 : "stdout", 2 : "stderr"}
+
+
+class DockerAPIError(RuntimeError):
+	def __init__(self, status:int, message:str) -> None:
+		self.status = status
+		super().__init__(f"{status} {message}")
+
+class NotFound(DockerAPIError):
+	pass
+
+class BuildError(DockerAPIError):
+	def __init__(self, message:str, log:BuildLog) -> None:
+		self.log = log
+		super().__init__(500, message)
+
+
+def docker_socket() -> str:
+	host = os.environ.get("DOCKER_HOST", "")
+	if host == "":
+		return DOCKER_SOCKET
+	if not host.startswith("unix://"):
+		raise ValueError(f"The asyncio engine only talks to unix sockets, not {host}")
+	return host[len("unix://"):]
+
+
+class Response(object):
+	def __init__(self, status:int, headers:Dict[str, str], reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+		self.status:int = status
+		# Header names are lower case
+		self.headers:Dict[str, str] = headers
+		self.__reader = reader
+		self.__writer = writer
+
+	async def chunks(self) -> AsyncIterator[bytes]:
+		# Body as it arrives: chunked, sized, or raw until the daemon closes (hijacked streams)
+		if self.status in (204, 304):
+			return
+		if self.headers.get("transfer-encoding", "").lower() == "chunked":
+			while True:
+				size = int((await self.__reader.readline()).split(b";")[0].strip() or b"0", 16)
+				if size == 0:
+					# Trailers, up to the final empty line
+					while (await self.__reader.readline()).strip() != b"":
+						pass
+					return
+				data = await self.__reader.readexactly(size)
+				await self.__reader.readline()
+				yield data
+		elif "content-length" in self.headers and self.status != 101:
+			remaining = int(self.headers["content-length"])
+			while remaining > 0:
+				data = await self.__reader.read(min(remaining, 2**16))
+				if data == b"":
+					return
+				remaining -= len(data)
+				yield data
+		else:
+			while True:
+				data = await self.__reader.read(2**16)
+				if data == b"":
+					return
+				yield data
+
+	async def read(self) -> bytes:
+		return b"".join([data async for data in self.chunks()])
+
+	async def json(self):
+		body = await self.read()
+		return json.loads(body) if body.strip() != b"" else None
+
+	async def close(self) -> None:
+		self.__writer.close()
+		try:
+			await self.__writer.wait_closed()
+		except (ConnectionError, OSError):
+			pass
+
+
+class AsyncDockerClient(object):
+	def __init__(self, socket:str = None) -> None:
+		self.socket:str = socket if socket is not None else docker_socket()
+
+	async def request(
+			self,
+			method:str,
+			path:str,
+			params:dict = None,
+			body:Union[bytes, dict, list] = None,
+			headers:Dict[str, str] = None,
+			upgrade:bool = False
+		) -> Response:
+		# One connection per request, the daemon is local and connections are cheap.
+		# The caller reads the body then closes the response.
+		params = {k : v for k, v in (params or {}).items() if v is not None}
+		target = urllib.parse.quote(path) + (f"?{urllib.parse.urlencode(params)}" if len(params) > 0 else "")
+		headers = dict(headers or {})
+		if isinstance(body, (dict, list)):
+			body = json.dumps(body).encode("utf-8")
+			headers.setdefault("Content-Type", "application/json")
+		body = body if body is not None else b""
+		headers["Host"] = "docker"
+		headers["Content-Length"] = str(len(body))
+		if upgrade:
+			# Exec output is sent on the hijacked connection
+			headers.update({"Connection" : "Upgrade", "Upgrade" : "tcp"})
+		else:
+			headers["Connection"] = "close"
+
+		reader, writer = await asyncio.open_unix_connection(self.socket, limit = 2**20)
+		head = f"{method} {target} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+		writer.write(head.encode("latin-1") + body)
+		await writer.drain()
+
+		status = int((await reader.readline()).split()[1])
+		response_headers = {}
+		while True:
+			line = await reader.readline()
+			if line.strip() == b"":
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			response_headers[name.strip().lower()] = value.strip()
+		response = Response(status, response_headers, reader, writer)
+
+		if status >= 400:
+			try:
+				message = (await response.json() or {}).get("message", "")
+			except ValueError:
+				message = ""
+			finally:
+				await response.close()
+			raise (NotFound if status == 404 else DockerAPIError)(status, message)
+		return response
+
+	async def call(self, method:str, path:str, **kwargs):
+		# Request whose whole body is a json document (or nothing)
+		response = await self.request(method, path, **kwargs)
+		try:
+			return await response.json()
+		finally:
+			await response.close()
+
+	async def json_stream(self, response:Response) -> AsyncIterator[dict]:
+		# Documents of a streamed json body, whatever the chunk boundaries
+		decoder = json.JSONDecoder()
+		text = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+		buffer = ""
+		async for data in response.chunks():
+			buffer += text.decode(data)
+			while True:
+				buffer = buffer.lstrip()
+				try:
+					document, end = decoder.raw_decode(buffer)
+				except ValueError:
+					break
+				buffer = buffer[end:]
+				yield document
+
+
+class ExecStream(object):
+	def __init__(self, client:AsyncDockerClient, exec_id:str, response:Response) -> None:
+		self.__client = client
+		self.__response = response
+		self.exec_id:str = exec_id
+		# Exit code, known once the output was read to the end
+		self.code:int = None
+
+	def __aiter__(self) -> AsyncIterator[Tuple[str, str]]:
+		return self.__lines()
+
+	async def __frames(self) -> AsyncIterator[Tuple[str, bytes]]:
+		# Without a tty, output comes in frames: stream type, 3 zeros, big endian size
+		buffer = b""
+		async for data in self.__response.chunks():
+			buffer += data
+			while len(buffer) >= 8:
+				stream, size = struct.unpack(">BxxxL", buffer[:8])
+				if len(buffer) < 8 + size:
+					break
+				yield _STREAMS.get(stream, "stdout"), buffer[8:8 + size]
+				buffer = buffer[8 + size:]
+
+	async def __lines(self) -> AsyncIterator[Tuple[str, str]]:
+		# (stream name, line) as soon as each line is complete
+		decoders = {name : codecs.getincrementaldecoder("utf-8")(errors = "replace") for name in _STREAMS.values()}
+		pending = {name : "" for name in _STREAMS.values()}
+		try:
+			async for stream, data in self.__frames():
+				*lines, pending[stream] = (pending[stream] + decoders[stream].decode(data)).split("\n")
+				for line in lines:
+					yield stream, line
+			for stream, rest in pending.items():
+				if rest != "":
+					yield stream, rest
+		finally:
+			await self.__response.close()
+		self.code = (await self.__client.call("GET", f"/exec/{self.exec_id}/json"))["ExitCode"]
+
+
+class AsyncEngine(object):
+	def __init__(self, client:AsyncDockerClient = None, user:str = None) -> None:
+		self.client:AsyncDockerClient = client if client is not None else AsyncDockerClient()
+		# Default user of execs, the image user otherwise
+		self.user:str = user
+
+	async def image(self, name:str) -> dict:
+		return await self.client.call("GET", f"/images/{name}/json")
+
+	async def container(self, name:str) -> dict:
+		return await self.client.call("GET", f"/containers/{name}/json")
+
+	async def remove_image(self, name:str, force:bool = True) -> None:
+		await self.client.call("DELETE", f"/images/{name}", params = {"force" : int(force)})
+
+	async def remove_container(self, name:str, force:bool = True) -> None:
+		await self.client.call("DELETE", f"/containers/{name}", params = {"force" : int(force)})
+
+	async def build(
+			self,
+			dockerfile:str,
+			tag:str = None,
+			labels:dict = None,
+			echo:bool = False,
+			buildargs:Dict[str, str] = None,
+			container_limits:Dict[str, int] = None,
+			shmsize:int = None
+		) -> BuildLog:
+		# Same build as the synchronous engine: only the dockerfile and the files it copies are sent.
+		# buildargs, container_limits and shmsize are the ones of ContainedEnv.build_options().
+		log = BuildLog(dockerfile, echo = echo)
+		context = build_context(dockerfile, context_files(dockerfile, config_dir()))
+		response = await self.client.request(
+			"POST", "/build",
+			params = {
+				"t" : tag,
+				"labels" : json.dumps(labels) if labels is not None else None,
+				"buildargs" : json.dumps(buildargs) if buildargs else None,
+				"shmsize" : shmsize,
+				"dockerfile" : DOCKERFILE,
+				"rm" : 1,
+				"forcerm" : 1,
+				# memory, memswap, cpushares, cpusetcpus
+				**(container_limits or {})
+			},
+			body = context.getvalue(),
+			headers = {"Content-Type" : "application/x-tar"}
+		)
+		try:
+			async for chunk in self.client.json_stream(response):
+				log.feed(chunk)
+				if "error" in chunk:
+					raise BuildError(chunk["error"], log)
+		finally:
+			await response.close()
+		log.close()
+		return log
+
+	async def run(
+			self,
+			image:str,
+			name:str = None,
+			command:Union[str, List[str]] = "bash",
+			hostname:str = None,
+			labels:Dict[str, str] = None,
+			ports:dict = None,
+			volumes:dict = None,
+			environment:Dict[str, str] = None,
+			nano_cpus:int = None,
+			mem_limit:Union[str, int] = None,
+			shm_size:Union[str, int] = None
+		) -> str:
+		# Detached container with a tty, as the synchronous engine runs them.
+		# Other arguments are given as to docker.DockerClient.containers.run, environment and
+		# resources are the ones of ContainedEnv.run_options()
+		ports = {(str(c) if "/" in str(c) else f"{c}/tcp") : str(h) for c, h in (ports or {}).items()}
+		resources = {"NanoCpus" : nano_cpus, "Memory" : parse_size(mem_limit), "ShmSize" : parse_size(shm_size)}
+		body = {
+			"Image" : image,
+			"Cmd" : [command] if isinstance(command, str) else command,
+			"Hostname" : hostname or "",
+			"Labels" : labels or {},
+			"Env" : [f"{k}={v}" for k, v in (environment or {}).items()],
+			"Tty" : True,
+			"ExposedPorts" : {port : {} for port in ports},
+			"HostConfig" : {
+				"PortBindings" : {port : [{"HostPort" : host}] for port, host in ports.items()},
+				"Binds" : [f"{host}:{v['bind']}:{v.get('mode', 'rw')}" for host, v in (volumes or {}).items()],
+				**{k : v for k, v in resources.items() if v is not None}
+			}
+		}
+		created = await self.client.call("POST", "/containers/create", params = {"name" : name}, body = body)
+		await self.client.call("POST", f"/containers/{created['Id']}/start")
+		return created["Id"]
+
+	async def put_archive(self, container:str, path:str, data:bytes) -> None:
+		await self.client.call(
+			"PUT", f"/containers/{container}/archive",
+			params = {"path" : path}, body = data,
+			headers = {"Content-Type" : "application/x-tar"}
+		)
+
+	async def exec_stream(
+			self,
+			container:str,
+			cmd:Union[str, List[str]],
+			user:str = None,
+			cwd:str = None,
+			environment:Dict[str, str] = None
+		) -> ExecStream:
+		# Output lines of the command, as they are printed
+		created = await self.client.call("POST", f"/containers/{container}/exec", body = {
+			"Cmd" : ["bash", "-c", cmd] if isinstance(cmd, str) else cmd,
+			"User" : user or self.user or "",
+			"WorkingDir" : cwd or "",
+			"Env" : [f"{k}={v}" for k, v in (environment or {}).items()],
+			"AttachStdout" : True,
+			"AttachStderr" : True,
+			"Tty" : False
+		})
+		response = await self.client.request(
+			"POST", f"/exec/{created['Id']}/start",
+			body = {"Detach" : False, "Tty" : False},
+			upgrade = True
+		)
+		return ExecStream(self.client, created["Id"], response)
+
+	async def exec(
+			self,
+			container:str,
+			cmd:Union[str, List[str]],
+			user:str = None,
+			cwd:str = None,
+			on_line:Callable[[str, str], None] = None
+		) -> Tuple[int, List[str]]:
+		# Exit code and output lines, each line is also handed to on_line(stream, line) as it comes
+		stream = await self.exec_stream(container, cmd, user = user, cwd = cwd)
+		output = []
+		async for name, line in stream:
+			output.append(line)
+			if on_line is not None:
+				on_line(name, line)
+		return stream.code, output
+
+	async def bash(self, container:str, cmds:Union[str, List[str]], cwd:str = None, user:str = None) -> Tuple[int, List[str]]:
+		# Lines chained with '&&', empty ones skipped like in pyrc's engine
+		cmds = [cmds] if isinstance(cmds, str) else cmds
+		return await self.exec(container, " && ".join(c for c in cmds if c), user = user, cwd = cwd)
@@ -0,0 +1,133 @@
+import io
+import tarfile
+import time
+from dataclasses import dataclass, field
+from typing import List, Union
+from containedenv.trace import span
+
+# Prefix of the lines the script prints around each step
+MARKER = "__containedenv_step__"
+
+
+@dataclass
+class Step:
+	# Name reported in the step results
+	name:str
+	# Bash lines of the step, chained with '&&'
+	cmds:List[str]
+	# Directory the step is executed in
+	cwd:str = None
+	# Drop the step output (for steps handling secrets)
+	silent:bool = False
+
+@dataclass
+class StepResult:
+	name:str
+	# Exit code of the step, None if the step never ran
+	code:int = None
+	# Wall time of the step in seconds
+	duration:float = 0.0
+	# Output lines of the step
+	output:List[str] = field(default_factory=list)
+
+
+class SetupScript(object):
+	def __init__(self, name:str) -> None:
+		# Script name, used for its path in the container
+		self.name:str = name
+		self.steps:List[Step] = []
+
+	@property
+	def path(self) -> str:
+		return f"/tmp/containedenv-{self.name}.sh"
+
+	def add(self, name:str, cmds:Union[str, List[str]], cwd:str = None, silent:bool = False) -> "SetupScript":
+		cmds = [cmds] if isinstance(cmds, str) else cmds
+		# Empty lines are allowed in the engine's bash calls, skip them the same way
+		cmds = [c for c in cmds if c is not None and c != ""]
+		if len(cmds) > 0:
+			self.steps.append(Step(name, cmds, cwd, silent))
+		return self
+
+	def render(self) -> str:
+		lines = [
+			"#!/bin/bash",
+			# The script may hold credentials, never leave it behind
+			"trap 'sudo rm -f \"$0\" 2>/dev/null || rm -f \"$0\"' EXIT"
+		]
+		for i, step in enumerate(self.steps):
+			body = " && ".join(step.cmds)
+			if step.cwd is not None:
+				body = f"cd {step.cwd} && {body}"
+			redirect = " > /dev/null 2>&1" if step.silent else " 2>&1"
+			lines += [
+				f"echo \"{MARKER} begin {i} $(date +%s.%N)\"",
+				f"( {body} ){redirect}",
+				"code=$?",
+				# On a line of its own, the step output may not end with a newline
+				f"printf '\\n%s end {i} %s %s\\n' {MARKER} \"$code\" \"$(date +%s.%N)\"",
+				"[ $code -eq 0 ] || exit $code"
+			]
+		return "\n".join(lines) + "\n"
+
+	def archive(self) -> bytes:
+		# Tar archive holding the script, as expected by put_archive
+		data = self.render().encode("utf-8")
+		stream = io.BytesIO()
+		with tarfile.open(fileobj = stream, mode = "w") as tar:
+			info = tarfile.TarInfo(name = self.path.split("/")[-1])
+			info.size = len(data)
+			info.mode = 0o644
+			info.mtime = int(time.time())
+			tar.addfile(info, io.BytesIO(data))
+		return stream.getvalue()
+
+	def command(self) -> List[str]:
+		return ["bash", self.path]
+
+	def parse(self, output:Union[str, bytes]) -> List[StepResult]:
+		if isinstance(output, bytes):
+			output = output.decode("utf-8", errors = "replace")
+
+		results = [StepResult(step.name) for step in self.steps]
+		current, begin = None, 0.0
+		for line in output.splitlines():
+			if not line.startswith(MARKER):
+				if current is not None:
+					results[current].output.append(line)
+				continue
+			# The empty line printed before the end marker is not step output
+			if current is not None and len(results[current].output) > 0 and results[current].output[-1] == "":
+				results[current].output.pop()
+
+			fields = line[len(MARKER):].split()
+			if fields[0] == "begin":
+				current, begin = int(fields[1]), float(fields[2])
+			elif fields[0] == "end":
+				i = int(fields[1])
+				results[i].code = int(fields[2])
+				results[i].duration = float(fields[3]) - begin
+				current = None
+		return results
+
+	def run(self, container, user:str = None) -> List[StepResult]:
+		# One upload and one exec for the whole script
+		archive = self.archive()
+		with span("setup.upload", script = self.path, bytes = len(archive)):
+			container.put_archive(self.path.rsplit("/", 1)[0], archive)
+		with span("setup.exec", script = self.path) as s:
+			code, output = container.exec_run(self.command(), user = user or "")
+			s.set(exit_code = code, output_bytes = len(output))
+		return self.__check(code, self.parse(output))
+
+	async def arun(self, engine, container:str, user:str = None) -> List[StepResult]:
+		# Same as run, on the asyncio engine (containedenv.aioengine.AsyncEngine)
+		await engine.put_archive(container, self.path.rsplit("/", 1)[0], self.archive())
+		code, output = await engine.exec(container, self.command(), user = user)
+		return self.__check(code, self.parse("\n".join(output)))
+
+	def __check(self, code:int, results:List[StepResult]) -> List[StepResult]:
+		# The script itself failed outside of any step (not found, not readable, ...)
+		if code != 0 and all(r.code in (None, 0) for r in results):
+			raise RuntimeError(f"Setup script {self.path} exited with code {code}")
+		return results
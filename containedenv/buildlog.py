@@ -0,0 +1,254 @@
+import json
+import re
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Tuple
+from containedenv.context import logical_lines, split_stages
+
+# Comment written in the dockerfile before the lines of a package or a project
+OWNER_MARKER = "# containedenv:"
+
+_STEP = re.compile(r"^Step (\d+)/(\d+) : (.*)$")
+# BuildKit plain progress: '#7 [stage 2/5] RUN ...', then '#7 CACHED' or '#7 DONE 1.2s'
+_VERTEX = re.compile(r"^#(\d+) \[[^\]]*?(\d+)/(\d+)\] (.*)$")
+_VERTEX_STATUS = re.compile(r"^#(\d+) (CACHED|DONE ([\d.]+)s|ERROR.*)$")
+_WRITING_IMAGE = re.compile(r"writing image (sha256:[0-9a-f]+)")
+# History of a RUN: build arguments it saw ('|2 A=1 B=2'), then the shell
+_HISTORY_ARGS = re.compile(r"^\|\d+ (\S+=\S* )*")
+_HISTORY_SHELL = "/bin/sh -c "
+_HISTORY_NOP = "#(nop) "
+
+
+def owner_comment(kind:str, name:str) -> str:
+	return f"{OWNER_MARKER} {kind} {name}"
+
+def step_owners(dockerfile:str) -> List[str]:
+	# Owner of each build step (one per instruction, in order), from the owner comments
+	owners, owner, continued = [], "base", False
+	for line in dockerfile.splitlines():
+		stripped = line.strip()
+		if stripped.startswith(OWNER_MARKER):
+			owner = stripped[len(OWNER_MARKER):].strip()
+			continue
+		# Comments are ignored by docker, even inside continued instructions
+		if stripped.startswith("#") or stripped == "":
+			continue
+		if not continued:
+			owners.append(owner)
+		continued = stripped.endswith("\\")
+	return owners
+
+
+@dataclass
+class BuildStep:
+	# Step number, as printed by the builder
+	index:int
+	instruction:str
+	# Package or project that emitted the instruction
+	owner:str
+	duration:float = 0.0
+	cached:bool = False
+
+
+@dataclass
+class LayerSize:
+	instruction:str
+	owner:str
+	# Bytes added by the layer
+	size:int = 0
+
+
+def _layer_instructions(dockerfile:str) -> List[tuple]:
+	# (instruction, owner) making the layers of the final image: the last stage,
+	# after the stages it starts from (FROM <stage>)
+	stages, names = [], {}
+	for instruction, owner in zip(logical_lines(dockerfile), step_owners(dockerfile)):
+		words = instruction.split()
+		if words[0].upper() == "FROM":
+			stages.append((words[1], []))
+			if len(words) >= 4 and words[2].upper() == "AS":
+				names[words[3]] = len(stages) - 1
+		elif len(stages) > 0:
+			stages[-1][1].append((instruction, owner))
+	if len(stages) == 0:
+		return []
+	source, chain = stages[-1]
+	while source in names:
+		source, parent = stages[names[source]]
+		chain = parent + chain
+	return chain
+
+def _history_instruction(created_by:str) -> Tuple[str, str]:
+	# (keyword, arguments) of a history entry. The classic builder writes '/bin/sh -c cmd' for
+	# a RUN and '/bin/sh -c #(nop) ENV ...' for the others, BuildKit 'RUN /bin/sh -c cmd # buildkit'.
+	text = " ".join(created_by.split())
+	text = text[:-len("# buildkit")].rstrip() if text.endswith("# buildkit") else text
+	keyword = None
+	if text.startswith("RUN "):
+		keyword, text = "RUN", text[len("RUN "):]
+	text = _HISTORY_ARGS.sub("", text)
+	if text.startswith(_HISTORY_SHELL + _HISTORY_NOP):
+		keyword, _, text = text[len(_HISTORY_SHELL + _HISTORY_NOP):].strip().partition(" ")
+	elif text.startswith(_HISTORY_SHELL):
+		keyword, text = "RUN", text[len(_HISTORY_SHELL):]
+	elif keyword is None:
+		keyword, _, text = text.partition(" ")
+	return keyword.upper(), text.strip()
+
+def _same_instruction(instruction:str, keyword:str, args:str) -> bool:
+	words = instruction.split(None, 1)
+	if words[0].upper() != keyword:
+		return False
+	own = words[1] if len(words) > 1 else ""
+	if keyword == "RUN":
+		# Flags (--mount) are not in the history
+		while own.startswith("--"):
+			own = own.partition(" ")[2].lstrip()
+		return " ".join(own.split()) == args
+	if keyword == "ARG":
+		return own.split("=")[0].strip() == args.split("=")[0].strip()
+	if keyword == "ENV":
+		# Values are substituted in the history, names are not
+		names = lambda a: [p.split("=")[0] for p in a.split()] if "=" in a.split(None, 1)[0] else a.split()[:1]
+		return names(own) == names(args)
+	if keyword in ("COPY", "ADD"):
+		# Sources become content hashes, the destination stays
+		return own.split()[-1] == args.split()[-1] if len(args.split()) > 0 else False
+	return " ".join(own.split()) == args
+
+def layer_sizes(dockerfile:str, history:List[dict]) -> List[LayerSize]:
+	# Size of each layer of a built image from its history (docker image history, newest first),
+	# with the package or project that wrote the instruction. Entries are matched to instructions
+	# on what created them, from the newest: builders leave some instructions out of the history
+	# (ARG with BuildKit), and entries older than every match come from the base image.
+	chain = _layer_instructions(dockerfile)
+	matched, position, oldest = [], len(chain), len(history)
+	for i, entry in enumerate(history):
+		keyword, args = _history_instruction(entry.get("CreatedBy", ""))
+		found = next((j for j in range(position - 1, -1, -1) if _same_instruction(chain[j][0], keyword, args)), None)
+		if found is not None:
+			position, oldest = found, i
+			matched.append(LayerSize(chain[found][0], chain[found][1], entry.get("Size", 0)))
+		elif entry.get("Size", 0) > 0:
+			# Unknown entry with content, kept so that the total stays right
+			matched.append(LayerSize(f"{keyword} {args}".strip(), "unknown", entry.get("Size", 0)))
+		else:
+			matched.append(None)
+	base = history[oldest + 1:]
+	layers = [LayerSize("FROM", "base image", sum(e.get("Size", 0) for e in base))] if len(base) > 0 else []
+	return layers + [l for l in reversed(matched[:oldest + 1]) if l is not None]
+
+def size_table(layers:List[LayerSize]) -> str:
+	# Image size by owner, biggest first
+	owners:Dict[str, List[LayerSize]] = {}
+	[owners.setdefault(l.owner, []).append(l) for l in layers]
+	rows = [("owner", "layers", "size", "biggest layer")]
+	for owner, owned in sorted(owners.items(), key = lambda o: -sum(l.size for l in o[1])):
+		biggest = max(owned, key = lambda l: l.size).instruction
+		biggest = biggest if len(biggest) <= 50 else biggest[:47] + "..."
+		rows.append((owner, str(len(owned)), f"{sum(l.size for l in owned) / 2**20:.1f}MB", biggest))
+	widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+	lines = ["  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in rows]
+	lines.append(f"total {sum(l.size for l in layers) / 2**20:.1f}MB in {len(layers)} layers")
+	return "\n".join(lines)
+
+
+class BuildLog(object):
+	def __init__(self, dockerfile:str, echo:bool = False) -> None:
+		self.owners:List[str] = step_owners(dockerfile)
+		# Print builder output as it comes
+		self.echo:bool = echo
+		self.steps:List[BuildStep] = []
+		self.image_id:str = None
+		# Raw builder output, kept for error reports
+		self.output:List[dict] = []
+		# Layer sizes of the built image, when asked for (see layer_sizes)
+		self.layers:List[LayerSize] = None
+		self.__start:float = None
+		# BuildKit names steps by instruction, not by position: owner of each instruction
+		self.__owners:Dict[str, str] = {
+			" ".join(i.split()) : o for i, o in zip(logical_lines(dockerfile), self.owners)
+		}
+		# BuildKit steps by vertex number
+		self.__vertices:Dict[str, BuildStep] = {}
+
+	def __close_step(self) -> None:
+		if self.__start is not None and len(self.steps) > 0:
+			self.steps[-1].duration = time.perf_counter() - self.__start
+		self.__start = None
+
+	def feed(self, chunk:dict) -> None:
+		# Handle one decoded chunk of the build api stream
+		self.output.append(chunk)
+		if "aux" in chunk and "ID" in chunk["aux"]:
+			self.image_id = chunk["aux"]["ID"]
+		if "error" in chunk:
+			self.__close_step()
+			return
+
+		for line in chunk.get("stream", "").splitlines():
+			if self.echo and line.strip() != "":
+				print(line)
+			step = _STEP.match(line.strip())
+			if step is not None:
+				self.__close_step()
+				index = int(step.group(1))
+				owner = self.owners[index - 1] if index <= len(self.owners) else "unknown"
+				self.steps.append(BuildStep(index, step.group(3), owner))
+				self.__start = time.perf_counter()
+			elif line.strip() == "---> Using cache" and len(self.steps) > 0:
+				self.steps[-1].cached = True
+			elif line.startswith("Successfully built"):
+				self.__close_step()
+				if self.image_id is None:
+					self.image_id = line.split()[-1]
+
+	def feed_plain(self, line:str) -> None:
+		# Handle one line of BuildKit '--progress=plain' output
+		line = line.rstrip("\n")
+		self.output.append({"stream" : line})
+		if self.echo and line.strip() != "":
+			print(line)
+		vertex = _VERTEX.match(line)
+		if vertex is not None and vertex.group(1) not in self.__vertices:
+			instruction = vertex.group(4).strip()
+			owner = self.__owners.get(" ".join(instruction.split()), "base" if instruction.startswith("FROM") else "unknown")
+			self.__vertices[vertex.group(1)] = BuildStep(len(self.steps) + 1, instruction, owner)
+			self.steps.append(self.__vertices[vertex.group(1)])
+			return
+		status = _VERTEX_STATUS.match(line)
+		if status is not None and status.group(1) in self.__vertices:
+			step = self.__vertices[status.group(1)]
+			if status.group(2) == "CACHED":
+				step.cached = True
+			elif status.group(3) is not None:
+				step.duration = float(status.group(3))
+			return
+		image = _WRITING_IMAGE.search(line)
+		if image is not None:
+			self.image_id = image.group(1)
+
+	def close(self) -> None:
+		self.__close_step()
+
+	def table(self) -> str:
+		rows = [("step", "owner", "duration", "cached", "instruction")]
+		for s in self.steps:
+			instruction = s.instruction if len(s.instruction) <= 50 else s.instruction[:47] + "..."
+			rows.append((str(s.index), s.owner, f"{s.duration:.2f}s", "yes" if s.cached else "no", instruction))
+		widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+		lines = ["  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in rows]
+		total = sum(s.duration for s in self.steps)
+		lines.append(f"total {total:.2f}s, {sum(s.cached for s in self.steps)}/{len(self.steps)} steps cached")
+		return "\n".join(lines)
+
+	def to_dict(self) -> dict:
+		return {
+			"image" : self.image_id,
+			"steps" : [asdict(s) for s in self.steps],
+			"layers" : [asdict(l) for l in self.layers] if self.layers is not None else None
+		}
+
+	def write_json(self, path:str) -> None:
+		with open(path, "w") as f:
+			json.dump(self.to_dict(), f, indent = 2)
@@ -0,0 +1,36 @@
+import hashlib
+import json
+from typing import Dict, List
+
+# Image label holding the content key of the build plan the image was built from
+CONTENT_KEY_LABEL = "containedenv.content-key"
+
+
+def sha256(data:bytes) -> str:
+	return hashlib.sha256(data).hexdigest()
+
+def build_content_key(
+		dockerfile:str,
+		projects:List[str],
+		packages:List[str],
+		base_digest:str,
+		fragments:Dict[str, bytes]
+	) -> str:
+	# Everything that can change the resulting image goes in the key,
+	# serialized in a stable order so the same plan always gives the same key
+	plan = {
+		"dockerfile": sha256(dockerfile.encode("utf-8")),
+		"projects": sorted(projects),
+		"packages": sorted(packages),
+		"base": base_digest,
+		"fragments": {name : sha256(data) for name, data in sorted(fragments.items())}
+	}
+	return sha256(json.dumps(plan, sort_keys = True).encode("utf-8"))
+
+def read_files(files:Dict[str, str]) -> Dict[str, bytes]:
+	# Content of the files (name -> path) entering a content key
+	contents = {}
+	for name, path in files.items():
+		with open(path, "rb") as f:
+			contents[name] = f.read()
+	return contents
@@ -0,0 +1,117 @@
+import glob
+import io
+import os
+import re
+import tarfile
+from typing import Dict, List
+
+# Name of the Dockerfile inside the build context
+DOCKERFILE = "Dockerfile"
+
+_VARIABLE = re.compile(r"\$\{(\w+)\}|\$(\w+)")
+
+
+def logical_lines(dockerfile:str) -> List[str]:
+	# Join continued lines ('\' at the end) and drop comments
+	lines, current = [], ""
+	for line in dockerfile.splitlines():
+		stripped = line.strip()
+		# Docker ignores comments even inside continued instructions
+		if stripped.startswith("#") or stripped == "":
+			continue
+		if stripped.endswith("\\"):
+			current += stripped[:-1] + " "
+			continue
+		lines.append(current + stripped)
+		current = ""
+	if current != "":
+		lines.append(current)
+	return lines
+
+def split_stages(dockerfile:str) -> List[str]:
+	# Dockerfile text of each build stage, each one starting with its FROM line
+	stages = []
+	for line in dockerfile.splitlines(keepends = True):
+		if line.lstrip().upper().startswith("FROM ") or len(stages) == 0:
+			stages.append("")
+		stages[-1] += line
+	return stages
+
+def _substitute(value:str, variables:Dict[str, str]) -> str:
+	def replace(match):
+		name = match.group(1) or match.group(2)
+		return variables.get(name, match.group(0))
+	return _VARIABLE.sub(replace, value)
+
+def _unquote(value:str) -> str:
+	if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+		return value[1:-1]
+	return value
+
+def copied_sources(dockerfile:str) -> List[str]:
+	# Context paths used by COPY/ADD instructions, with ARG and ENV values substituted
+	variables:Dict[str, str] = {}
+	sources = []
+	for line in logical_lines(dockerfile):
+		parts = line.split(None, 1)
+		instruction = parts[0].upper()
+		args = parts[1] if len(parts) > 1 else ""
+
+		if instruction == "ARG" and "=" in args:
+			name, value = args.split("=", 1)
+			variables[name.strip()] = _unquote(value.strip())
+		elif instruction == "ENV" and args != "":
+			if "=" in args.split(None, 1)[0]:
+				for assignment in args.split():
+					name, _, value = assignment.partition("=")
+					variables[name] = _substitute(_unquote(value), variables)
+			else:
+				name, _, value = args.partition(" ")
+				variables[name] = _substitute(_unquote(value.strip()), variables)
+		elif instruction in ("COPY", "ADD"):
+			words = [w for w in args.split() if not w.startswith("--")]
+			# Copies from other stages never come from the context
+			if any(w.startswith("--from") for w in args.split()):
+				continue
+			for source in words[:-1]:
+				source = _substitute(_unquote(source), variables)
+				if "://" in source:
+					continue
+				if source not in sources:
+					sources.append(source)
+	return sources
+
+def context_files(dockerfile:str, root:str) -> Dict[str, str]:
+	# Files of 'root' the dockerfile needs (context path -> local path)
+	files = {}
+	for source in copied_sources(dockerfile):
+		matches = glob.glob(os.path.join(root, source))
+		if len(matches) == 0:
+			raise FileNotFoundError(f"COPY source '{source}' not found in {root}")
+		for match in matches:
+			paths = [match]
+			if os.path.isdir(match):
+				paths = [
+					os.path.join(d, f) for d, _, names in os.walk(match) for f in names
+				]
+			for path in paths:
+				files[os.path.relpath(path, root)] = path
+	return files
+
+def build_context(dockerfile:str, files:Dict[str, str]) -> io.BytesIO:
+	# Uncompressed tarball streamed to the daemon as a custom context.
+	# Entries are sorted with fixed metadata so the same inputs give the same bytes.
+	stream = io.BytesIO()
+	with tarfile.open(fileobj = stream, mode = "w") as tar:
+		entries = {DOCKERFILE : dockerfile.encode("utf-8")}
+		for name, path in files.items():
+			with open(path, "rb") as f:
+				entries[name] = f.read()
+
+		for name in sorted(entries):
+			info = tarfile.TarInfo(name = name)
+			info.size = len(entries[name])
+			info.mode = 0o644
+			tar.addfile(info, io.BytesIO(entries[name]))
+	stream.seek(0)
+	return stream
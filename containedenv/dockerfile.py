@@ -1,5 +1,24 @@
-from typing import List
+import re
+from typing import Dict, List
 from pyrc.docker import DockerFile
+from containedenv.lock import pinned
+
+# BuildKit cache mounts added to RUN instructions in cache mount mode: apt archives and lists, pip wheels.
+# Their content persists on the builder across builds but never enters an image layer.
+CACHE_MOUNTS = [
+    "--mount=type=cache,target=/var/cache/apt,sharing=locked",
+    "--mount=type=cache,target=/var/lib/apt,sharing=locked",
+    "--mount=type=cache,target=/root/.cache/pip",
+]
+# Build argument holding the number of parallel jobs of the build host, for 'make -j$JOBS' and the like
+JOBS_ARG = "JOBS"
+_USES_JOBS = re.compile(r"\$\{?" + JOBS_ARG + r"\b")
+# Ubuntu images delete downloaded .deb files after each install (docker-clean), which would leave the
+# apt cache mount empty. It is set aside only for the RUN using the mount: the image keeps it, and
+# apt-get run later in containers keeps no .deb file.
+_DOCKER_CLEAN = "/etc/apt/apt.conf.d/docker-clean"
+_KEEP_DOWNLOADS = f"(mv {_DOCKER_CLEAN} /etc/apt/docker-clean.off 2> /dev/null || true)"
+_CLEAN_DOWNLOADS = f"(mv /etc/apt/docker-clean.off {_DOCKER_CLEAN} 2> /dev/null || true)"
 
 
 class UbuntuDockerFile(DockerFile):
@@ -7,27 +26,100 @@ class UbuntuDockerFile(DockerFile):
             self,
             dockerfile:str,
             imgfrom:str,
-            user:str
+            user:str,
+            stage:str = None,
+            update:bool = True,
+            distribution:str = None,
+            cache_mounts:bool = False,
+            apt_versions:Dict[str, Dict[str, str]] = None
         ) -> None:
+        # Add BuildKit cache mounts to every RUN instruction (needs a BuildKit build)
+        self.cache_mounts:bool = cache_mounts
+        # Locked apt packages and what they pull in (see lock.Lockfile), None to install the current versions
+        self.apt_versions:Dict[str, Dict[str, str]] = apt_versions
+        # Lines of the instruction being written, held until it ends (see writeline)
+        self.__instruction:List[str] = []
+        # JOBS_ARG is declared in the current stage
+        self.__jobs:bool = False
         super().__init__(dockerfile, "w+")
 
         # open file
         self.open()
+        if cache_mounts:
+            # Must be the first line of the dockerfile
+            self.writeline("# syntax=docker/dockerfile:1")
 
         # From ubuntu 22 
-        self.FROM(imgfrom)
+        self.stage(imgfrom, stage)
 
         # Run eveything as root
         self.USER(f"{user}")
 
-        self.image:str = imgfrom.split(":")[0]
-        self.tag:str = imgfrom.split(":")[0]
+        # Image the package manager is guessed from, when imgfrom is a containedenv image
+        distribution = distribution if distribution is not None else imgfrom
+        self.image:str = distribution.split(":")[0]
+        self.tag:str = distribution.split(":")[0]
+
+        # Pkg setup (not needed when starting from an image that did it already).
+        # A locked base image is not upgraded, that would install whatever is current.
+        if update:
+            self.__apt_run([
+                f"{self.__package_manager()} update -y"
+            ] + ([f"{self.__package_manager()} upgrade -y"] if apt_versions is None else []))
+
+    def writeline(self, line:str) -> None:
+        if self.cache_mounts and line.startswith("RUN ") and not line.startswith("RUN --mount"):
+            line = f"RUN {' '.join(CACHE_MOUNTS)} {line[4:]}"
+        # An argument in scope is in the cache key of every later RUN of the stage, and the job
+        # count changes with the projects and the endpoint. JOBS_ARG is declared just before the
+        # first RUN using it, so the layers before it are shared whatever the job count.
+        self.__instruction.append(line)
+        stripped = line.strip()
+        continued = len(self.__instruction) > 1 and (stripped.startswith("#") or stripped == "")
+        if not stripped.endswith("\\") and not continued:
+            self.__flush()
+
+    def __flush(self) -> None:
+        lines, self.__instruction = self.__instruction, []
+        words = lines[0].split() if len(lines) > 0 else []
+        keyword = words[0].upper() if len(words) > 0 else ""
+        if keyword == "ARG" and len(words) > 1 and words[1].split("=")[0] == JOBS_ARG:
+            self.__jobs = True
+        elif keyword == "RUN" and not self.__jobs and _USES_JOBS.search("\n".join(lines)):
+            super().writeline(f"ARG {JOBS_ARG}")
+            self.__jobs = True
+        for line in lines:
+            super().writeline(line)
 
-        # Pkg setup
-        self.RUN([
-            f"{self.__package_manager()} update -y",
-            f"{self.__package_manager()} upgrade -y"
-        ])
+    def close(self) -> None:
+        self.__flush()
+        super().close()
+
+    def writelines(self, lines:List[str]) -> None:
+        [self.writeline(line) for line in lines]
+
+    def append_dockerfile(self, dockerfile:str) -> None:
+        # Appended dockerfiles get the cache mounts too
+        if not self.cache_mounts:
+            return super().append_dockerfile(dockerfile)
+        with open(dockerfile, "r") as f:
+            self.writelines(f.read().splitlines())
+
+    def stage(self, source:str, name:str = None) -> "UbuntuDockerFile":
+        # Start a new build stage, named if other stages refer to it
+        if name is None:
+            self.FROM(source)
+        else:
+            self.writeline(f"FROM {source} AS {name}")
+        # Build arguments are scoped to the stage declaring them
+        self.__jobs = False
+        return self
+
+    def __apt_run(self, commands:List[str]) -> None:
+        # A failed command fails the build, its layer is never kept without docker-clean
+        if self.cache_mounts:
+            commands = [_KEEP_DOWNLOADS] + commands + [_CLEAN_DOWNLOADS]
+        self.RUN(commands)
 
     def __package_manager(self) -> str:
         prefix:str = "DEBIAN_FRONTEND=noninteractive"
@@ -43,21 +135,29 @@ class UbuntuDockerFile(DockerFile):
         if "alpine" in self.image:
             return f"{prefix} apk"
 
-    def install(self, ubuntu_packages:List[str]) -> "UbuntuDockerFile":
+    def install(self, ubuntu_packages:List[str], clean:bool = False) -> "UbuntuDockerFile":
         if isinstance(ubuntu_packages, str):
-            return self.install([ubuntu_packages])
+            return self.install([ubuntu_packages], clean)
+
+        if self.apt_versions is not None:
+            ubuntu_packages = pinned(self.apt_versions, ubuntu_packages)
 
         if len(ubuntu_packages) == 0:
             return self
         
         if len(ubuntu_packages) == 1:
-            self.RUN(
-                f"{self.__package_manager()} install -y {ubuntu_packages[0]}" 
-            )
+            install = f"{self.__package_manager()} install -y {ubuntu_packages[0]}"
         else:
             install = " \ \n\t".join(ubuntu_packages)
-            self.RUN(
-                f"{self.__package_manager()} install -y \ \n\t{install}" 
-            )
+            install = f"{self.__package_manager()} install -y \ \n\t{install}"
+
+        if clean:
+            # Refresh and drop package lists in the same layer so they never get stored in the image,
+            # with cache mounts they live in the mount and are kept for the next build
+            self.__apt_run([
+                f"{self.__package_manager()} update -y",
+                install
+            ] + ([] if self.cache_mounts else ["rm -rf /var/lib/apt/lists/*"]))
+        else:
+            self.__apt_run([install])
         return self
-        
\ No newline at end of file
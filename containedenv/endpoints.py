@@ -0,0 +1,117 @@
+import threading
+from typing import Callable, Dict, List
+import docker
+
+# Endpoint name of the daemon configured in the environment (DOCKER_HOST, or the default socket)
+LOCAL_ENDPOINT = "local"
+
+
+def docker_client(url:str) -> docker.DockerClient:
+	# unix://, tcp:// and ssh:// urls are understood by the client library
+	if url == LOCAL_ENDPOINT:
+		return docker.from_env()
+	return docker.DockerClient(base_url = url)
+
+
+class Endpoint(object):
+	def __init__(
+			self, url:str, client:docker.DockerClient = None,
+			factory:Callable[[str], docker.DockerClient] = docker_client
+		) -> None:
+		self.url:str = url
+		self.__client = client
+		# Makes the client on first use. Clients ask the daemon its API version when they
+		# are made, so an unreachable daemon fails there (in probe, for several endpoints).
+		self.__factory = factory
+		# Builds and containers placed here by this process and not released yet
+		self.active:int = 0
+		# Containers running on the daemon when it was last probed
+		self.running:int = 0
+
+	@property
+	def client(self) -> docker.DockerClient:
+		if self.__client is None:
+			self.__client = self.__factory(self.url)
+		return self.__client
+
+	@property
+	def load(self) -> int:
+		return self.active + self.running
+
+	def is_local(self) -> bool:
+		# Host paths (git mirrors) can only be mounted in containers of a local daemon
+		return self.url == LOCAL_ENDPOINT or self.url.startswith("unix://")
+
+	def docker_host(self) -> str:
+		# DOCKER_HOST for the docker command line, None to keep the environment's
+		return None if self.url == LOCAL_ENDPOINT else self.url
+
+
+class Scheduler(object):
+	def __init__(self, endpoints:List[Endpoint]) -> None:
+		if len(endpoints) == 0:
+			raise ValueError("No docker endpoint")
+		self.endpoints:List[Endpoint] = endpoints
+		self.__lock = threading.Lock()
+
+	@staticmethod
+	def from_urls(urls:List[str], client:Callable[[str], docker.DockerClient] = docker_client) -> "Scheduler":
+		# client makes the client of an url, fake clients can be given in its place
+		return Scheduler([Endpoint(url, factory = client) for url in urls])
+
+	def probe(self) -> "Scheduler":
+		# Count the running containers of each endpoint, and leave out the unreachable ones
+		reachable = []
+		for endpoint in self.endpoints:
+			try:
+				endpoint.running = len(endpoint.client.containers.list(filters = {"status" : "running"}))
+				reachable.append(endpoint)
+			except Exception as e:
+				print(f"Docker endpoint {endpoint.url} is unreachable, not using it: {str(e).splitlines()[0] if str(e) != '' else type(e).__name__}")
+		if len(reachable) == 0:
+			raise RuntimeError("No docker endpoint is reachable")
+		self.endpoints = reachable
+		return self
+
+	def cached(self, endpoint:Endpoint, images:List[str]) -> int:
+		# images: what a build or container can reuse, shallowest first (tiers, then the app image).
+		# Number of them up to the deepest one the endpoint holds.
+		for depth in range(len(images), 0, -1):
+			try:
+				endpoint.client.images.get(images[depth - 1])
+				return depth
+			except docker.errors.ImageNotFound:
+				continue
+			except docker.errors.APIError:
+				return 0
+		return 0
+
+	def holding(self, container:str) -> Endpoint:
+		# Endpoint where a container of this name exists, containers never move
+		for endpoint in self.endpoints:
+			try:
+				endpoint.client.containers.get(container)
+				return endpoint
+			except docker.errors.NotFound:
+				continue
+			except docker.errors.APIError:
+				continue
+		return None
+
+	def place(self, images:List[str] = [], container:str = None) -> Endpoint:
+		# Each image already held saves about one build of work, so it is traded against one
+		# placement of load. Ties go to the least loaded endpoint, then to the first given.
+		# The placement counts in the endpoint load until released.
+		endpoint = self.holding(container) if container is not None else None
+		if endpoint is None:
+			depths:Dict[str, int] = {e.url : self.cached(e, images) for e in self.endpoints}
+		with self.__lock:
+			if endpoint is None:
+				order = {e.url : i for i, e in enumerate(self.endpoints)}
+				endpoint = min(self.endpoints, key = lambda e: (e.load - depths[e.url], e.load, order[e.url]))
+			endpoint.active += 1
+		return endpoint
+
+	def release(self, endpoint:Endpoint) -> None:
+		with self.__lock:
+			endpoint.active = max(0, endpoint.active - 1)
@@ -1,11 +1,37 @@
-from distutils.command.config import config
+import asyncio
+import os
+import subprocess
+import tempfile
+from urllib import parse
+from dataclasses import replace
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
 import docker
 from pyrc.system import LocalFileSystem
 from pyrc.docker import DockerEngine
-from containedenv.dockerfile import UbuntuDockerFile
+from containedenv.dockerfile import JOBS_ARG, UbuntuDockerFile
 from containedenv.packages import PackageManager, PackageManager2
+from containedenv.cache import CONTENT_KEY_LABEL, build_content_key, read_files, sha256
+from containedenv.tiers import Tier, BASE_TOOLING, TIER_BASE_LABEL, TIER_PACKAGES_LABEL, TIER_PARENT_LABEL
+from containedenv.tiers import tier_sequence, tier_chain, deepest_tier
+from containedenv.scheduler import ProjectScheduler
+from containedenv.batch import SetupScript, Step
+from containedenv.journal import SetupJournal, step_keys
+from containedenv.snapshot import SNAPSHOT_KEY_LABEL, snapshot_key, snapshot_tag
+from containedenv.mirrors import MirrorCache, clone_command, detach_command
+from containedenv.pool import ContainerPool, pool_key, refill_lock
+from containedenv.context import DOCKERFILE, build_context, context_files, split_stages
+from containedenv.buildlog import BuildLog, owner_comment, layer_sizes, size_table
+from containedenv.optimize import optimize, findings
+from containedenv.trace import span, traced
+from containedenv.endpoints import Endpoint
+from containedenv.state import State, state_path
+from containedenv.lock import lock_config
 from containedenv.config import *
 
+# Name of the first build stage in multistage mode (base image, apt packages and user)
+BASE_STAGE = "containedenv-base"
+
 #from traitlets import Any, Dict, Int, List, Unicode, Bool, default
 #from traitlets.config import Application
 
@@ -31,12 +57,47 @@ class ContainedEnv:
 	def args(self):
 		return self._config.args
 
-	def __init__(self, config:Config) -> None:
+	@property
+	def buildlog(self):
+		return self._buildlog
+
+	@property
+	def tier(self):
+		return self._tier
+
+	@property
+	def endpoint(self):
+		return self._endpoint
+
+	def __init__(self, config:Config, dockerclient:docker.DockerClient = None, endpoint:Endpoint = None, statedir:str = None) -> None:
 		# protected
 		self._local = LocalFileSystem()
 		self._config = config
 		self._engine = DockerEngine(user = self.config.app.user)
-		self._dockerclient = docker.from_env()
+		# Docker endpoint images are built and containers run on, None for the daemon of the environment
+		self._endpoint:Endpoint = endpoint
+		# The docker client may be shared between environments
+		if dockerclient is None:
+			dockerclient = endpoint.client if endpoint is not None else docker.from_env()
+		self._dockerclient = dockerclient
+		# Local state file of the app (in statedir if given), updated after builds and setups on a docker
+		# daemon. Plans against a state and other stand-in clients never write it unless given a statedir.
+		self._statepath:str = None
+		if self.args is not None and (statedir is not None or isinstance(dockerclient, docker.DockerClient)):
+			self._statepath = state_path(self.config.appname(), statedir)
+		# Package manager used to generate the last dockerfile
+		self._pkgmanager:PackageManager2 = None
+		# Log of the last image build, None if the image was reused
+		self._buildlog:BuildLog = None
+		# Shared base image tier the image starts from, if any
+		self._tier:Tier = None
+		# Host git mirrors of project sources, if enabled
+		self._mirrors:MirrorCache = None
+		if self.args is not None and self.args.git_mirrors is not None:
+			if endpoint is None or endpoint.is_local():
+				self._mirrors = MirrorCache(self.args.git_mirrors)
+			else:
+				print(f"Git mirrors are host directories, not used on the remote endpoint {endpoint.url}")
 
 	def home(self) -> str:
 		return f"/home/{self.config.app.user}"
@@ -44,18 +105,62 @@ class ContainedEnv:
 	def projects(self) -> str:
 		return f"{self.home()}/projects"
 
-	def __build_dockerfile(self):
+	@traced("dockerfile.generate")
+	def __build_dockerfile(self) -> str:
+		# The dockerfile is written to a private temporary file and returned as a string,
+		# so that concurrent builds never share a file
+		fd, path = tempfile.mkstemp(prefix = f"Dockerfile.{self.config.appname()}.")
+		os.close(fd)
+		try:
+			dockerfile = self.__write_dockerfile(path)
+		finally:
+			if self._local.isfile(path): self._local.unlink(path)
+		if self.args.optimize:
+			with span("dockerfile.optimize", size = len(dockerfile)) as s:
+				dockerfile = optimize(dockerfile)
+				s.set(optimized_size = len(dockerfile))
+			for finding in findings(dockerfile):
+				print(f"[{finding.owner}] {finding.message}: {finding.instruction}")
+		return dockerfile
+
+	def __write_dockerfile(self, path:str) -> str:
 		# Create the dockerfile
+		tier = self._tier
 		dockerfile = UbuntuDockerFile(
-			self.local.join(config_dir(), f"Dockerfile.{self.config.appname()}"),
-			self.config.app.imgfrom,
-			"root"
+			path,
+			self.config.base_image() if tier is None else tier.tag(),
+			"root",
+			stage = BASE_STAGE if self.args.multistage else None,
+			update = tier is None,
+			distribution = self.config.app.imgfrom,
+			cache_mounts = self.args.cache_mounts,
+			apt_versions = self.config.apt_versions()
 		)
 
-		# install utilitary packages
-		dockerfile.install(["sudo", "wget", "curl"])
+		# Plan the install so that stable layers come first
+		pkg = PackageManager2(self.config, dockerfile)
+		self._pkgmanager = pkg
+		# Packages of the tier are already in the image
+		if tier is not None:
+			pkg.installed.update(tier.packages)
+		plan = pkg.plan(
+			self.config.projects,
+			base = BASE_TOOLING if tier is None else [],
+			multistage = self.args.multistage
+		)
+		for owner, names in pkg.graph.unknown.items():
+			print(f"Unknown package(s) {', '.join(names)} required by {owner}, ignoring.")
+		if self.config.locked():
+			missing = self.config.lockfile().missing(self.config.app.imgfrom, plan.apt_packages)
+			if len(missing) > 0:
+				print(f"apt package(s) {', '.join(missing)} are not in {self.config.lockfile().path}, installed unpinned (run with --lock)")
+
+		# install utilitary packages and every apt package required by projects in one layer
+		dockerfile.writeline(owner_comment("apt", "packages"))
+		dockerfile.install(plan.apt_packages, clean = True)
 
 		# create the user workspace
+		dockerfile.writeline(owner_comment("base", "user"))
 		username = self.config.app.user
 		dockerfile.ENV("USER", username)
 		dockerfile.ENV("HOME", self.home())
@@ -72,86 +177,198 @@ class ContainedEnv:
 		])
 
 		# install user packages for projects
-		self.__install_projects(dockerfile)
+		self.__install_projects(dockerfile, plan)
 
 		# last line
+		dockerfile.writeline(owner_comment("base", "user"))
 		dockerfile.USER(username)
 		# TODO : make entrypoint a custom bash file
 		#dockerfile.ENTRYPOINT("sudo /usr/sbin/sshd -D")
 		dockerfile.close()
-		return dockerfile.filename
-
-	def __install_projects(self, dockerfile):
-		# Create Package manager
-		pkg = PackageManager2(self.config, dockerfile)
-		# Install project dependencies
-		[pkg.install_project_packages(p) for p in self.config.projects]
+		with open(dockerfile.filename, "r") as f:
+			return f.read()
+
+	def __install_projects(self, dockerfile, plan):
+		# Independent packages are built in their own stages, then copied in the final one
+		if len(plan.stages) > 0:
+			self._pkgmanager.install_stages(plan, BASE_STAGE)
+			dockerfile.stage(BASE_STAGE)
+			self._pkgmanager.copy_stages(plan)
+		# Install project dependencies (dockerfiles and image lines, apt packages are already in)
+		self._pkgmanager.install_plan(plan)
 		# Run docker commands for projects
 		for project in self.config.projects:
 			if project.name not in self.args.projects:
 				continue
+			dockerfile.writeline(owner_comment("project", project.name))
 			dockerfile.writelines(project.image)
 
 
-	def __setup_projects(self):
-		from urllib import parse
-
-		def __clone_repo(self, repourl:str, workspace:str) -> str:
-			# clone repositories (if git in name, else copy local path (?))
-			if ".git" in repourl:
-				repo_workspace = self._engine.join(
-					workspace,
-					self._engine.basename(repourl).replace(".git", "")
-				)
-
-				self._engine.bash(
-					cmds = f"git clone {repourl} {repo_workspace}",
-					cwd = workspace
-				)
-
-				return repo_workspace
-			else:
-				raise RuntimeError("Can only clone git repo at the moment.")
-
-		def __configure_repository(self, repo_workspace:str, ghprofile:GithubProfile) -> None:
-			if ghprofile is None: return
-			# Retrieve url from cloned repo
-			repourl = self._engine.evaluate("git config --get remote.origin.url", cwd = repo_workspace)[0]
-			# Get site from url to generate token line
-			repourl = parse.urlsplit(repourl)
-			user = ghprofile.user
-			mail = ghprofile.mail
-			token = ghprofile.token if ghprofile.token is not None else self.args.ghtoken
-
-			# Add token as a credential
-			if token is not None:
-				ghcredentials = f"{repourl.scheme}://{user}:{token}@{repourl.netloc}"
-				credentials_file = self._engine.join(".git", "." + user + "-credentials")
-				# Hidden token from stdout
-				self._engine.bash(
-					cmds = [f"echo \"{ghcredentials}\" | tee {credentials_file}"],
-					cwd = repo_workspace, silent = True
-				)
-
-			# Configure repository user and mail
-			self._engine.bash(
-				cmds = [
-					f"git config --local user.name {user}",
-					f"git config --local user.email {mail}" if mail is not None else "",
-					f"git config --local credential.helper \'store --file {credentials_file}\'" if token is not None else "",
-				],
-				cwd = repo_workspace
+	def __repo_workspace(self, repourl:str, workspace:str) -> str:
+		# clone repositories (if git in name, else copy local path (?))
+		if ".git" in repourl:
+			return self._engine.join(
+				workspace,
+				self._engine.basename(repourl).replace(".git", "")
 			)
-			
-		def __setup_project(self, project:Project):
-			# Step one, clone repositories of the projects
-			for repourl in project.sources:
-				repo_workspace = __clone_repo(self, repourl, project.workspace)
-				__configure_repository(self, repo_workspace, self.config.github_profile)
-
-
+		else:
+			raise RuntimeError("Can only clone git repo at the moment.")
+
+	def __clone_command(self, project:Project, repourl:str, repo_workspace:str) -> str:
+		# Clone from the host mirror when there is one, only what is missing from it is downloaded
+		reference = self._mirrors.container_path(repourl) if self._mirrors is not None else None
+		clone = clone_command(
+			repourl, repo_workspace,
+			reference = reference,
+			depth = project.clone_depth,
+			filter = project.clone_filter
+		)
+		# A repository cloned by a previous setup of the container is kept
+		return f"test -d {repo_workspace}/.git || {clone}"
+
+	def __token(self, ghprofile:GithubProfile) -> str:
+		# Token of the profile, or the one given on the command line
+		return ghprofile.token if ghprofile.token is not None else self.args.ghtoken
+
+	def __configure_commands(self, repourl:str, ghprofile:GithubProfile):
+		# Get site from url to generate token line
+		repourl = parse.urlsplit(repourl)
+		user = ghprofile.user
+		mail = ghprofile.mail
+		token = self.__token(ghprofile)
+
+		# Add token as a credential
+		credentials = []
+		if token is not None:
+			ghcredentials = f"{repourl.scheme}://{user}:{token}@{repourl.netloc}"
+			credentials_file = self._engine.join(".git", "." + user + "-credentials")
+			credentials = [f"echo \"{ghcredentials}\" | tee {credentials_file}"]
+
+		# Configure repository user and mail
+		configure = [
+			f"git config --local user.name {user}",
+			f"git config --local user.email {mail}" if mail is not None else "",
+			f"git config --local credential.helper \'store --file {credentials_file}\'" if token is not None else "",
+		]
+		return credentials, configure
+
+	def project_steps(self, project:Project) -> SetupScript:
+		# Setup steps of a project, applied with one exec each or as a single script
+		script = SetupScript(project.name)
+		script.add("env", f"echo \"export {project.name.upper()}={project.workspace}\" >> $HOME/.bashrc")
+		ghprofile = self.config.github_profile
+		for repourl in project.sources:
+			repo_workspace = self.__repo_workspace(repourl, project.workspace)
+			script.add(f"clone {repourl}", self.__clone_command(project, repourl, repo_workspace), cwd = project.workspace)
+			if ghprofile is None: continue
+			# The origin of a fresh clone is the url it was cloned from
+			credentials, configure = self.__configure_commands(repourl, ghprofile)
+			script.add(f"credentials {repo_workspace}", credentials, cwd = repo_workspace, silent = True)
+			script.add(f"configure {repo_workspace}", configure, cwd = repo_workspace)
+		for cmd in project.container:
+			script.add(f"run {cmd}", cmd, cwd = project.workspace)
+		return script
+
+	def credential_steps(self) -> List[Step]:
+		# Steps writing repository tokens (credentials file and credential.helper) of the selected projects.
+		# They are left out of snapshots and applied again to containers started from one.
+		selected = [p for p in self.config.projects if p.name in self.args.projects]
+		steps = [s for p in selected for s in self.project_steps(p).steps]
+		return [s for s in steps if s.name.split(" ")[0] in ("credentials", "configure")]
+
+	def __remove_credentials(self) -> None:
+		user = self.config.github_profile.user if self.config.github_profile is not None else None
+		for step in [s for s in self.credential_steps() if s.name.startswith("credentials ")]:
+			self._engine.bash(cmds = [
+				f"rm -f {self._engine.join('.git', '.' + user + '-credentials')}",
+				"(git config --local --unset-all credential.helper || true)"
+			], cwd = step.cwd)
+
+	def __restore_credentials(self) -> None:
+		for step in self.credential_steps():
+			self._engine.bash(cmds = step.cmds, cwd = step.cwd, silent = step.silent)
+
+	def __detach_clones(self) -> None:
+		# Clones borrowing objects of the mounted mirrors get their own copy, images committed from
+		# the container are run without the mount
+		selected = [p for p in self.config.projects if p.name in self.args.projects]
+		workspaces = [self.__repo_workspace(url, p.workspace) for p in selected for url in p.sources]
+		if len(workspaces) > 0:
+			self._engine.bash(cmds = [detach_command(w) for w in workspaces])
+
+	@traced("setup")
+	def __setup_projects(self):
+		def __run_batched(self, project:Project, script:SetupScript, log) -> None:
+			with span("setup.script", project = project.name, steps = len(script.steps)):
+				results = script.run(self._engine.container, user = self.config.user())
+			__report(self, project, results, log)
+
+		def __report(self, project:Project, results, log) -> None:
+			for result in results:
+				if result.code is None: continue
+				log(f"{result.name} exited with {result.code} in {result.duration:.2f}s")
+				if self.args.debug:
+					[print(f"[{project.name}] {line}") for line in result.output]
+				if result.code != 0:
+					raise RuntimeError(f"Step '{result.name}' exited with code {result.code}")
+
+		def __setup_project(self, project:Project, log) -> None:
+			with span("setup.project", project = project.name) as s:
+				__apply_steps(self, project, log, s)
+
+		async def __asetup_project(self, engine, project:Project, log) -> None:
+			# Same as __setup_project with --batch, on the asyncio engine. The journal and the
+			# mirrors are handled in a thread, the event loop keeps running the other projects.
+			with span("setup.project", project = project.name) as s:
+				script = await asyncio.get_running_loop().run_in_executor(None, __pending_script, self, project, log, s)
+				if len(script.steps) == 0:
+					return
+				with span("setup.script", project = project.name, steps = len(script.steps)):
+					results = await script.arun(engine, self._engine.container.name, user = self.config.user())
+				__report(self, project, results, log)
+
+		def __apply_steps(self, project:Project, log, s) -> None:
+			script = __pending_script(self, project, log, s)
+			if len(script.steps) == 0:
+				return
+			if self.args.batch:
+				# One exec for the whole setup
+				__run_batched(self, project, script, log)
+				return
+			for step in script.steps:
+				log(step.name)
+				# Silent steps handle secrets, their commands stay out of the trace
+				command = " && ".join(step.cmds) if not step.silent else None
+				with span("setup.step", project = project.name, step = step.name, command = command):
+					self._engine.bash(cmds = step.cmds, cwd = step.cwd, silent = step.silent)
+
+		def __pending_script(self, project:Project, log, s) -> SetupScript:
+			# Only the steps missing from the container journal are applied,
+			# each one records itself in the journal when it succeeds
+			script = self.project_steps(project)
+			pending = journal.pending(project.name, script.steps)
+			s.set(steps = len(script.steps), pending = len(pending))
+			if len(pending) < len(script.steps):
+				log(f"{len(script.steps) - len(pending)} step(s) already applied, {len(pending)} to apply")
+			script.steps = [
+				replace(step, cmds = step.cmds + [journal.record(key, project.name, step.name)])
+				for step, key in pending
+			]
+			# Refresh the host mirrors of the repositories about to be cloned
+			if self._mirrors is not None:
+				names = set(step.name for step in script.steps)
+				for url in project.sources:
+					if f"clone {url}" not in names: continue
+					with span("mirror.update", project = project.name, url = url):
+						self._mirrors.update(url)
+			return script
 
 		assert self._engine.container is not None
+		with span("setup.journal") as s:
+			journal = SetupJournal(f"{self.home()}/.containedenv/journal").load(
+				self._engine.container, user = self.config.user()
+			)
+			s.set(applied = len(journal.done))
 
 		# To correct : fatal: unable to access <repo>: server certificate verification failed. CAfile: none CRLfile: none
 		# Either put export GIT_SSL_NO_VERIFY=1 in image
@@ -159,36 +376,337 @@ class ContainedEnv:
 		self._engine.bash("git config --global http.sslverify false")
 
 		# Install projects
+		selected = []
 		for project in self.config.projects:
 			if project.name not in self.args.projects:
 				print(f"Project {project.name} not found, ignoring.")
 				continue
+			selected.append(project)
+
+		# Independent projects are setup concurrently, dependent ones wait for their dependencies
+		scheduler = ProjectScheduler(selected, workers = self.args.workers, known = [p.name for p in self.config.projects])
+		if self.args.asyncio:
+			engine = self.async_engine()
+			asyncio.run(scheduler.arun(lambda project, log: __asetup_project(self, engine, project, log)))
+		else:
+			scheduler.run(lambda project, log: __setup_project(self, project, log))
+		# Keys of every step now applied in the container
+		return journal.done | set(self.selected_step_keys())
 
-			# Add project workspace to the container's bashrc
-			self._engine.register_env(project.name.upper(), project.workspace)
-			# Clone and configure project's repositories
-			__setup_project(self, project)
-			# Call custom commands of the project in the container (if any)
-			[self._engine.bash(cmd, project.workspace) for cmd in project.container]
 
 
+	def async_engine(self) -> "AsyncEngine":
+		# Engine of --asyncio, on the socket of the endpoint (or of DOCKER_HOST)
+		from containedenv.aioengine import AsyncDockerClient, AsyncEngine
+		url = self._endpoint.docker_host() if self._endpoint is not None else None
+		if url is not None and not url.startswith("unix://"):
+			raise ValueError(f"--asyncio talks to unix sockets only, not to {url}")
+		return AsyncEngine(AsyncDockerClient(url[len("unix://"):] if url is not None else None), user = self.config.user())
 
 	def from_image(self, image:str) -> "ContainedEnv":
 		self._image = self._dockerclient.images.get(image)
 		return self
 
+	@traced("base_digest")
+	def base_digest(self, imgfrom:str = None) -> str:
+		imgfrom = imgfrom if imgfrom is not None else self.config.app.imgfrom
+		# A locked base is its digest, on every host
+		if self.config.lockfile() is not None and self.config.lockfile().locked(imgfrom):
+			return self.config.lockfile().base(imgfrom)
+		try:
+			base = self._dockerclient.images.get(imgfrom)
+			digests = base.attrs.get("RepoDigests") or []
+			return digests[0] if len(digests) > 0 else base.id
+		except docker.errors.ImageNotFound:
+			pass
+		try:
+			return self._dockerclient.images.get_registry_data(imgfrom).id
+		except docker.errors.APIError:
+			# Offline and not pulled yet, the name is the best we have
+			return imgfrom
+
+	@traced("content_key")
+	def content_inputs(self, dockerfile:str) -> dict:
+		# Appended dockerfiles and files copied from the build context
+		files = {**self._pkgmanager.fragments, **context_files(dockerfile, config_dir())}
+		return dict(
+			dockerfile = dockerfile,
+			projects = [p.name for p in self.config.projects if p.name in self.args.projects],
+			packages = list(self._pkgmanager.installed),
+			# A tier key already covers the base image it was built from
+			base_digest = self.base_digest() if self._tier is None else self._tier.key,
+			fragments = read_files(files)
+		)
+
+	def content_key(self, dockerfile:str) -> str:
+		return build_content_key(**self.content_inputs(dockerfile))
+
+	def image_plan(self) -> tuple:
+		# Dockerfile of the image and its inputs, the content key decides whether a build is needed
+		if self.args.tiers and self._tier is None:
+			self._tier = self.find_tier()
+		dockerfile = self.__build_dockerfile()
+		inputs = self.content_inputs(dockerfile)
+		return dockerfile, inputs, build_content_key(**inputs)
+
+	def __record(self, update) -> None:
+		# Read, update and write back the state file right away, concurrent runs lose little
+		if self._statepath is None:
+			return
+		try:
+			state = State.load(self._statepath)
+			update(state)
+			state.save(self._statepath)
+		except OSError as e:
+			print(f"Cannot update the state file {self._statepath}: {e}")
+
+	def __record_image(self, inputs:dict) -> None:
+		image, imgfrom, tier = self.image, self.config.app.imgfrom, self._tier
+		def update(state:State) -> None:
+			if tier is None:
+				base = inputs["base_digest"]
+				state.add_image(base, [imgfrom], {}, [base] if "@" in base else [])
+			parent = tier
+			while parent is not None:
+				state.add_image(parent.tag(), [parent.tag()], parent.labels())
+				parent = parent.parent
+			state.add_image(image.id, image.tags, image.labels, image.attrs.get("RepoDigests") or [])
+			state.builds[self.config.imagename()] = {
+				"dockerfile" : inputs["dockerfile"],
+				"base" : inputs["base_digest"],
+				"files" : {name : sha256(data) for name, data in inputs["fragments"].items()}
+			}
+		self.__record(update)
+
+	def tier_packages(self) -> List[str]:
+		# Every package of the image, in the canonical order tiers are cut from
+		graph = self.config.graph()
+		return graph.sorted_closure([r for p in self.config.projects for r in p.requires])
+
+	def use_tier(self, tier:Tier) -> "ContainedEnv":
+		self._tier = tier
+		return self
+
+	@traced("tiers.find")
+	def find_tier(self) -> Tier:
+		# Deepest existing tier image matching the packages of this image,
+		# whose content key still matches the current package definitions
+		sequence = tier_sequence(self.config, self.tier_packages())
+		names = [token.split("@")[0] for token in sequence[1:]]
+		candidates = []
+		for image in self._dockerclient.images.list(filters = {"label" : TIER_PACKAGES_LABEL}):
+			labels = image.labels
+			packages = [p for p in labels[TIER_PACKAGES_LABEL].split(",") if p != ""]
+			if labels.get(TIER_BASE_LABEL) == self.config.base_image() and packages == names[:len(packages)]:
+				candidates.append((len(packages), image))
+
+		for _, image in sorted(candidates, key = lambda c: -c[0]):
+			# Rebuild the chain of tiers this one was built on
+			chain = [image]
+			while chain[-1].labels.get(TIER_PARENT_LABEL, "") != "":
+				try:
+					chain.append(self._dockerclient.images.get(chain[-1].labels[TIER_PARENT_LABEL]))
+				except docker.errors.ImageNotFound:
+					break
+			if chain[-1].labels.get(TIER_PARENT_LABEL, "") != "":
+				continue
+			prefixes = [
+				tuple(sequence[:1 + len([p for p in i.labels[TIER_PACKAGES_LABEL].split(",") if p != ""])])
+				for i in reversed(chain)
+			]
+			tiers = tier_chain(prefixes, [(self.config, sequence)], {sequence[0] : self.base_digest()})
+			tier = tiers[prefixes[-1]]
+			if tier.key == image.labels.get(CONTENT_KEY_LABEL):
+				return tier
+		return None
+
+	@traced("tiers.build")
+	def build_tier(self, tier:Tier) -> "ContainedEnv":
+		# Tiers are tagged by content key, an existing tag is up to date
+		try:
+			self._dockerclient.images.get(tier.tag())
+		except docker.errors.ImageNotFound:
+			log = self.__stream_build(tier.dockerfile, tag = tier.tag(), labels = tier.labels())
+			print(f"Built tier {tier.tag()} ({', '.join(tier.packages) or 'base'}) in {sum(s.duration for s in log.steps):.2f}s")
+		return self
+
+	def proxy_environment(self) -> dict:
+		# Package managers (apt, pip, julia's downloads) honour the proxy variables.
+		# Given as build arguments they are not stored in the image.
+		proxy = self.args.package_proxy
+		if proxy is None:
+			return {}
+		return {name : proxy for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY")}
+
+	def lock(self, update:bool = False) -> List[str]:
+		# Resolve the base image digest and the apt package versions into the lockfile of the config
+		return lock_config(self.config, self._dockerclient, update = update, environment = self.proxy_environment())
+
+	def resources(self) -> Resources:
+		# Profile of the app and of the selected projects
+		return self.config.resources(self.args.projects)
+
+	def host_cpus(self) -> int:
+		# Cores of the docker host, which runs the builds and the containers
+		if getattr(self, "_host_cpus", None) is None:
+			self._host_cpus = os.cpu_count()
+			if self._endpoint is not None and not self._endpoint.is_local():
+				try:
+					self._host_cpus = self._dockerclient.info().get("NCPU") or self._host_cpus
+				except docker.errors.APIError:
+					pass
+		return self._host_cpus
+
+	def jobs(self) -> int:
+		return self.resources().job_count(self.host_cpus())
+
+	def build_arguments(self) -> dict:
+		return {**self.proxy_environment(), JOBS_ARG : str(self.jobs())}
+
+	def build_limits(self) -> dict:
+		# Limits of the classic builder's containers. It knows no cpu quota,
+		# cpus become a share of the host relative to other builds.
+		resources = self.resources()
+		limits = {}
+		if resources.memory is not None:
+			limits["memory"] = parse_size(resources.memory)
+			# No swap on top of the memory limit: memswap is memory plus swap, -1 would be unlimited swap
+			limits["memswap"] = limits["memory"]
+		if resources.cpus is not None:
+			limits["cpushares"] = int(resources.cpus * 1024)
+		return limits
+
+	def build_options(self) -> dict:
+		# Build arguments and limits of image builds, as docker.APIClient.build (and AsyncEngine.build) take them
+		return dict(
+			buildargs = self.build_arguments(),
+			container_limits = self.build_limits() or None,
+			shmsize = parse_size(self.resources().shm_size)
+		)
+
+	def run_options(self) -> dict:
+		# Environment and resources of containers, as containers.run (and AsyncEngine.run) take them.
+		# Setup commands download through the package proxy too, and know how many jobs to run.
+		resources = self.resources()
+		return dict(
+			environment = {**self.proxy_environment(), JOBS_ARG : str(self.jobs())},
+			nano_cpus = int(resources.cpus * 1e9) if resources.cpus is not None else None,
+			mem_limit = resources.memory,
+			shm_size = resources.shm_size
+		)
+
+	def __buildkit_build(self, log:BuildLog, context, tag:str = None, labels:dict = None) -> BuildLog:
+		# Cache mounts need BuildKit, which the docker client library cannot drive:
+		# the docker command line builds the same context, read from stdin
+		cmd = ["docker", "build", "--progress=plain"]
+		cmd += ["-t", tag] if tag is not None else []
+		cmd += [a for k, v in (labels or {}).items() for a in ("--label", f"{k}={v}")]
+		# BuildKit applies no resource limits to build steps, only the job count reaches it
+		cmd += [a for k, v in self.build_arguments().items() for a in ("--build-arg", f"{k}={v}")]
+		env = dict(os.environ, DOCKER_BUILDKIT = "1")
+		if self._endpoint is not None and self._endpoint.docker_host() is not None:
+			env["DOCKER_HOST"] = self._endpoint.docker_host()
+		process = subprocess.Popen(
+			cmd + ["-"],
+			stdin = subprocess.PIPE,
+			stdout = subprocess.PIPE,
+			stderr = subprocess.STDOUT,
+			env = env
+		)
+		# The whole context is read before the build starts
+		process.stdin.write(context.getvalue())
+		process.stdin.close()
+		for line in process.stdout:
+			log.feed_plain(line.decode("utf-8", errors = "replace"))
+		if process.wait() != 0:
+			raise docker.errors.BuildError(f"docker build exited with code {process.returncode}", iter(log.output))
+		log.close()
+		return log
+
+	def __stream_build(self, dockerfile:str, tag:str = None, labels:dict = None) -> BuildLog:
+		with span("build", tag = tag, buildkit = self.args.cache_mounts) as s:
+			log = BuildLog(dockerfile, echo = self.args.debug)
+			# Only send the dockerfile and the files it copies to the daemon
+			with span("build.context"):
+				context = build_context(dockerfile, context_files(dockerfile, config_dir()))
+			s.set(context_bytes = len(context.getbuffer()))
+			if self.args.cache_mounts:
+				self.__buildkit_build(log, context, tag, labels)
+			else:
+				self.__api_build(log, context, tag, labels)
+			s.set(steps = len(log.steps), cached = sum(step.cached for step in log.steps), image = log.image_id)
+			return log
+
+	def __api_build(self, log:BuildLog, context, tag:str = None, labels:dict = None) -> BuildLog:
+		# Stream the build through the low level api to time each step
+		stream = self._dockerclient.api.build(
+			fileobj = context,
+			custom_context = True,
+			dockerfile = DOCKERFILE,
+			tag = tag,
+			labels = labels,
+			**self.build_options(),
+			# Remove intermediate containers. 
+			# The docker build command now defaults to --rm=true, 
+			# but we have kept the old default of False to preserve backward compatibility
+			rm = True,
+			# Always remove intermediate containers, even after unsuccessful builds
+			forcerm = True,
+			decode = True
+		)
+		for chunk in stream:
+			log.feed(chunk)
+			if "error" in chunk:
+				raise docker.errors.BuildError(chunk["error"], iter(log.output))
+		log.close()
+		return log
+
+	@traced("build.stages")
+	def __build_stages(self, dockerfile:str) -> None:
+		# The builder runs stages one after the other, so each package stage is built
+		# on its own (base stage + package stage) concurrently to fill the layer cache,
+		# the final build then only has cache hits for them
+		stages = split_stages(dockerfile)
+		if len(stages) <= 2:
+			return
+		base, packages = stages[0], stages[1:-1]
+		self.__stream_build(base)
+		with ThreadPoolExecutor(max_workers = len(packages)) as pool:
+			[f.result() for f in [pool.submit(self.__stream_build, base + stage) for stage in packages]]
+
+	def __build(self, dockerfile:str, key:str):
+		if self.args.multistage:
+			self.__build_stages(dockerfile)
+		log = self.__stream_build(dockerfile, tag = self.config.imagename(), labels = {CONTENT_KEY_LABEL : key})
+
+		self._buildlog = log
+		print(log.table())
+		image = self._dockerclient.images.get(log.image_id)
+		if self.args.size_report:
+			log.layers = layer_sizes(dockerfile, image.history())
+			print(size_table(log.layers))
+		if self.args.build_report is not None:
+			log.write_json(self.args.build_report)
+		return image
+
+	@traced("build_image")
 	def build_image(self) -> "ContainedEnv":
+		# Start from the deepest up to date tier, if asked to, and create the docker file
+		dockerfile, inputs, key = self.image_plan()
+
 		image = None
 		try:
 			image = self._dockerclient.images.get(self.config.imagename())
-			# If rebuild, force destroy image and remove linked container
-			if self.args.rebuild:
+			# If rebuild or the image was built from another plan,
+			# force destroy image and remove linked container
+			if self.args.rebuild or image.labels.get(CONTENT_KEY_LABEL) != key:
 				try:
 					container = self._dockerclient.containers.get(self.config.containername())
 					container.remove(force = True)
 					container = None
 				except:
 					container = None
+				self.__record(lambda state: state.remove_container(self.config.containername()))
 
 				self._dockerclient.images.remove(
 					image = image.id, force = True
@@ -199,29 +717,140 @@ class ContainedEnv:
 			image = None
 
 		if image is None:
-			# create the docker file
-			dockerfile_path = self.__build_dockerfile()
-
-			# Build the actual image
-			self._engine.image, _ = self._dockerclient.images.build(
-				path = config_dir(),
-				dockerfile = dockerfile_path,
-				tag = self.config.imagename(),
-				# Remove intermediate containers. 
-				# The docker build command now defaults to --rm=true, 
-				# but we have kept the old default of False to preserve backward compatibility
-				rm = True,
-				# Always remove intermediate containers, even after unsuccessful builds
-				forcerm = True
-			)
-
-			# If everything went fine, remove docker file from file system
-			if self._local.isfile(dockerfile_path): self._local.unlink(dockerfile_path)
+			self._engine.image = self.__build(dockerfile, key)
 		else:
 			self._engine.image = image
+		self.__record_image(inputs)
 
 		return self
 
+	def __run(self, name:str, labels:dict = None, ports:bool = True, image:str = None):
+		# Find the image name tagged for this container, unless starting from another image (a snapshot)
+		matches = [tag for tag in self.image.tags if tag == self.config.imagename()]
+		if len(matches) == 0:
+			raise docker.errors.ImageNotFound
+
+		image = image if image is not None else matches[0]
+		with span("containers.run", container = name, image = image):
+			return self.__run_container(name, image, labels, ports)
+
+	def __run_container(self, name:str, image:str, labels:dict, ports:bool):
+		return self._dockerclient.containers.run(
+			image = image,
+			#image = self._image.id,
+			command = "bash",
+			name = name,
+			hostname = self.config.appname(),
+			labels = labels,
+			ports = {p.split(":")[0] : p.split(":")[1] for p in self.args.ports} if ports else None,
+			# Host git mirrors, read only
+			volumes = self._mirrors.volumes() if self._mirrors is not None else None,
+			tty = True,
+			**self.run_options(),
+			detach = True
+		)
+
+	def setup_keys(self) -> Dict[str, List[str]]:
+		# Setup step keys of each selected project
+		selected = [p for p in self.config.projects if p.name in self.args.projects]
+		return {p.name : step_keys(p.name, self.project_steps(p).steps) for p in selected}
+
+	def selected_step_keys(self) -> List[str]:
+		return [k for keys in self.setup_keys().values() for k in keys]
+
+	def snapshot_key(self, image_key:str = None) -> str:
+		# Key of the current image (or of the image with the given content key) and of the setup steps
+		# of the selected projects
+		image_key = image_key if image_key is not None else self.image.labels.get(CONTENT_KEY_LABEL, self.image.id)
+		return snapshot_key(image_key, self.setup_keys())
+
+	@traced("snapshot.find")
+	def find_snapshot(self):
+		# Snapshot committed from the current image and setup, if any
+		try:
+			image = self._dockerclient.images.get(snapshot_tag(self.config.imagename()))
+		except docker.errors.ImageNotFound:
+			return None
+		return image if image.labels.get(SNAPSHOT_KEY_LABEL) == self.snapshot_key() else None
+
+	@traced("snapshot.commit")
+	def snapshot(self) -> "ContainedEnv":
+		# Commit the set up container, later containers start from it without setup
+		key = self.snapshot_key()
+		tag = snapshot_tag(self.config.imagename())
+		previous = None
+		try:
+			previous = self._dockerclient.images.get(tag)
+		except docker.errors.ImageNotFound:
+			pass
+		if previous is not None and previous.labels.get(SNAPSHOT_KEY_LABEL) == key:
+			self.__record(lambda state: state.add_image(previous.id, [tag], previous.labels))
+			return self
+
+		repository, name = tag.rsplit(":", 1)
+		self.__detach_clones()
+		# Tokens never go in an image layer, the container gets them back once committed
+		self.__remove_credentials()
+		try:
+			image = self.container.commit(repository = repository, tag = name, changes = [f"LABEL {SNAPSHOT_KEY_LABEL}={key}"])
+		finally:
+			self.__restore_credentials()
+		print(f"Committed snapshot {tag}")
+		self.__record(lambda state: state.add_image(image.id, [tag], image.labels))
+		# The previous snapshot lost its tag, drop it unless a container still uses it
+		if previous is not None and previous.id != image.id:
+			try:
+				self._dockerclient.images.remove(image = previous.id)
+			except docker.errors.APIError:
+				pass
+		return self
+
+	def pool(self) -> ContainerPool:
+		# Pool of ready containers for the current image, project selection and credentials
+		selected = [p for p in self.config.projects if p.name in self.args.projects]
+		ghprofile = self.config.github_profile
+		key = pool_key(
+			self.image.labels.get(CONTENT_KEY_LABEL, self.image.id), selected,
+			ghprofile, self.__token(ghprofile) if ghprofile is not None else None
+		)
+		return ContainerPool(self._dockerclient, self.config.appname(), key, self.args.pool)
+
+	def current_image(self):
+		# Image of the app when it was built from the current plan, None otherwise. Never builds.
+		_, _, key = self.image_plan()
+		try:
+			image = self._dockerclient.images.get(self.config.imagename())
+		except docker.errors.ImageNotFound:
+			return None
+		return image if image.labels.get(CONTENT_KEY_LABEL) == key else None
+
+	@traced("pool.refill")
+	def refill_pool(self) -> "ContainedEnv":
+		# Only from an up to date image: building one would remove the container of the app
+		image = self.current_image()
+		if image is None:
+			print(f"Image {self.config.imagename()} is missing or out of date, pool of {self.config.appname()} not refilled")
+			return self
+		self._engine.image = image
+		statedir = os.path.dirname(self._statepath) if self._statepath is not None else None
+		with refill_lock(self.config.appname(), statedir):
+			pool = self.pool()
+			pool.evict_stale()
+			# Pool members are not committed (their labels would be), but start from an existing snapshot
+			snapshot = self.find_snapshot() if self.args.snapshot else None
+			# Pool members cannot all bind the same host ports, they get none
+			for _ in range(pool.missing()):
+				self._engine.container = self.__run(
+					pool.member_name(), labels = pool.labels(), ports = False,
+					image = snapshot_tag(self.config.imagename()) if snapshot is not None else None
+				)
+				if snapshot is None:
+					self.__setup_projects()
+				else:
+					self.__restore_credentials()
+		return self
+
+	@traced("run_container")
 	def run_container(self) -> "ContainedEnv":
 		container = None
 		try:
@@ -237,27 +866,48 @@ class ContainedEnv:
 		if container is None and self._engine.image is None:
 			raise docker.errors.ImageNotFound
 		
+		claimed = False
+		# A rebuild sets the container up again, pool members were set up earlier
+		if container is None and not self.args.rebuild:
+			# Hand out a ready container from the pool, if any
+			if self.args.pool > 0 and len(self.args.ports) == 0:
+				pool = self.pool()
+				pool.evict_stale()
+				with span("pool.claim"):
+					container = pool.claim(self.config.containername())
+				claimed = container is not None
+			elif self.args.pool > 0:
+				print("Pool containers have no port mappings, not using the pool.")
+
+		snapshot = None
 		if container is None:
-			# Find the image name tagged for this container
-			matches = [tag for tag in self.image.tags if tag == self.config.imagename()]
-			if len(matches) == 0:
-				raise docker.errors.ImageNotFound
-				
-			self._engine.container = self._dockerclient.containers.run(
-				image = matches[0],
-				#image = self._image.id,
-				command = "bash",
-				name = self.config.containername(),
-				hostname = self.config.appname(),
-				ports = {p.split(":")[0] : p.split(":")[1] for p in self.args.ports},
-				tty = True,
-				detach = True
+			# A snapshot of the same image and setup needs no setup
+			if self.args.snapshot and not self.args.rebuild:
+				snapshot = self.find_snapshot()
+			self._engine.container = self.__run(
+				self.config.containername(),
+				image = snapshot_tag(self.config.imagename()) if snapshot is not None else None
 			)
 		else:
 			self._engine.container = container
 
-		self.__setup_projects()
+		# A pool member was setup when it was created
+		applied = self.selected_step_keys()
+		if not claimed and snapshot is None:
+			applied = self.__setup_projects()
+			if self.args.snapshot:
+				self.snapshot()
+		elif snapshot is not None:
+			self.__restore_credentials()
+			print(f"Started from snapshot {snapshot_tag(self.config.imagename())}, setup skipped")
+		started = self._engine.container
+		self.__record(lambda state: state.add_container(
+			self.config.containername(), started.id,
+			snapshot_tag(self.config.imagename()) if snapshot is not None else self.config.imagename(),
+			started.labels, applied
+		))
 		
-		print(f"Enter this container with \"docker exec -it -u {self.config.user()} {self.config.containername()} bash\"")
+		host = f"-H {self._endpoint.docker_host()} " if self._endpoint is not None and self._endpoint.docker_host() is not None else ""
+		print(f"Enter this container with \"docker {host}exec -it -u {self.config.user()} {self.config.containername()} bash\"")
 		print(f"If an ssh server is running in the container, you may call \"ssh -i id_rsa -p <port> {self.config.user()}@localhost\"")
-		return self
\ No newline at end of file
+		return self
@@ -0,0 +1,167 @@
+import argparse
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+import docker
+from containedenv.engine import ContainedEnv
+from containedenv.config import Config
+from containedenv.trace import span
+from containedenv.endpoints import LOCAL_ENDPOINT, Scheduler
+from containedenv.tiers import Tier, tier_sequence, shared_prefixes, tier_chain, deepest_tier
+
+
+@dataclass
+class BuildSummary:
+	# Config file (or name) given on the command line
+	config:str
+	app:str = None
+	# built, reused or failed
+	status:str = "pending"
+	duration:float = 0.0
+	steps:int = 0
+	cached:int = 0
+	error:str = None
+	# Docker endpoint the image was built on
+	endpoint:str = None
+
+
+def _pull_bases(client:docker.DockerClient, envs:List[ContainedEnv]) -> None:
+	# Pull each base image once up front, so concurrent builds share its layers
+	# instead of each pulling it on their own
+	for base in sorted(set(env.config.base_image() for env in envs)):
+		try:
+			client.images.get(base)
+		except docker.errors.ImageNotFound:
+			print(f"Pulling base image {base}")
+			client.images.pull(base)
+
+def _plan_tiers(envs:List[ContainedEnv]) -> Dict[Tuple[str, ...], Tier]:
+	# Package prefixes shared by several apps, as tiers. Each app starts from the deepest tier it matches.
+	apps = [(env.config, tier_sequence(env.config, env.tier_packages())) for env in envs]
+	prefixes = shared_prefixes([seq for _, seq in apps])
+	if len(prefixes) == 0:
+		return {}
+	digests = {}
+	for env in envs:
+		if env.config.base_image() not in digests:
+			digests[env.config.base_image()] = env.base_digest()
+	tiers = tier_chain(prefixes, apps, digests)
+	for env, (_, seq) in zip(envs, apps):
+		env.use_tier(deepest_tier(tiers, seq))
+	return tiers
+
+def _tier_chain(tier:Tier) -> List[Tier]:
+	# The tier and the tiers it is built on, shallowest first
+	chain = []
+	while tier is not None:
+		chain.insert(0, tier)
+		tier = tier.parent
+	return chain
+
+def _build_tiers(builder:ContainedEnv, tiers:List[Tier], max_builds:int) -> None:
+	# Parents before children, tiers of the same depth concurrently
+	with ThreadPoolExecutor(max_workers = max(1, max_builds)) as pool:
+		for depth in sorted(set(len(t.packages) for t in tiers)):
+			level = [t for t in tiers if len(t.packages) == depth]
+			[f.result() for f in [pool.submit(builder.build_tier, tier) for tier in level]]
+
+def _build(env:ContainedEnv, summary:BuildSummary) -> BuildSummary:
+	start = time.perf_counter()
+	try:
+		env.build_image()
+		log = env.buildlog
+		summary.status = "reused" if log is None else "built"
+		if log is not None:
+			summary.steps = len(log.steps)
+			summary.cached = sum(s.cached for s in log.steps)
+	except Exception as e:
+		summary.status = "failed"
+		summary.error = str(e).splitlines()[0] if str(e) != "" else type(e).__name__
+	summary.duration = time.perf_counter() - start
+	return summary
+
+def build_many(
+		args:argparse.Namespace,
+		configs:List[str],
+		max_builds:int = 2,
+		scheduler:Scheduler = None
+	) -> List[BuildSummary]:
+	# Builds are spread over the endpoints of the scheduler (by default the daemon of the environment),
+	# at most max_builds at the same time on each
+	if scheduler is None:
+		scheduler = Scheduler.from_urls(getattr(args, "docker_hosts", None) or [LOCAL_ENDPOINT])
+	if len(scheduler.endpoints) > 1:
+		scheduler.probe()
+	summaries = [BuildSummary(config) for config in configs]
+	# Configs are loaded, and tiers planned, against the first endpoint
+	planner = scheduler.endpoints[0]
+	envs = {}
+	for summary in summaries:
+		try:
+			envargs = copy.copy(args)
+			envargs.config = summary.config
+			with span("config.load", path = summary.config):
+				envs[summary.config] = ContainedEnv(Config.from_args(envargs), endpoint = planner)
+			summary.app = envs[summary.config].config.appname()
+		except Exception as e:
+			summary.status = "failed"
+			summary.error = f"cannot load config: {e}"
+	if args.tiers:
+		_plan_tiers(list(envs.values()))
+
+	# Place every app up front, queued builds count in the load of their endpoint.
+	# An endpoint holding the tiers (or a previous image) of an app needs less work to build it.
+	placed:Dict[str, List[ContainedEnv]] = {}
+	for summary in summaries:
+		if summary.config not in envs:
+			continue
+		env = envs[summary.config]
+		cached = [t.tag() for t in _tier_chain(env.tier)] + [env.config.imagename()]
+		endpoint = scheduler.place(cached)
+		summary.endpoint = endpoint.url
+		envs[summary.config] = ContainedEnv(env.config, endpoint = endpoint).use_tier(env.tier)
+		placed.setdefault(endpoint.url, []).append(envs[summary.config])
+	endpoints = {e.url : e for e in scheduler.endpoints}
+
+	def prepare(url:str) -> None:
+		# Base images, then the tiers the apps placed on the endpoint start from
+		with span("images.pull_bases", endpoint = url):
+			_pull_bases(endpoints[url].client, placed[url])
+		tiers = {t.tag() : t for env in placed[url] for t in _tier_chain(env.tier)}
+		if len(tiers) > 0:
+			_build_tiers(placed[url][0], list(tiers.values()), max_builds)
+
+	slots = {url : threading.BoundedSemaphore(max(1, max_builds)) for url in placed}
+
+	def build(env:ContainedEnv, summary:BuildSummary) -> BuildSummary:
+		with slots[summary.endpoint]:
+			try:
+				return _build(env, summary)
+			finally:
+				scheduler.release(endpoints[summary.endpoint])
+
+	with ThreadPoolExecutor(max_workers = max(1, len(placed))) as pool:
+		[f.result() for f in [pool.submit(prepare, url) for url in placed]]
+	with ThreadPoolExecutor(max_workers = max(1, max_builds * len(placed))) as pool:
+		futures = [
+			pool.submit(build, envs[s.config], s) for s in summaries if s.config in envs
+		]
+		[f.result() for f in futures]
+	return summaries
+
+def summary_table(summaries:List[BuildSummary]) -> str:
+	# Endpoints are only worth a column when builds were spread over several
+	spread = len(set(s.endpoint for s in summaries if s.endpoint is not None)) > 1
+	rows = [("config", "app", "status", "duration", "cached") + (("endpoint",) if spread else ())]
+	for s in summaries:
+		rows.append((
+			s.config, s.app or "-", s.status, f"{s.duration:.2f}s",
+			f"{s.cached}/{s.steps}" if s.status == "built" else "-"
+		) + ((s.endpoint or "-",) if spread else ()))
+	widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+	lines = ["  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in rows]
+	lines += [f"{s.config}: {s.error}" for s in summaries if s.error is not None]
+	return "\n".join(lines)
@@ -0,0 +1,41 @@
+import json
+import shlex
+from typing import List, Set, Tuple
+from containedenv.batch import Step
+from containedenv.cache import sha256
+
+
+def step_keys(project:str, steps:List[Step]) -> List[str]:
+	# Content hash of each setup step. Keys are chained within a project,
+	# a changed step is applied again with every step after it.
+	keys, previous = [], ""
+	for step in steps:
+		content = {"project" : project, "name" : step.name, "cmds" : step.cmds, "cwd" : step.cwd, "previous" : previous}
+		previous = sha256(json.dumps(content, sort_keys = True).encode("utf-8"))
+		keys.append(previous)
+	return keys
+
+
+class SetupJournal(object):
+	def __init__(self, path:str) -> None:
+		# File in the container, one line per applied step: key, project and step name
+		self.path:str = path
+		# Keys of the applied steps
+		self.done:Set[str] = set()
+
+	def load(self, container, user:str = None) -> "SetupJournal":
+		# A container without journal (new, or older than journals) has every step to apply
+		code, output = container.exec_run(["cat", self.path], user = user or "")
+		self.done = set()
+		if code == 0:
+			lines = output.decode("utf-8", errors = "replace").splitlines()
+			self.done = set(line.split()[0] for line in lines if line.strip() != "")
+		return self
+
+	def pending(self, project:str, steps:List[Step]) -> List[Tuple[Step, str]]:
+		return [(step, key) for step, key in zip(steps, step_keys(project, steps)) if key not in self.done]
+
+	def record(self, key:str, project:str, name:str) -> str:
+		# Command appending a step to the journal, chained after the step so only successes are recorded
+		directory = self.path.rsplit("/", 1)[0]
+		return f"mkdir -p {directory} && echo {shlex.quote(f'{key} {project} {name}')} >> {self.path}"
@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import tempfile
+from typing import Dict, List, Tuple
+
+# Lockfile of a config: digest of its base image and exact versions of its apt packages.
+# Dockerfiles of a locked config start from the digest and install the pinned versions,
+# so identical configs give identical images (and content keys) on every build host.
+LOCK_VERSION = 1
+# Marks the start of each package in the output of the resolution script
+_MARKER = "@@containedenv"
+# Marks the simulated install of all the packages together
+_ALL = f"{_MARKER}-all"
+
+
+def lock_path(config_path:str) -> str:
+	# Next to the config: default.yml -> default.lock.json
+	return os.path.splitext(config_path)[0] + ".lock.json"
+
+
+class Lockfile(object):
+	def __init__(self, path:str) -> None:
+		self.path:str = path
+		# Base image name -> repository digest (e.g. ubuntu@sha256:...)
+		self.bases:Dict[str, str] = {}
+		# Base image name -> apt package -> versions of the packages installing it pulls in
+		self.apt:Dict[str, Dict[str, Dict[str, str]]] = {}
+
+	@staticmethod
+	def load(path:str) -> "Lockfile":
+		lock = Lockfile(path)
+		if not os.path.isfile(path):
+			return lock
+		with open(path, "r") as f:
+			content = json.load(f)
+		if content.get("version") != LOCK_VERSION:
+			raise ValueError(f"{path} was written by another version of containedenv, update it")
+		lock.bases = content.get("bases", {})
+		lock.apt = content.get("apt", {})
+		return lock
+
+	def save(self) -> None:
+		# Sorted and indented, diffs of a refreshed lockfile stay readable in review
+		content = {"version" : LOCK_VERSION, "bases" : self.bases, "apt" : self.apt}
+		fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)))
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(content, f, indent = 1, sort_keys = True)
+				f.write("\n")
+			os.replace(tmp, self.path)
+		except BaseException:
+			if os.path.exists(tmp): os.unlink(tmp)
+			raise
+
+	def locked(self, imgfrom:str) -> bool:
+		return imgfrom in self.bases
+
+	def base(self, imgfrom:str) -> str:
+		return self.bases.get(imgfrom, imgfrom)
+
+	def missing(self, imgfrom:str, packages:List[str]) -> List[str]:
+		known = self.apt.get(imgfrom, {})
+		return [p for p in packages if p not in known]
+
+	def versions(self, imgfrom:str) -> Dict[str, Dict[str, str]]:
+		return self.apt.get(imgfrom, {})
+
+	def conflicts(self, imgfrom:str) -> List[str]:
+		# Packages pinned to several versions, by packages resolved at different times
+		pins:Dict[str, set] = {}
+		for versions in self.versions(imgfrom).values():
+			for name, version in versions.items():
+				pins.setdefault(name, set()).add(version)
+		return sorted(name for name, versions in pins.items() if len(versions) > 1)
+
+
+def resolution_script(packages:List[str]) -> str:
+	# Simulated install of each package on the base image: the Inst line of every package it would install.
+	# Then one simulated install of all the installable ones, the versions they get installed together.
+	# The exit status of apt-get is checked apart, the filter of its output would hide it.
+	lines = ["apt-get update -qq > /dev/null", "ok=''"]
+	for package in packages:
+		lines.append(f"echo '{_MARKER} {package}'")
+		lines.append(f"apt-get install -s -y {package} 2> /dev/null | awk '/^Inst /'")
+		lines.append(f"if [ \"${{PIPESTATUS[0]}}\" -eq 0 ]; then ok=\"$ok {package}\"; else echo '{_MARKER}-failed'; fi")
+	lines.append(f"echo '{_ALL}'")
+	lines.append("[ -z \"$ok\" ] || apt-get install -s -y $ok 2> /dev/null | awk '/^Inst /'")
+	lines.append(f"[ \"${{PIPESTATUS[0]}}\" -eq 0 ] || echo '{_MARKER}-failed'")
+	return "\n".join(lines) + "\n"
+
+def parse_inst(line:str) -> Tuple[str, str]:
+	# 'Inst name (version archive [arch])', or 'Inst name [installed] (version archive [arch])'
+	# when a package of the base image is upgraded: the version is the first parenthesized one.
+	fields = line.split()
+	if len(fields) < 2 or fields[0] != "Inst":
+		return None
+	version = re.search(r"\(([^\s)]+)", line)
+	return (fields[1], version.group(1)) if version is not None else None
+
+def parse_resolution(output:str) -> Dict[str, Dict[str, str]]:
+	# Packages apt cannot install are left out. Each package keeps what it pulls in on its own,
+	# at the versions of the install of all of them: the pins of any subset agree with each other.
+	resolved, current, failed = {}, None, set()
+	together:Dict[str, str] = None
+	for line in output.splitlines():
+		if line.startswith(f"{_MARKER}-failed"):
+			failed.add(current)
+		elif line.startswith(_ALL):
+			current, together = _ALL, {}
+		elif line.startswith(_MARKER):
+			current = line[len(_MARKER):].strip()
+			resolved[current] = {}
+		elif current is not None:
+			inst = parse_inst(line)
+			if inst is not None:
+				(together if current == _ALL else resolved[current])[inst[0]] = inst[1]
+	resolved = {p : v for p, v in resolved.items() if p not in failed}
+	if _ALL in failed:
+		raise ValueError(f"apt packages {', '.join(sorted(resolved))} cannot be installed together")
+	if together is not None:
+		resolved = {p : {n : together.get(n, v) for n, v in versions.items()} for p, versions in resolved.items()}
+	return resolved
+
+def pinned(versions:Dict[str, Dict[str, str]], packages:List[str]) -> List[str]:
+	# 'name=version' of the packages and of what they pull in, unknown packages stay unpinned.
+	# A package already in the base image pulls nothing in and needs no install.
+	out, seen = [], {}
+	for package in packages:
+		entries = sorted(versions[package].items()) if package in versions else [(package, None)]
+		for name, version in entries:
+			if name in seen:
+				if seen[name] != version:
+					# apt cannot install both, lock_config resolves such lockfiles again
+					raise ValueError(f"{name} is locked to {seen[name]} and {version}, lock the config again")
+				continue
+			seen[name] = version
+			out.append(f"{name}={version}" if version is not None else name)
+	return out
+
+def resolve_base(client, imgfrom:str) -> str:
+	# Pull the current image of the name, and keep its repository digest
+	image = client.images.pull(imgfrom)
+	digests = image.attrs.get("RepoDigests") or []
+	repository = imgfrom.rsplit(":", 1)[0] if ":" in imgfrom.split("/")[-1] else imgfrom
+	matching = [d for d in digests if d.split("@")[0] == repository] or digests
+	if len(matching) == 0:
+		raise ValueError(f"{imgfrom} has no repository digest, it cannot be locked")
+	return matching[0]
+
+def resolve_apt(client, base:str, packages:List[str], environment:dict = None) -> Dict[str, Dict[str, str]]:
+	# One throwaway container of the base image simulates every install
+	output = client.containers.run(
+		base, ["bash", "-c", resolution_script(packages)],
+		environment = environment or None,
+		remove = True
+	)
+	return parse_resolution(output.decode("utf-8", errors = "replace"))
+
+def lock_config(config, client, update:bool = False, environment:dict = None) -> List[str]:
+	# Fill the lockfile of the config (resolve the base, and the packages when some are missing
+	# or pinned inconsistently), or resolve everything again when updating. Returns what changed.
+	# Packages are always resolved all together, pins resolved at different times may not
+	# be installable together.
+	from containedenv.tiers import BASE_TOOLING
+	lock, imgfrom = config.lockfile(), config.app.imgfrom
+	changes = []
+	previous = lock.bases.get(imgfrom)
+	if update or previous is None:
+		lock.bases[imgfrom] = resolve_base(client, imgfrom)
+		if lock.bases[imgfrom] != previous:
+			changes.append(f"{imgfrom}: {previous or 'unlocked'} -> {lock.bases[imgfrom]}")
+			# Versions resolved on another base are not worth keeping
+			lock.apt.pop(imgfrom, None)
+
+	packages = sorted(set(BASE_TOOLING + [a for p in config.packages for a in p.apt_packages]))
+	stale = update or len(lock.missing(imgfrom, packages)) > 0 or len(lock.conflicts(imgfrom)) > 0
+	todo = packages if stale else []
+	known = lock.apt.setdefault(imgfrom, {})
+	before = {p : known.get(p) for p in todo}
+	if len(todo) > 0:
+		resolved = resolve_apt(client, lock.bases[imgfrom], todo, environment)
+		for package in todo:
+			if package not in resolved:
+				print(f"apt package {package} cannot be installed on {imgfrom}, left unpinned")
+				known.pop(package, None)
+				continue
+			known[package] = resolved[package]
+			if before[package] != resolved[package]:
+				version = resolved[package].get(package, "in base image")
+				changes.append(f"{package}: {'updated' if before[package] is not None else 'locked'} ({version})")
+	# Packages no longer in the config
+	for package in [p for p in known if p not in packages]:
+		known.pop(package)
+		changes.append(f"{package}: removed")
+	lock.save()
+	return changes
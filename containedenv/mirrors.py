@@ -0,0 +1,81 @@
+import hashlib
+import os
+import subprocess
+import threading
+from typing import Dict
+
+# Where the host mirrors are mounted (read only) in containers, for the lifetime of the container
+MIRROR_MOUNT = "/var/cache/containedenv/mirrors"
+
+
+def default_mirror_dir() -> str:
+	return os.path.join(os.path.expanduser("~"), ".cache", "containedenv", "mirrors")
+
+
+class MirrorCache(object):
+	def __init__(self, root:str) -> None:
+		# Host directory holding one bare mirror per repository url
+		self.root:str = os.path.abspath(root)
+		# One lock per mirror, projects may share repositories
+		self.__locks:Dict[str, threading.Lock] = {}
+		self.__guard = threading.Lock()
+		os.makedirs(self.root, exist_ok = True)
+
+	def name(self, repourl:str) -> str:
+		# Readable and unique directory name for the url
+		base = repourl.rstrip("/").split("/")[-1]
+		base = base if base.endswith(".git") else f"{base}.git"
+		return f"{hashlib.sha256(repourl.encode('utf-8')).hexdigest()[:16]}-{base}"
+
+	def path(self, repourl:str) -> str:
+		return os.path.join(self.root, self.name(repourl))
+
+	def container_path(self, repourl:str) -> str:
+		return f"{MIRROR_MOUNT}/{self.name(repourl)}"
+
+	def volumes(self) -> dict:
+		# Volume specification for containers.run
+		return {self.root : {"bind" : MIRROR_MOUNT, "mode" : "ro"}}
+
+	def __lock(self, repourl:str) -> threading.Lock:
+		with self.__guard:
+			return self.__locks.setdefault(repourl, threading.Lock())
+
+	def update(self, repourl:str) -> str:
+		# Create the mirror on first use, then only fetch what changed
+		path = self.path(repourl)
+		with self.__lock(repourl):
+			if os.path.isdir(path):
+				cmd = ["git", "--git-dir", path, "remote", "update", "--prune"]
+			else:
+				# Clones borrow objects of the mirror, which must never drop them
+				cmd = ["git", "clone", "--mirror", "--quiet", "--config", "gc.pruneExpire=never", repourl, path]
+			result = subprocess.run(cmd, capture_output = True, text = True)
+			if result.returncode != 0:
+				raise RuntimeError(f"Cannot update mirror of {repourl}: {result.stderr.strip()}")
+		return path
+
+
+def clone_command(
+		repourl:str,
+		repo_workspace:str,
+		reference:str = None,
+		depth:int = None,
+		filter:str = None
+	) -> str:
+	# git clone, borrowing the objects of a mirror when one is available: they stay in the mirror,
+	# mounted in the container for as long as it exists (see detach_command)
+	options = []
+	if reference is not None:
+		options.append(f"--reference-if-able {reference}")
+	if depth is not None:
+		options.append(f"--depth {depth}")
+	if filter is not None:
+		options.append(f"--filter={filter}")
+	return " ".join(["git clone"] + options + [repourl, repo_workspace])
+
+def detach_command(repo_workspace:str) -> str:
+	# Copy the objects a clone borrows from its mirror into the clone, for when the mount goes
+	# away (a committed snapshot runs without it)
+	alternates = f"{repo_workspace}/.git/objects/info/alternates"
+	return f"if test -f {alternates}; then git -C {repo_workspace} repack -a -d -q && rm -f {alternates}; fi"
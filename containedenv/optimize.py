@@ -0,0 +1,205 @@
+import re
+from dataclasses import dataclass
+from typing import List, Tuple
+from containedenv.buildlog import OWNER_MARKER
+from containedenv.context import logical_lines
+
+_VARIABLE = re.compile(r"\$\{?(\w+)")
+_ENV_PAIR = re.compile(r"(\w+)=")
+_PIP_INSTALL = re.compile(r"\b(pip3?(\.\d+)? install)\b")
+
+
+@dataclass
+class Finding:
+	# Instruction (first line) the finding is about, and who emitted it
+	instruction:str
+	owner:str
+	rule:str
+	message:str
+
+
+@dataclass
+class _Instruction:
+	owner:str
+	# Physical lines, as written
+	lines:List[str]
+	# Comments written right before the instruction
+	comments:List[str]
+
+	@property
+	def text(self) -> str:
+		return logical_lines("\n".join(self.lines))[0]
+
+	@property
+	def keyword(self) -> str:
+		return self.text.split(None, 1)[0].upper()
+
+	@property
+	def args(self) -> str:
+		parts = self.text.split(None, 1)
+		return parts[1] if len(parts) > 1 else ""
+
+
+def _parse(dockerfile:str) -> List[object]:
+	# Owner markers and blank lines (str) and instructions, in order
+	items, owner, comments, current = [], "base", [], None
+	for line in dockerfile.splitlines():
+		stripped = line.strip()
+		if current is not None:
+			current.lines.append(line)
+			# Comments do not end a continued instruction
+			if not stripped.startswith("#") and not stripped.endswith("\\") and stripped != "":
+				current = None
+			continue
+		if stripped.startswith(OWNER_MARKER):
+			owner = stripped[len(OWNER_MARKER):].strip()
+			items += comments + [line]
+			comments = []
+		elif stripped.startswith("#") or stripped == "":
+			comments.append(line)
+		else:
+			current = _Instruction(owner, [line], comments)
+			comments = []
+			items.append(current)
+			if not stripped.endswith("\\"):
+				current = None
+	return items + comments
+
+def _run_flags(args:str) -> Tuple[str, str]:
+	# Leading --mount/--network flags of a RUN, and its command
+	flags = []
+	while args.startswith("--"):
+		flag, _, args = args.partition(" ")
+		flags.append(flag)
+		args = args.lstrip()
+	return " ".join(flags), args
+
+def _exec_form(args:str) -> bool:
+	return args.lstrip().startswith("[")
+
+def _env_pairs(args:str) -> List[str]:
+	# key=value assignments of an ENV, None when it cannot be rewritten safely
+	if "=" in args.split(None, 1)[0]:
+		return [args]
+	parts = args.split(None, 1)
+	value = parts[1] if len(parts) > 1 else ""
+	if any(c in value for c in "\"'\\"):
+		return None
+	return [f"{parts[0]}=\"{value}\""]
+
+def _env_keys(args:str) -> List[str]:
+	return [args.split(None, 1)[0]] if "=" not in args.split(None, 1)[0] else _ENV_PAIR.findall(args)
+
+
+def _cleanup(flags:str, command:str, user:str = "root") -> str:
+	# Drop package manager caches in the layer that filled them, unless they live in a cache mount.
+	# pip keeps no cache at all: its cache is in the home of whichever user runs it, and the
+	# cache mount only covers root's.
+	if "apt-get update" in command and "apt-get install" in command \
+			and "/var/lib/apt/lists" not in command and "target=/var/lib/apt" not in flags:
+		command += " && rm -rf /var/lib/apt/lists/*"
+	mounted = "target=/root/.cache/pip" in flags and user in ("root", "0")
+	if "--no-cache-dir" not in command and not mounted:
+		command = _PIP_INSTALL.sub(r"\1 --no-cache-dir", command)
+	return command
+
+def _render_run(flags:str, commands:List[str]) -> List[str]:
+	# Each command in its own subshell, so 'cd', 'set' or a trailing ';' keep their meaning
+	prefix = f"RUN {flags} " if flags != "" else "RUN "
+	if len(commands) == 1:
+		return [prefix + commands[0]]
+	lines = [f"{prefix}( {commands[0]} ) && \\"]
+	lines += [f"\t( {c} ) && \\" for c in commands[1:-1]]
+	lines.append(f"\t( {commands[-1]} )")
+	return lines
+
+def _render_env(pairs:List[str]) -> List[str]:
+	if len(pairs) == 1:
+		return [f"ENV {pairs[0]}"]
+	return [f"ENV {pairs[0]} \\"] + [f"\t{p} \\" for p in pairs[1:-1]] + [f"\t{pairs[-1]}"]
+
+
+def findings(dockerfile:str) -> List[Finding]:
+	# Constructs that defeat the layer cache, or leave it stale
+	found, args = [], set()
+	for item in _parse(dockerfile):
+		if not isinstance(item, _Instruction):
+			continue
+		keyword, text, rest = item.keyword, item.text, item.args
+		first = item.lines[0].strip()
+		if keyword == "FROM":
+			args = set()
+		elif keyword == "ARG":
+			args.add(rest.split("=", 1)[0].strip())
+		elif keyword == "ADD" and re.search(r"\bhttps?://", rest):
+			found.append(Finding(first, item.owner, "remote-add",
+				"ADD of a url is checked again on every build, download it in a RUN instead"))
+		if keyword in ("ADD", "COPY") and any(s in (".", "./") for s in rest.split()[:-1] if not s.startswith("--")):
+			found.append(Finding(first, item.owner, "context-copy",
+				"copying the whole context invalidates this and every later layer on any change"))
+		if keyword == "RUN":
+			used = set(_VARIABLE.findall(text)) & args
+			if len(used) > 0:
+				found.append(Finding(first, item.owner, "build-arg",
+					f"build argument(s) {', '.join(sorted(used))} change the cache key of this and every later layer"))
+			_, command = _run_flags(rest)
+			if "apt-get update" in command and "apt-get install" not in command and "upgrade" not in command:
+				found.append(Finding(first, item.owner, "stale-update",
+					"apt-get update alone in a layer is cached, later installs then use stale package lists"))
+	return found
+
+def optimize(dockerfile:str) -> str:
+	# Merge adjacent RUN (same flags) and ENV instructions of the same owner,
+	# and drop package caches in the RUN that filled them
+	out:List[str] = []
+	group:List[_Instruction] = []
+	# User the RUN instructions run as
+	user = "root"
+
+	def flush():
+		if len(group) == 0:
+			return
+		[out.extend(i.comments) for i in group]
+		if group[0].keyword == "RUN":
+			flags = _run_flags(group[0].args)[0]
+			commands = [_cleanup(flags, _run_flags(i.args)[1], user) for i in group]
+			if len(group) == 1 and commands[0] == _run_flags(group[0].args)[1]:
+				out.extend(group[0].lines)
+			else:
+				out.extend(_render_run(flags, commands))
+		elif len(group) > 1:
+			out.extend(_render_env([p for i in group for p in _env_pairs(i.args)]))
+		else:
+			out.extend(group[0].lines)
+		group.clear()
+
+	def mergeable(item:_Instruction) -> bool:
+		if len(group) == 0 or item.owner != group[0].owner or item.keyword != group[0].keyword:
+			return False
+		if item.keyword == "RUN":
+			return not _exec_form(_run_flags(item.args)[1]) and _run_flags(item.args)[0] == _run_flags(group[0].args)[0]
+		# An ENV refering to a variable set earlier in the same ENV would see its previous value
+		defined = set(k for i in group for k in _env_keys(i.args))
+		return _env_pairs(item.args) is not None and len(set(_VARIABLE.findall(item.args)) & defined) == 0
+
+	for item in _parse(dockerfile):
+		if not isinstance(item, _Instruction):
+			flush()
+			out.append(item)
+			continue
+		if mergeable(item):
+			group.append(item)
+			continue
+		flush()
+		if item.keyword == "FROM":
+			user = "root"
+		elif item.keyword == "USER":
+			user = item.args.split(":")[0].strip()
+		if item.keyword == "RUN" and not _exec_form(_run_flags(item.args)[1]):
+			group.append(item)
+		elif item.keyword == "ENV" and _env_pairs(item.args) is not None:
+			group.append(item)
+		else:
+			out.extend(item.comments + item.lines)
+	flush()
+	return "\n".join(out) + "\n"
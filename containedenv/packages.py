@@ -1,49 +1,275 @@
+import heapq
+import os
 import re
-from pyrc.system import LocalFileSystem
+from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
 from containedenv.config import config_dir, Config, Project, Package
-from containedenv.dockerfile import DockerFile
+from containedenv.context import logical_lines
+from containedenv.trace import span, traced
+
+
+class DependencyError(ValueError):
+	def __init__(self, cycle:List[str]) -> None:
+		self.cycle = cycle
+		super().__init__(f"Cyclic package requirements: {' -> '.join(cycle)}")
+
+
+# Dockerfile lines installing system packages. Their files and dpkg state would stay in a package stage.
+_SYSTEM_INSTALL = re.compile(r"\b(apt-get|apt|aptitude)\b[^;&|]*\binstall\b|\bdpkg\b[^;&|]*\s(-i|--install)\b")
+
+
+def _owner_comment(kind:str, name:str) -> str:
+	# Compiled configs hold a PackageGraph, buildlog is only imported once a dockerfile is written
+	from containedenv.buildlog import owner_comment
+	return owner_comment(kind, name)
+
+
+class PackageGraph(object):
+	def __init__(self, packages:List[Package]) -> None:
+		# Packages indexed by name
+		self.packages:Dict[str, Package] = {p.name : p for p in packages}
+		# Unknown requirement names, by package or project requiring them
+		self.unknown:Dict[str, List[str]] = {}
+		# Resolved requirements of each package, in declaration order
+		self.edges:Dict[str, List[str]] = {
+			p.name : self.__names(p.name, p.requires) for p in packages
+		}
+		# Memoized closures, by owner and requirement list
+		self.__closures:Dict[Tuple[str, Tuple[str, ...]], List[str]] = {}
+		self.__check_cycles()
+
+	def name(self, requirement:str) -> str:
+		# '$pkg' and 'pkg' both name a package, None if there is no such package
+		name = requirement[1:] if requirement.startswith('$') else requirement
+		return name if name in self.packages else None
+
+	def __names(self, owner:str, requires:List[str]) -> List[str]:
+		names = []
+		for requirement in requires:
+			name = self.name(requirement)
+			if name is None:
+				self.unknown.setdefault(owner, []).append(requirement)
+			elif name not in names:
+				names.append(name)
+		return names
+
+	def __check_cycles(self) -> None:
+		# Iterative depth first search, graphs may be deep
+		state = {}
+		for root in self.edges:
+			if root in state: continue
+			stack = [(root, iter(self.edges[root]))]
+			state[root] = "visiting"
+			while len(stack) > 0:
+				node, children = stack[-1]
+				child = next(children, None)
+				if child is None:
+					state[node] = "done"
+					stack.pop()
+				elif state.get(child) == "visiting":
+					path = [n for n, _ in stack]
+					raise DependencyError(path[path.index(child):] + [child])
+				elif child not in state:
+					state[child] = "visiting"
+					stack.append((child, iter(self.edges[child])))
+
+	def closure(self, requires:List[str], owner:str = None) -> List[str]:
+		# Transitive requirements in topological order (requirements first),
+		# following declaration order so the result is the same on every run
+		key = (owner, tuple(requires))
+		if key not in self.__closures:
+			roots = self.__names(owner, requires) if owner is not None else [
+				n for n in (self.name(r) for r in requires) if n is not None
+			]
+			order, visited = [], set()
+			for root in roots:
+				if root in visited: continue
+				visited.add(root)
+				stack = [(root, iter(self.edges[root]))]
+				while len(stack) > 0:
+					node, children = stack[-1]
+					child = next(children, None)
+					if child is None:
+						order.append(node)
+						stack.pop()
+					elif child not in visited:
+						visited.add(child)
+						stack.append((child, iter(self.edges[child])))
+			self.__closures[key] = order
+		return self.__closures[key]
+
+	def sorted_closure(self, requires:List[str]) -> List[str]:
+		# Transitive requirements in a canonical topological order: among the packages
+		# whose requirements are met, the smallest name comes first. It does not depend
+		# on declaration order, so two configs needing the same packages agree on it.
+		names = set(self.closure(requires))
+		pending = {n : len([m for m in self.edges[n] if m in names]) for n in names}
+		dependents:Dict[str, List[str]] = {}
+		[dependents.setdefault(m, []).append(n) for n in names for m in self.edges[n]]
+		ready = [n for n, count in pending.items() if count == 0]
+		heapq.heapify(ready)
+		order = []
+		while len(ready) > 0:
+			name = heapq.heappop(ready)
+			order.append(name)
+			for dependent in dependents.get(name, []):
+				pending[dependent] -= 1
+				if pending[dependent] == 0:
+					heapq.heappush(ready, dependent)
+		return order
+
+	def project_closure(self, project:Project) -> List[str]:
+		return self.closure(project.requires, owner = project.name)
+
+	def subtrees(self, names:List[str]) -> List[List[str]]:
+		# Split names into groups sharing no requirement, each group keeps the order of names
+		parent = {n : n for n in names}
+		def find(n):
+			while parent[n] != n:
+				parent[n] = parent[parent[n]]
+				n = parent[n]
+			return n
+		for n in names:
+			for m in self.edges[n]:
+				if m in parent:
+					parent[find(m)] = find(n)
+		groups:Dict[str, List[str]] = {}
+		[groups.setdefault(find(n), []).append(n) for n in names]
+		return list(groups.values())
+
+
+@dataclass
+class LayerPlan:
+	# Deduplicated and sorted apt packages, installed in a single stable layer
+	apt_packages:List[str] = field(default_factory=list)
+	# Packages in install order, their dockerfiles and image lines are volatile layers
+	packages:List[Package] = field(default_factory=list)
+	# Independent groups of packages built in their own stage (multistage mode)
+	stages:List[List[Package]] = field(default_factory=list)
 
 
 class PackageManager2(object):
-	def __init__(self, config:Config, dockerfile:DockerFile) -> None:
+	def __init__(self, config:Config, dockerfile:'DockerFile') -> None:
+		# Requirement graph of the packages, resolved once
+		self.graph:PackageGraph = config.graph()
 		# Packages dictionnary for easier handling
-		self.packages:dict = {
-			p.name : p for p in config.packages
-		}
+		self.packages:dict = self.graph.packages
 		# Dockerfile
-		self.dockerfile:DockerFile = dockerfile
+		self.dockerfile:'DockerFile' = dockerfile
 		# Installed packages (names)
 		self.installed:set = set()
-		# Local filesystem
-		self.local = LocalFileSystem()
+		# Dockerfile fragments appended to the dockerfile (name -> path)
+		self.fragments:dict = {}
 
 	def install_package(self, pkg:str) -> None:
-		# Ignore pkg if its not prefixed by '$' (containedenv syntax)
-		if pkg[0] != '$': return
-		pkg = pkg[1:]
-
-		# Skip if package is note found in packages list
-		if not pkg in self.packages: return
-		# Skip if package is already installed
-		if pkg in self.installed: return
-
-		_pkg:Package = self.packages[pkg]
-
-		# Step zero, install package dependencies
-		[self.install_package(p) for p in _pkg.requires]
-
-		# Step one, install apt packages in any
-		self.dockerfile.install(_pkg.apt_packages)
-		# Step two, append a given docker file if any
-		if _pkg.dockerfile is not None:
-			self.dockerfile.append_dockerfile(self.local.join(config_dir(), _pkg.dockerfile))
-		# Step three, executing given custom dockerfile commands
-		self.dockerfile.writelines(_pkg.image)
-		# Step four, mark package as already installed
-		self.installed.add(pkg)
+		for name in self.graph.closure([pkg]):
+			# Skip if package is already installed
+			if name in self.installed: continue
+			_pkg:Package = self.packages[name]
+
+			# Step one, install apt packages in any
+			self.dockerfile.install(_pkg.apt_packages)
+			# Step two, append a given docker file if any
+			if _pkg.dockerfile is not None:
+				self.fragments[_pkg.dockerfile] = os.path.join(config_dir(), _pkg.dockerfile)
+				self.dockerfile.append_dockerfile(self.fragments[_pkg.dockerfile])
+			# Step three, executing given custom dockerfile commands
+			self.dockerfile.writelines(_pkg.image)
+			# Step four, mark package as already installed
+			self.installed.add(name)
 
 	def install_project_packages(self, project:Project) -> None:
-		[self.install_package(pkg) for pkg in project.requires]
+		[self.install_package(pkg) for pkg in self.graph.project_closure(project)]
+
+	@traced("packages.plan")
+	def plan(self, projects:List[Project], base:List[str] = [], multistage:bool = False) -> LayerPlan:
+		# Order layers from the most stable to the most volatile
+		# so that changing a project does not invalidate the apt layer
+		plan = LayerPlan()
+		for project in projects:
+			for name in self.graph.project_closure(project):
+				if name in self.installed: continue
+				plan.packages.append(self.packages[name])
+				self.installed.add(name)
+
+		# Apt packages of staged packages too: the shared apt layer is in the base stage,
+		# which package stages and the final stage both start from
+		apt_packages = set(base)
+		[apt_packages.update(p.apt_packages) for p in plan.packages]
+		plan.apt_packages = sorted(apt_packages)
+
+		if multistage:
+			# A group of packages gets its own stage when every package in it declares its outputs,
+			# so they can be copied into the final image, and installs no system package itself
+			names = [p.name for p in plan.packages]
+			for group in self.graph.subtrees(names):
+				if all(len(self.packages[n].outputs) > 0 and not self.installs_system_packages(n) for n in group):
+					plan.stages.append([self.packages[n] for n in group])
+			staged = set(p.name for group in plan.stages for p in group)
+			plan.packages = [p for p in plan.packages if p.name not in staged]
+		return plan
+
+	def installs_system_packages(self, name:str) -> bool:
+		# Whether the dockerfile or image lines of a package install apt packages. Only its outputs
+		# reach the final image from a stage, these would be lost (declare them in apt_packages).
+		_pkg:Package = self.packages[name]
+		lines = list(_pkg.image)
+		if _pkg.dockerfile is not None:
+			with open(os.path.join(config_dir(), _pkg.dockerfile), "r") as f:
+				lines = f.read().splitlines() + lines
+		return any(_SYSTEM_INSTALL.search(l) is not None for l in logical_lines("\n".join(lines)))
+
+	def install_plan(self, plan:LayerPlan) -> None:
+		# Apt packages are expected to be installed already (see LayerPlan.apt_packages)
+		for _pkg in plan.packages:
+			with span("packages.install", package = _pkg.name, fragment = _pkg.dockerfile):
+				self.dockerfile.writeline(_owner_comment("package", _pkg.name))
+				if _pkg.dockerfile is not None:
+					self.fragments[_pkg.dockerfile] = os.path.join(config_dir(), _pkg.dockerfile)
+					self.dockerfile.append_dockerfile(self.fragments[_pkg.dockerfile])
+				self.dockerfile.writelines(_pkg.image)
+				self.__write_checks(_pkg)
+
+	def __write_checks(self, _pkg:Package) -> None:
+		if len(_pkg.checks) > 0:
+			self.dockerfile.RUN(list(_pkg.checks))
+
+	def __stage_name(self, group:List[Package]) -> str:
+		return "pkg-" + re.sub(r"[^a-z0-9_.-]", "-", group[-1].name.lower())
+
+	@traced("packages.stages")
+	def install_stages(self, plan:LayerPlan, base:str) -> None:
+		# One stage per independent group, all starting from the 'base' stage
+		for group in plan.stages:
+			self.dockerfile.stage(base, self.__stage_name(group))
+			for _pkg in group:
+				self.dockerfile.writeline(_owner_comment("package", _pkg.name))
+				if _pkg.dockerfile is not None:
+					self.fragments[_pkg.dockerfile] = os.path.join(config_dir(), _pkg.dockerfile)
+					self.dockerfile.append_dockerfile(self.fragments[_pkg.dockerfile])
+				self.dockerfile.writelines(_pkg.image)
+
+	@traced("packages.copy_stages")
+	def copy_stages(self, plan:LayerPlan) -> None:
+		# Bring the outputs of each stage in the current (final) stage,
+		# with the environment variables the packages defined
+		for group in plan.stages:
+			stage = self.__stage_name(group)
+			for _pkg in group:
+				self.dockerfile.writeline(_owner_comment("package", _pkg.name))
+				[self.dockerfile.writeline(f"COPY --from={stage} {o} {o}") for o in _pkg.outputs]
+				lines = list(_pkg.image)
+				if _pkg.dockerfile is not None:
+					with open(self.fragments[_pkg.dockerfile], "r") as f:
+						lines = f.read().splitlines() + lines
+				[self.dockerfile.writeline(l) for l in logical_lines("\n".join(lines)) if l.upper().startswith("ENV ")]
+		if len(plan.stages) > 0:
+			# Copied shared libraries must be known to the dynamic linker
+			self.dockerfile.RUN("ldconfig")
+		# Staged packages are checked in the final image, where only their outputs are
+		for _pkg in [p for group in plan.stages for p in group if len(p.checks) > 0]:
+			self.dockerfile.writeline(_owner_comment("package", _pkg.name))
+			self.__write_checks(_pkg)
 
 
 
@@ -75,7 +301,7 @@ class PackageManager(object):
 		dockerfile.RUN(pip_lines)
 
 	def __install_julia(self, dockerfile):
-		juliafile = LocalFileSystem().join(config_dir(), "julia.dockerfile")
+		juliafile = os.path.join(config_dir(), "julia.dockerfile")
 		dockerfile.append_dockerfile(juliafile)
 		dockerfile.exec_command(f"# installing julia")
 		dockerfile.RUN(f"sudo bash -ci \"$(curl -fsSL https://raw.githubusercontent.com/abelsiqueira/jill/main/jill.sh)\" --yes --no-confirm")
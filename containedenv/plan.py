@@ -0,0 +1,167 @@
+import argparse
+import copy
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+from containedenv.buildlog import step_owners
+from containedenv.cache import CONTENT_KEY_LABEL, sha256
+from containedenv.config import config_dir
+from containedenv.context import context_files, logical_lines
+from containedenv.journal import step_keys
+from containedenv.snapshot import SNAPSHOT_KEY_LABEL, snapshot_tag
+from containedenv.state import OfflineClient, State, state_path
+
+# What a run would do, computed from the config and a state (see state.py): which image layers
+# would be built again and which setup steps would run, without building or running anything.
+
+
+@dataclass
+class ImagePlan:
+	tag:str
+	# keep, build (no image yet) or rebuild
+	action:str
+	reasons:List[str] = field(default_factory = list)
+	# (owner, instruction) of the steps built again, out of total
+	layers:List[Tuple[str, str]] = field(default_factory = list)
+	total:int = 0
+
+
+@dataclass
+class SetupPlan:
+	container:str
+	# keep (apply the missing steps), create, recreate or snapshot (start from it, no setup)
+	action:str
+	# Names of the steps to run, per project
+	steps:Dict[str, List[str]] = field(default_factory = dict)
+	# The container exists but its applied steps were never recorded, the journal in it decides
+	unknown:bool = False
+
+
+@dataclass
+class AppPlan:
+	app:str
+	image:ImagePlan
+	setup:SetupPlan
+	dockerfile:str = None
+	# Setup scripts of the selected projects, commands of silent steps left out
+	scripts:List[str] = field(default_factory = list)
+
+
+def _instructions(dockerfile:str) -> List[Tuple[str, str]]:
+	return [(owner, instruction) for instruction, owner in zip(logical_lines(dockerfile), step_owners(dockerfile))]
+
+def _first_change(previous:dict, dockerfile:str, inputs:dict) -> Tuple[int, List[str]]:
+	# Index of the first step the builder cannot take from its cache, and why
+	new = _instructions(dockerfile)
+	if previous is None:
+		return 0, ["content key changed, no recorded build to compare with"]
+	if previous["base"] != inputs["base_digest"]:
+		return 0, ["base image (or tier) changed"]
+	reasons, first = [], len(new)
+	old = _instructions(previous["dockerfile"])
+	changed = next((i for i, (a, b) in enumerate(zip(old, new)) if a[1] != b[1]), min(len(old), len(new)))
+	if changed < len(new) or len(old) != len(new):
+		first = changed
+		reasons.append(f"dockerfile changed from step {changed + 1}")
+	files = {name : sha256(data) for name, data in inputs["fragments"].items()}
+	copied = context_files(dockerfile, config_dir())
+	for name in sorted(set(files) | set(previous["files"])):
+		if files.get(name) == previous["files"].get(name):
+			continue
+		reasons.append(f"file {name} changed")
+		if name not in copied:
+			continue
+		# Steps copying the file get a new cache key
+		using = [i for i, (_, instruction) in enumerate(new) if instruction.split()[0].upper() in ("COPY", "ADD") and name in instruction.split()]
+		first = min([first] + using)
+	if len(reasons) == 0:
+		reasons.append("content key changed, every step is in the builder cache")
+	return first, reasons
+
+def plan_image(env, state:State, dockerfile:str, inputs:dict, key:str) -> ImagePlan:
+	tag = env.config.imagename()
+	existing = state.image(tag)
+	total = len(_instructions(dockerfile))
+	if existing is None:
+		return ImagePlan(tag, "build", ["no image"], _instructions(dockerfile), total)
+	if env.args.rebuild:
+		return ImagePlan(tag, "rebuild", ["--rebuild"], _instructions(dockerfile), total)
+	if existing["labels"].get(CONTENT_KEY_LABEL) == key:
+		return ImagePlan(tag, "keep", [], [], total)
+	first, reasons = _first_change(state.builds.get(tag), dockerfile, inputs)
+	return ImagePlan(tag, "rebuild", reasons, _instructions(dockerfile)[first:], total)
+
+def plan_setup(env, state:State, image:ImagePlan, key:str) -> SetupPlan:
+	name = env.config.containername()
+	container = state.containers.get(name)
+	selected = [p for p in env.config.projects if p.name in env.args.projects]
+	scripts = {p.name : env.project_steps(p).steps for p in selected}
+
+	if container is not None and image.action == "keep" and not env.args.rebuild:
+		if container.get("steps") is None:
+			return SetupPlan(name, "keep", unknown = True)
+		done = set(container["steps"])
+		return SetupPlan(name, "keep", {
+			project : [s.name for s, k in zip(steps, step_keys(project, steps)) if k not in done]
+			for project, steps in scripts.items()
+		})
+
+	action = "create" if container is None else "recreate"
+	if env.args.snapshot and not env.args.rebuild:
+		snapshot = state.image(snapshot_tag(env.config.imagename()))
+		if snapshot is not None and snapshot["labels"].get(SNAPSHOT_KEY_LABEL) == env.snapshot_key(key):
+			return SetupPlan(name, "snapshot")
+	return SetupPlan(name, action, {project : [s.name for s in steps] for project, steps in scripts.items()})
+
+def plan_app(env, state:State) -> AppPlan:
+	# env: a ContainedEnv on an OfflineClient of the same state
+	dockerfile, inputs, key = env.image_plan()
+	image = plan_image(env, state, dockerfile, inputs, key)
+	scripts = []
+	for project in [p for p in env.config.projects if p.name in env.args.projects]:
+		scripts.append(f"# {project.name}")
+		for step in env.project_steps(project).steps:
+			command = " && ".join(step.cmds) if not step.silent else "(hidden)"
+			scripts.append(f"{step.name}: {'cd ' + step.cwd + ' && ' if step.cwd else ''}{command}")
+	return AppPlan(env.config.appname(), image, plan_setup(env, state, image, key), dockerfile, scripts)
+
+def plan_configs(args:argparse.Namespace, configs:List[str], daemon:State = None) -> List[AppPlan]:
+	# Plans of the given configs against their state files, or against a listing of the daemon
+	# completed with what the state files recorded
+	from containedenv.config import Config
+	from containedenv.engine import ContainedEnv
+	plans = []
+	for path in configs:
+		envargs = copy.copy(args)
+		envargs.config = path
+		config = Config.from_args(envargs)
+		recorded = State.load(state_path(config.appname()))
+		state = copy.deepcopy(daemon).merge(recorded) if daemon is not None else recorded
+		plans.append(plan_app(ContainedEnv(config, dockerclient = OfflineClient(state)), state))
+	return plans
+
+def plan_text(plans:List[AppPlan], verbose:bool = False) -> str:
+	lines = []
+	for plan in plans:
+		image = plan.image
+		reasons = f" ({'; '.join(image.reasons)})" if len(image.reasons) > 0 else ""
+		lines.append(f"{plan.app}: image {image.tag}: {image.action}{reasons}")
+		if image.action != "keep":
+			lines.append(f"  {len(image.layers)}/{image.total} step(s) built again")
+			width = max([len(owner) for owner, _ in image.layers] + [0])
+			for owner, instruction in image.layers:
+				text = instruction if len(instruction) <= 72 else instruction[:69] + "..."
+				lines.append(f"    {owner.ljust(width)}  {text}")
+		setup = plan.setup
+		count = sum(len(s) for s in setup.steps.values())
+		if setup.action == "snapshot":
+			lines.append(f"  container {setup.container}: start from snapshot, no setup")
+		elif setup.unknown:
+			lines.append(f"  container {setup.container}: keep, applied setup steps not recorded (journal in the container decides)")
+		else:
+			lines.append(f"  container {setup.container}: {setup.action}, {count} setup step(s) to run")
+			for project, steps in setup.steps.items():
+				if len(steps) > 0:
+					lines.append(f"    {project}: {', '.join(steps)}")
+		if verbose:
+			lines += ["", plan.dockerfile or ""] + plan.scripts + [""]
+	return "\n".join(lines)
@@ -0,0 +1,110 @@
+import contextlib
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import uuid
+from typing import Dict, List
+import docker
+from containedenv.cache import sha256
+from containedenv.config import GithubProfile, Project
+from containedenv.state import state_dir
+
+# Labels of pool containers: owning app and key of the image and setup they were made from
+POOL_LABEL = "containedenv.pool"
+POOL_KEY_LABEL = "containedenv.pool-key"
+
+
+def pool_key(image_key:str, projects:List[Project], profile:GithubProfile = None, token:str = None) -> str:
+	# A pool member can only be handed out for the same image, the same setup and the same
+	# credentials (repositories of members are configured and logged in with them)
+	setup = [p.to_dict() for p in projects]
+	identity = None
+	if profile is not None:
+		identity = {
+			"user" : profile.user,
+			"mail" : profile.mail,
+			"token" : sha256(token.encode("utf-8")) if token is not None else None
+		}
+	return sha256(json.dumps({"image" : image_key, "projects" : setup, "credentials" : identity}, sort_keys = True).encode("utf-8"))
+
+
+class ContainerPool(object):
+	def __init__(self, client:docker.DockerClient, app:str, key:str, size:int) -> None:
+		self.client = client
+		# App the pool belongs to
+		self.app:str = app
+		# Pool key of the current image and setup
+		self.key:str = key
+		# Number of ready containers to keep
+		self.size:int = size
+
+	def labels(self) -> Dict[str, str]:
+		return {POOL_LABEL : self.app, POOL_KEY_LABEL : self.key}
+
+	def member_name(self) -> str:
+		return f"{self.app}_pool_{uuid.uuid4().hex[:8]}"
+
+	def members(self) -> list:
+		# Claimed members keep their labels but not their pool name
+		containers = self.client.containers.list(all = True, filters = {"label" : f"{POOL_LABEL}={self.app}"})
+		return [c for c in containers if c.name.startswith(f"{self.app}_pool_")]
+
+	def evict_stale(self) -> int:
+		# Members made from another image or setup are useless, remove them
+		stale = [c for c in self.members() if c.labels.get(POOL_KEY_LABEL) != self.key]
+		for container in stale:
+			container.remove(force = True)
+		return len(stale)
+
+	def ready(self) -> list:
+		return [
+			c for c in self.members()
+			if c.labels.get(POOL_KEY_LABEL) == self.key and c.status == "running"
+		]
+
+	def missing(self) -> int:
+		return max(0, self.size - len(self.ready()))
+
+	def claim(self, name:str):
+		# Renaming is atomic on the daemon, a member another process claimed first
+		# either is gone from the list or fails to rename
+		for container in self.ready():
+			try:
+				container.rename(name)
+				container.reload()
+				return container
+			except docker.errors.APIError:
+				continue
+		return None
+
+
+def refill_log(app:str) -> str:
+	return os.path.join(state_dir(), f"{app}.pool.log")
+
+@contextlib.contextmanager
+def refill_lock(app:str, directory:str = None):
+	# One refill of an app at a time: counting the members then creating the missing ones
+	# is not atomic, two refills started together would both fill the pool
+	directory = directory if directory is not None else state_dir()
+	os.makedirs(directory, exist_ok = True)
+	with open(os.path.join(directory, f"{app}.pool.lock"), "w") as f:
+		fcntl.flock(f, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(f, fcntl.LOCK_UN)
+
+def spawn_refill(argv:List[str], log:str) -> subprocess.Popen:
+	# Top the pool up from a detached process, so handing out does not wait for it.
+	# Its output goes to the log, where failures can be found.
+	os.makedirs(os.path.dirname(log), exist_ok = True)
+	with open(log, "a") as f:
+		return subprocess.Popen(
+			[sys.executable, "-m", "containedenv"] + argv + ["--pool-refill"],
+			stdin = subprocess.DEVNULL,
+			stdout = f,
+			stderr = subprocess.STDOUT,
+			start_new_session = True
+		)
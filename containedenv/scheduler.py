@@ -0,0 +1,128 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List
+from containedenv.config import Project
+
+
+class SetupError(RuntimeError):
+	def __init__(self, project:str, log:List[str], error:Exception) -> None:
+		self.project = project
+		self.log = log
+		self.error = error
+		lines = "\n".join(f"\t{line}" for line in log)
+		super().__init__(f"Setup of project {project} failed: {error}\n{lines}")
+
+
+class ProjectScheduler(object):
+	def __init__(self, projects:List[Project], workers:int = 4, known:List[str] = None) -> None:
+		# Projects to setup, indexed by name
+		self.projects:Dict[str, Project] = {p.name : p for p in projects}
+		# Names of every project of the config, the scheduled ones by default
+		known = set(known if known is not None else self.projects) | set(self.projects)
+		for project in projects:
+			unknown = [d for d in project.depends if d not in known]
+			if len(unknown) > 0:
+				raise SetupError(project.name, [], ValueError(f"depends on unknown project(s) {', '.join(unknown)}"))
+		# Maximum number of projects being setup at the same time
+		self.workers:int = max(1, workers)
+		# Per project setup logs
+		self.logs:Dict[str, List[str]] = {name : [] for name in self.projects}
+		# Dependencies between scheduled projects, known projects not selected are considered already setup
+		self.depends:Dict[str, set] = {
+			p.name : set(d for d in p.depends if d in self.projects) for p in projects
+		}
+		self.__check_cycles()
+
+	def __check_cycles(self) -> None:
+		visiting, done = set(), set()
+		def visit(name:str, path:List[str]):
+			if name in done: return
+			if name in visiting:
+				cycle = path[path.index(name):] + [name]
+				raise ValueError(f"Cyclic project dependencies: {' -> '.join(cycle)}")
+			visiting.add(name)
+			[visit(d, path + [name]) for d in sorted(self.depends[name])]
+			visiting.discard(name)
+			done.add(name)
+		[visit(name, []) for name in self.projects]
+
+	def log(self, project:str, line:str) -> None:
+		self.logs[project].append(line)
+
+	def __run_one(self, setup:Callable[[Project, Callable[[str], None]], None], name:str) -> None:
+		start = time.perf_counter()
+		self.log(name, "started")
+		try:
+			setup(self.projects[name], lambda line: self.log(name, line))
+		except Exception as e:
+			self.log(name, f"failed after {time.perf_counter() - start:.2f}s")
+			raise SetupError(name, self.logs[name], e) from e
+		self.log(name, f"done in {time.perf_counter() - start:.2f}s")
+
+	def run(self, setup:Callable[[Project, Callable[[str], None]], None]) -> Dict[str, List[str]]:
+		# setup(project, log) is called once per project, as soon as all its dependencies are setup
+		pending = {name : set(deps) for name, deps in self.depends.items()}
+		running = {}
+		failure = None
+		with ThreadPoolExecutor(max_workers = self.workers) as pool:
+			while len(pending) > 0 or len(running) > 0:
+				# Stop scheduling new projects as soon as one failed
+				if failure is None:
+					ready = [name for name, deps in pending.items() if len(deps) == 0]
+					for name in ready:
+						del pending[name]
+						running[pool.submit(self.__run_one, setup, name)] = name
+
+				if len(running) == 0:
+					break
+
+				finished, _ = wait(running, return_when = FIRST_COMPLETED)
+				for future in finished:
+					name = running.pop(future)
+					if future.exception() is not None:
+						failure = failure or future.exception()
+						continue
+					[deps.discard(name) for deps in pending.values()]
+
+		if failure is not None:
+			raise failure
+		return self.logs
+
+	async def __arun_one(self, setup, name:str) -> None:
+		start = time.perf_counter()
+		self.log(name, "started")
+		try:
+			await setup(self.projects[name], lambda line: self.log(name, line))
+		except Exception as e:
+			self.log(name, f"failed after {time.perf_counter() - start:.2f}s")
+			raise SetupError(name, self.logs[name], e) from e
+		self.log(name, f"done in {time.perf_counter() - start:.2f}s")
+
+	async def arun(self, setup) -> Dict[str, List[str]]:
+		# Same as run, setup(project, log) being a coroutine function: projects are tasks
+		# of the running event loop, at most workers of them at the same time
+		pending = {name : set(deps) for name, deps in self.depends.items()}
+		running = {}
+		failure = None
+		while len(pending) > 0 or len(running) > 0:
+			if failure is None:
+				ready = [name for name, deps in pending.items() if len(deps) == 0]
+				for name in ready[:max(0, self.workers - len(running))]:
+					del pending[name]
+					running[asyncio.ensure_future(self.__arun_one(setup, name))] = name
+
+			if len(running) == 0:
+				break
+
+			finished, _ = await asyncio.wait(running, return_when = asyncio.FIRST_COMPLETED)
+			for task in finished:
+				name = running.pop(task)
+				if task.exception() is not None:
+					failure = failure or task.exception()
+					continue
+				[deps.discard(name) for deps in pending.values()]
+
+		if failure is not None:
+			raise failure
+		return self.logs
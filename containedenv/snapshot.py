@@ -0,0 +1,15 @@
+import json
+from typing import Dict, List
+from containedenv.cache import sha256
+
+# Label of snapshot images: key of the image and setup they were committed from
+SNAPSHOT_KEY_LABEL = "containedenv.snapshot-key"
+
+
+def snapshot_key(image_key:str, steps:Dict[str, List[str]]) -> str:
+	# steps: setup step keys of each selected project (see journal.step_keys)
+	return sha256(json.dumps({"image" : image_key, "steps" : steps}, sort_keys = True).encode("utf-8"))
+
+def snapshot_tag(imagename:str) -> str:
+	# One snapshot per app, next to its image
+	return f"{imagename}-snapshot"
@@ -0,0 +1,172 @@
+import json
+import os
+import tempfile
+from typing import Dict, List
+import docker
+
+# What runs leave behind (images, containers and the inputs of the last builds), recorded
+# in a local state file per app. Plans are computed against it, or against one listing of
+# the daemon images and containers, without any other call to the daemon.
+
+
+def state_dir() -> str:
+	return os.path.join(os.path.expanduser("~"), ".cache", "containedenv", "state")
+
+def state_path(appname:str, root:str = None) -> str:
+	return os.path.join(root if root is not None else state_dir(), f"{appname}.json")
+
+
+class State(object):
+	def __init__(self) -> None:
+		# Image id -> {"id", "tags", "labels", "digests"}
+		self.images:Dict[str, dict] = {}
+		# Container name -> {"id", "image", "labels", "steps"}, steps: keys of the applied
+		# setup steps, None when unknown
+		self.containers:Dict[str, dict] = {}
+		# Image tag -> inputs of its last build: dockerfile, base digest and hash of each context file
+		self.builds:Dict[str, dict] = {}
+
+	def to_dict(self) -> dict:
+		return {"images" : self.images, "containers" : self.containers, "builds" : self.builds}
+
+	@staticmethod
+	def from_dict(d:dict) -> "State":
+		state = State()
+		state.images = d.get("images", {})
+		state.containers = d.get("containers", {})
+		state.builds = d.get("builds", {})
+		return state
+
+	@staticmethod
+	def load(path:str) -> "State":
+		# A missing or unreadable state is an empty one, everything then shows as new
+		try:
+			with open(path, "r") as f:
+				return State.from_dict(json.load(f))
+		except (OSError, ValueError):
+			return State()
+
+	def save(self, path:str) -> None:
+		# Written aside then renamed, a concurrent plan never reads half a file
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(self.to_dict(), f, indent = 1, sort_keys = True)
+			os.replace(tmp, path)
+		except BaseException:
+			if os.path.exists(tmp): os.unlink(tmp)
+			raise
+
+	@staticmethod
+	def from_daemon(client:docker.DockerClient) -> "State":
+		# One listing of the images and one of the containers. The low level api answers with
+		# the labels directly, the high level one would inspect every object.
+		state = State()
+		for i in client.api.images():
+			state.images[i["Id"]] = {
+				"id" : i["Id"], "tags" : i.get("RepoTags") or [],
+				"labels" : i.get("Labels") or {}, "digests" : i.get("RepoDigests") or []
+			}
+		for c in client.api.containers(all = True):
+			name = (c.get("Names") or ["/"])[0].lstrip("/")
+			state.add_container(name, c["Id"], c.get("Image"), c.get("Labels") or {})
+		return state
+
+	def merge(self, recorded:"State") -> "State":
+		# What the daemon cannot tell from labels: applied setup steps and build inputs
+		for name, container in self.containers.items():
+			previous = recorded.containers.get(name)
+			if previous is not None and previous.get("id") == container["id"]:
+				container["steps"] = previous.get("steps")
+		self.builds = {**recorded.builds, **self.builds}
+		return self
+
+	def add_image(self, id:str, tags:List[str], labels:Dict[str, str], digests:List[str] = []) -> None:
+		# A tag moves to the image last given, images left without tag are forgotten
+		for image in self.images.values():
+			image["tags"] = [t for t in image["tags"] if t not in tags]
+		self.images = {k : i for k, i in self.images.items() if len(i["tags"]) > 0}
+		self.images[id] = {"id" : id, "tags" : list(tags), "labels" : dict(labels), "digests" : list(digests)}
+
+	def add_container(self, name:str, id:str, image:str, labels:Dict[str, str], steps:List[str] = None) -> None:
+		self.containers[name] = {
+			"id" : id, "image" : image, "labels" : dict(labels),
+			"steps" : sorted(steps) if steps is not None else None
+		}
+
+	def remove_container(self, name:str) -> None:
+		self.containers.pop(name, None)
+
+	def image(self, name:str) -> dict:
+		for image in self.images.values():
+			if image["id"] == name or name in image["tags"]:
+				return image
+		return None
+
+
+class _Image(object):
+	def __init__(self, image:dict) -> None:
+		self.id:str = image["id"]
+		self.tags:List[str] = image["tags"]
+		self.labels:Dict[str, str] = image["labels"]
+		self.attrs:dict = {"Id" : self.id, "RepoDigests" : image["digests"], "Config" : {"Labels" : self.labels}}
+
+
+class _Container(object):
+	def __init__(self, name:str, container:dict) -> None:
+		self.id:str = container["id"]
+		self.name:str = name
+		self.labels:Dict[str, str] = container["labels"]
+		self.attrs:dict = {"Id" : self.id, "Name" : name, "Config" : {"Image" : container["image"], "Labels" : self.labels}}
+
+
+class _Images(object):
+	def __init__(self, state:State) -> None:
+		self.__state = state
+
+	def get(self, name:str) -> _Image:
+		image = self.__state.image(name)
+		if image is None:
+			raise docker.errors.ImageNotFound(f"No such image: {name}")
+		return _Image(image)
+
+	def list(self, filters:dict = None, **kwargs) -> List[_Image]:
+		label = (filters or {}).get("label")
+		images = [_Image(i) for i in self.__state.images.values()]
+		if label is None:
+			return images
+		key, _, value = label.partition("=")
+		return [i for i in images if key in i.labels and (value == "" or i.labels[key] == value)]
+
+	def get_registry_data(self, name:str):
+		# Registries are not asked either, bases are known from their local digests
+		raise docker.errors.APIError(f"Offline, no registry data for {name}")
+
+
+class _Containers(object):
+	def __init__(self, state:State) -> None:
+		self.__state = state
+
+	def get(self, name:str) -> _Container:
+		for cname, container in self.__state.containers.items():
+			if cname == name or container["id"] == name:
+				return _Container(cname, container)
+		raise docker.errors.NotFound(f"No such container: {name}")
+
+	def list(self, all:bool = False, filters:dict = None, **kwargs) -> List[_Container]:
+		label = (filters or {}).get("label")
+		containers = [_Container(n, c) for n, c in self.__state.containers.items()]
+		if label is None:
+			return containers
+		key, _, value = label.partition("=")
+		return [c for c in containers if key in c.labels and (value == "" or c.labels[key] == value)]
+
+
+class OfflineClient(object):
+	# Read only view of a state with the interface of docker.DockerClient used to compute
+	# keys and find tiers. Anything else (builds, runs) is not there and fails loudly.
+	def __init__(self, state:State) -> None:
+		self.state:State = state
+		self.images = _Images(state)
+		self.containers = _Containers(state)
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+from containedenv.buildlog import owner_comment
+from containedenv.cache import CONTENT_KEY_LABEL, build_content_key, read_files, sha256
+from containedenv.config import Config, Project, config_dir
+from containedenv.context import context_files
+from containedenv.dockerfile import UbuntuDockerFile
+from containedenv.optimize import optimize
+from containedenv.packages import PackageManager2
+
+# Repository of tier images, tagged by content key
+TIER_REPOSITORY = "containedenv-tier"
+# Labels of tier images
+TIER_BASE_LABEL = "containedenv.tier.base"
+TIER_PACKAGES_LABEL = "containedenv.tier.packages"
+TIER_PARENT_LABEL = "containedenv.tier.parent"
+# Apt packages every containedenv image starts with
+BASE_TOOLING = ["sudo", "wget", "curl"]
+
+
+@dataclass
+class Tier:
+	# Image the whole tier chain starts from
+	imgfrom:str
+	# Packages installed in the tier (parent packages included), in canonical order
+	packages:List[str]
+	# Tier this one is built on, None to build on imgfrom
+	parent:"Tier" = None
+	# Rendered dockerfile and its content key (see render_tier)
+	dockerfile:str = None
+	key:str = None
+
+	def tag(self) -> str:
+		return f"{TIER_REPOSITORY}:{self.key[:24]}"
+
+	def source(self) -> str:
+		return self.parent.tag() if self.parent is not None else self.imgfrom
+
+	def labels(self) -> Dict[str, str]:
+		return {
+			CONTENT_KEY_LABEL : self.key,
+			TIER_BASE_LABEL : self.imgfrom,
+			TIER_PACKAGES_LABEL : ",".join(self.packages),
+			TIER_PARENT_LABEL : self.parent.tag() if self.parent is not None else ""
+		}
+
+
+def tier_sequence(config:Config, packages:List[str]) -> List[str]:
+	# Tokens identifying the base image then each package (name and definition),
+	# two configs share a tier only when they share a prefix of these tokens
+	# A locked config starts from the base digest, and its packages include their pinned versions
+	defs = {p.name : p for p in config.packages}
+	versions = config.apt_versions()
+	tokens = [config.base_image()]
+	for name in packages:
+		definition = defs[name].to_dict()
+		if versions is not None:
+			definition["pins"] = {a : versions.get(a) for a in defs[name].apt_packages}
+		definition = json.dumps(definition, sort_keys = True)
+		tokens.append(f"{name}@{sha256(definition.encode('utf-8'))[:12]}")
+	return tokens
+
+def shared_prefixes(sequences:List[List[str]]) -> List[Tuple[str, ...]]:
+	# Deepest prefix each sequence shares with at least another one, shortest first
+	counts:Dict[Tuple[str, ...], int] = {}
+	for seq in sequences:
+		for k in range(1, len(seq) + 1):
+			counts[tuple(seq[:k])] = counts.get(tuple(seq[:k]), 0) + 1
+
+	deepest = set()
+	for seq in sequences:
+		shared = [tuple(seq[:k]) for k in range(1, len(seq) + 1) if counts[tuple(seq[:k])] >= 2]
+		if len(shared) > 0:
+			deepest.add(shared[-1])
+	return sorted(deepest, key = lambda p: (len(p), p))
+
+def render_tier(config:Config, tier:Tier, base_digest:str) -> Tier:
+	# Dockerfile installing the tier packages on top of its parent (or of the base image)
+	fd, path = tempfile.mkstemp(prefix = "Dockerfile.tier.")
+	os.close(fd)
+	try:
+		dockerfile = UbuntuDockerFile(
+			path, tier.source(), "root",
+			update = tier.parent is None,
+			distribution = config.app.imgfrom,
+			cache_mounts = config.args is not None and config.args.cache_mounts,
+			apt_versions = config.apt_versions()
+		)
+		pkg = PackageManager2(config, dockerfile)
+		if tier.parent is not None:
+			pkg.installed.update(tier.parent.packages)
+		plan = pkg.plan(
+			[Project(name = "tier", requires = tier.packages)],
+			base = BASE_TOOLING if tier.parent is None else []
+		)
+		dockerfile.writeline(owner_comment("apt", "packages"))
+		dockerfile.install(plan.apt_packages, clean = True)
+		pkg.install_plan(plan)
+		dockerfile.close()
+		with open(path, "r") as f:
+			tier.dockerfile = f.read()
+		if config.args is not None and config.args.optimize:
+			tier.dockerfile = optimize(tier.dockerfile)
+	finally:
+		if os.path.isfile(path): os.unlink(path)
+
+	files = {**pkg.fragments, **context_files(tier.dockerfile, config_dir())}
+	tier.key = build_content_key(
+		dockerfile = tier.dockerfile,
+		projects = [],
+		packages = tier.packages,
+		# Chained keys, a tier is invalidated with its parent
+		base_digest = tier.parent.key if tier.parent is not None else base_digest,
+		fragments = read_files(files)
+	)
+	return tier
+
+def tier_chain(
+		prefixes:List[Tuple[str, ...]],
+		apps:List[Tuple[Config, List[str]]],
+		digests:Dict[str, str]
+	) -> Dict[Tuple[str, ...], Tier]:
+	# Tiers for the given prefixes (shortest first), each built on the deepest shorter one.
+	# A tier is rendered with the config of any app (config, sequence) starting with its prefix,
+	# the sequence tokens guarantee they all define its packages the same way.
+	tiers:Dict[Tuple[str, ...], Tier] = {}
+	for prefix in prefixes:
+		config = next(c for c, seq in apps if tuple(seq[:len(prefix)]) == prefix)
+		parents = [p for p in tiers if prefix[:len(p)] == p]
+		parent = tiers[max(parents, key = len)] if len(parents) > 0 else None
+		packages = [token.split("@")[0] for token in prefix[1:]]
+		tiers[prefix] = render_tier(config, Tier(prefix[0], packages, parent), digests[prefix[0]])
+	return tiers
+
+def deepest_tier(tiers:Dict[Tuple[str, ...], Tier], sequence:List[str]) -> Tier:
+	matches = [p for p in tiers if tuple(sequence[:len(p)]) == p]
+	return tiers[max(matches, key = len)] if len(matches) > 0 else None
@@ -0,0 +1,111 @@
+import functools
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+
+# Spans of the current run, exported in the Chrome trace event format
+# (chrome://tracing, https://ui.perfetto.dev). Tracing is off unless enable() was called,
+# span() then hands out a shared object doing nothing.
+
+
+class _NullSpan(object):
+	def __enter__(self) -> "_NullSpan":
+		return self
+
+	def __exit__(self, *exc) -> None:
+		pass
+
+	def set(self, **attributes) -> "_NullSpan":
+		return self
+
+_NULL = _NullSpan()
+
+
+class Span(object):
+	def __init__(self, tracer:"Tracer", name:str, attributes:dict) -> None:
+		self.__tracer = tracer
+		self.name:str = name
+		self.attributes:dict = attributes
+		self.start:int = None
+
+	def __enter__(self) -> "Span":
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, exc_type, exc, tb) -> None:
+		if exc_type is not None:
+			self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+		self.__tracer.add(self.name, self.start, time.perf_counter_ns() - self.start, self.attributes)
+
+	def set(self, **attributes) -> "Span":
+		# Attributes known once the span started (bytes sent, exit code, ...)
+		self.attributes.update(attributes)
+		return self
+
+
+class Tracer(object):
+	def __init__(self) -> None:
+		self.events:List[dict] = []
+		self.__threads:Dict[int, str] = {}
+		self.__origin:int = time.perf_counter_ns()
+		self.__lock = threading.Lock()
+
+	def add(self, name:str, start:int, duration:int, attributes:dict) -> None:
+		thread = threading.current_thread()
+		event = {
+			"name" : name,
+			"cat" : name.split(".")[0],
+			"ph" : "X",
+			# Microseconds
+			"ts" : (start - self.__origin) / 1000,
+			"dur" : duration / 1000,
+			"pid" : os.getpid(),
+			"tid" : thread.ident,
+			"args" : {k : v if isinstance(v, (int, float, bool, str)) or v is None else str(v) for k, v in attributes.items()}
+		}
+		with self.__lock:
+			self.events.append(event)
+			self.__threads[thread.ident] = thread.name
+
+	def to_dict(self) -> dict:
+		with self.__lock:
+			threads = [
+				{"name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : tid, "args" : {"name" : name}}
+				for tid, name in self.__threads.items()
+			]
+			return {"traceEvents" : threads + sorted(self.events, key = lambda e: e["ts"]), "displayTimeUnit" : "ms"}
+
+	def write(self, path:str) -> None:
+		with open(path, "w") as f:
+			json.dump(self.to_dict(), f)
+
+
+_tracer:Tracer = None
+
+def enable() -> Tracer:
+	global _tracer
+	_tracer = Tracer()
+	return _tracer
+
+def tracer() -> Tracer:
+	return _tracer
+
+def span(name:str, **attributes):
+	# with span("phase", key = value) as s: ... s.set(other = value)
+	if _tracer is None:
+		return _NULL
+	return Span(_tracer, name, attributes)
+
+def traced(name:str):
+	# Decorator making every call of a function a span
+	def decorate(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if _tracer is None:
+				return function(*args, **kwargs)
+			with Span(_tracer, name, {}):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
@@ -0,0 +1,27 @@
+import pytest
+from synthetic import write_config
+
+
+@pytest.fixture(autouse = True)
+def home(tmp_path, monkeypatch):
+	# State files, mirrors and compiled configs stay out of the real home directory
+	monkeypatch.setenv("HOME", str(tmp_path / "home"))
+	return tmp_path / "home"
+
+@pytest.fixture
+def environment(tmp_path):
+	# ContainedEnv of a small synthetic config on a fake docker client
+	pytest.importorskip("pyrc")
+	from fakedocker import FakeDockerClient
+	from containedenv.__main__ import get_argparser
+	from containedenv.config import compile_config
+	from containedenv.engine import ContainedEnv
+	path = write_config(str(tmp_path / "synthetic.yml"), packages = 20, depth = 5, projects = 4)
+	client = FakeDockerClient(base_images = ["ubuntu:22.04"])
+
+	def make(*argv:str) -> ContainedEnv:
+		config = compile_config(path, str(tmp_path / "cache"))
+		config.args = get_argparser().parse_args(list(argv) + [a for p in config.projects for a in ("-p", p.name)])
+		return ContainedEnv(config, dockerclient = client, statedir = str(tmp_path / "state"))
+	make.client = client
+	return make
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import shutil
+import struct
+import tempfile
+import urllib.parse
+import pytest
+from containedenv.aioengine import AsyncDockerClient, AsyncEngine, NotFound
+
+
+def chunked(*parts:bytes) -> bytes:
+	# Chunked body, the first chunk with an extension, and a trailer
+	body = b""
+	for i, part in enumerate(parts):
+		body += f"{len(part):x}{';ext=1' if i == 0 else ''}\r\n".encode() + part + b"\r\n"
+	return body + b"0\r\nX-Trailer: 1\r\n\r\n"
+
+def response(status:int, body:bytes = b"", headers:dict = None) -> bytes:
+	headers = headers if headers is not None else {"Content-Length" : str(len(body))}
+	head = f"HTTP/1.1 {status} X\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+	return head.encode() + body
+
+def frame(stream:int, data:bytes) -> bytes:
+	return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+class FakeDaemon(object):
+	# Answers each request on the socket with the raw response of its route, then closes
+	def __init__(self, routes:dict) -> None:
+		self.routes = routes
+		self.requests = []
+
+	async def __handle(self, reader, writer) -> None:
+		head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+		method, target, _ = head[0].split(" ")
+		headers = {l.split(":")[0].lower() : l.split(":", 1)[1].strip() for l in head[1:] if ":" in l}
+		body = await reader.readexactly(int(headers.get("content-length", "0")))
+		path, _, query = target.partition("?")
+		self.requests.append((method, urllib.parse.unquote(path), dict(urllib.parse.parse_qsl(query)), body))
+		writer.write(self.routes.get((method, path), response(404, b'{"message": "no such route"}')))
+		await writer.drain()
+		writer.close()
+
+	def run(self, scenario) -> object:
+		# scenario(client) runs against the daemon on a fresh socket
+		directory = tempfile.mkdtemp(prefix = "aio.")
+		socket = os.path.join(directory, "docker.sock")
+		async def main():
+			server = await asyncio.start_unix_server(self.__handle, socket)
+			try:
+				return await scenario(AsyncDockerClient(socket))
+			finally:
+				server.close()
+				await server.wait_closed()
+		try:
+			return asyncio.run(main())
+		finally:
+			shutil.rmtree(directory)
+
+
+def test_chunked_json_stream():
+	# Documents cut across chunks, several in one chunk
+	parts = [b'{"stream": "Step 1/2 : FROM ', b'ubuntu\\n"}\r\n{"stream": "St', b'ep 2/2 : RUN true\\n"}{"aux": {"ID": "sha256:1"}}']
+	daemon = FakeDaemon({("GET", "/stream") : response(200, chunked(*parts), {"Transfer-Encoding" : "chunked"})})
+	async def scenario(client):
+		r = await client.request("GET", "/stream")
+		try:
+			return [d async for d in client.json_stream(r)]
+		finally:
+			await r.close()
+	assert daemon.run(scenario) == [
+		{"stream" : "Step 1/2 : FROM ubuntu\n"}, {"stream" : "Step 2/2 : RUN true\n"}, {"aux" : {"ID" : "sha256:1"}}
+	]
+
+def test_exec_demultiplexes_frames():
+	stream = frame(1, b"out one\nout ") + frame(2, b"err \xc3") + frame(2, b"\xa9\n") + frame(1, b"two\nlast")
+	daemon = FakeDaemon({
+		("POST", "/containers/c/exec") : response(201, b'{"Id": "e1"}'),
+		# Raw stream on the hijacked connection, cut anywhere
+		("POST", "/exec/e1/start") : response(101, stream, {"Connection" : "Upgrade", "Upgrade" : "tcp"}),
+		("GET", "/exec/e1/json") : response(200, b'{"ExitCode": 3}')
+	})
+	lines = []
+	async def scenario(client):
+		return await AsyncEngine(client, user = "u").exec("c", "echo", on_line = lambda s, l: lines.append((s, l)))
+	code, output = daemon.run(scenario)
+	assert code == 3
+	assert lines == [("stdout", "out one"), ("stderr", "err é"), ("stdout", "out two"), ("stdout", "last")]
+	assert output == ["out one", "err é", "out two", "last"]
+	created = json.loads(daemon.requests[0][3])
+	assert created["Cmd"] == ["bash", "-c", "echo"] and created["User"] == "u"
+
+def test_build_sends_build_arguments_and_limits():
+	body = b'{"stream": "Step 1/1 : FROM ubuntu\\n"}\n{"aux": {"ID": "sha256:1"}}\n'
+	daemon = FakeDaemon({("POST", "/build") : response(200, chunked(body), {"Transfer-Encoding" : "chunked"})})
+	async def scenario(client):
+		return await AsyncEngine(client).build(
+			"FROM ubuntu\n", tag = "t", buildargs = {"JOBS" : "4"},
+			container_limits = {"memory" : 2**30, "memswap" : 2**30}, shmsize = 2**20
+		)
+	log = daemon.run(scenario)
+	assert log.image_id == "sha256:1"
+	_, _, params, _ = daemon.requests[0]
+	assert json.loads(params["buildargs"]) == {"JOBS" : "4"}
+	assert params["memory"] == params["memswap"] == str(2**30)
+	assert params["shmsize"] == str(2**20)
+
+def test_run_sends_environment_and_resources():
+	daemon = FakeDaemon({
+		("POST", "/containers/create") : response(201, b'{"Id": "c1"}'),
+		("POST", "/containers/c1/start") : response(204, headers = {})
+	})
+	async def scenario(client):
+		return await AsyncEngine(client).run(
+			"img", name = "n", environment = {"JOBS" : "4"}, nano_cpus = 2 * 10**9, mem_limit = "1g", shm_size = "64m"
+		)
+	assert daemon.run(scenario) == "c1"
+	body = json.loads(daemon.requests[0][3])
+	assert body["Env"] == ["JOBS=4"]
+	assert body["HostConfig"]["NanoCpus"] == 2 * 10**9
+	assert body["HostConfig"]["Memory"] == 2**30
+	assert body["HostConfig"]["ShmSize"] == 64 * 2**20
+
+def test_not_found():
+	daemon = FakeDaemon({})
+	async def scenario(client):
+		return await AsyncEngine(client).image("missing")
+	with pytest.raises(NotFound):
+		daemon.run(scenario)
+
+def test_options_of_the_sync_engine(environment, monkeypatch):
+	from containedenv.config import Resources
+	env = environment()
+	monkeypatch.setattr(type(env), "resources", lambda self: Resources(cpus = 2, memory = "1g", jobs = 3))
+	assert env.build_options()["buildargs"]["JOBS"] == "3"
+	assert env.run_options() == {"environment" : {"JOBS" : "3"}, "nano_cpus" : 2 * 10**9, "mem_limit" : "1g", "shm_size" : None}
+
+def test_asyncio_setup_of_every_project_on_one_loop(environment, monkeypatch):
+	loops = set()
+	class Engine(object):
+		# Hands the requests of the setup to the containers of the fake client
+		async def put_archive(self, container, path, data):
+			loops.add(asyncio.get_running_loop())
+			environment.client.containers.get(container).put_archive(path, data)
+		async def exec(self, container, cmd, user = None):
+			loops.add(asyncio.get_running_loop())
+			result = environment.client.containers.get(container).exec_run(cmd, user = user)
+			return result.exit_code, result.output.decode().splitlines()
+	env = environment("--asyncio")
+	monkeypatch.setattr(type(env), "async_engine", lambda self: Engine())
+	env = env.build_image().run_container()
+	assert len(env.container.archives) == 4
+	assert len(loops) == 1
+
+def test_asyncio_engine_needs_a_unix_socket(environment):
+	from containedenv.endpoints import Endpoint
+	env = environment("--asyncio")
+	env._endpoint = Endpoint("tcp://build:2375", client = environment.client)
+	with pytest.raises(ValueError, match = "unix sockets"):
+		env.async_engine()
+	env._endpoint = Endpoint("unix:///run/user/docker.sock", client = environment.client)
+	assert env.async_engine().client.socket == "/run/user/docker.sock"
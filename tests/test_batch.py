@@ -0,0 +1,48 @@
+import io
+import subprocess
+import tarfile
+from containedenv.batch import MARKER, SetupScript
+
+
+def run(script:SetupScript, tmp_path) -> list:
+	# The rendered script, in a real shell
+	path = tmp_path / "script.sh"
+	path.write_text(script.render())
+	output = subprocess.run(["bash", str(path)], capture_output = True).stdout
+	return script.parse(output)
+
+def test_steps_and_exit_codes(tmp_path):
+	script = SetupScript("p").add("one", ["echo a", "echo b"]).add("two", "printf 'no newline'").add("three", "exit 4").add("never", "true")
+	results = run(script, tmp_path)
+	assert [(r.name, r.code) for r in results] == [("one", 0), ("two", 0), ("three", 4), ("never", None)]
+	assert results[0].output == ["a", "b"]
+	# Output without a final newline keeps the end marker on its own line
+	assert results[1].output == ["no newline"]
+	assert all(r.duration >= 0 for r in results[:3])
+
+def test_trailing_empty_lines_are_kept(tmp_path):
+	results = run(SetupScript("p").add("one", "printf 'a\\n\\n'"), tmp_path)
+	assert results[0].output == ["a", ""]
+
+def test_silent_steps_and_cwd(tmp_path):
+	script = SetupScript("p").add("secret", "echo token", silent = True).add("where", "pwd", cwd = str(tmp_path))
+	results = run(script, tmp_path)
+	assert results[0].output == [] and results[0].code == 0
+	assert results[1].output == [str(tmp_path)]
+
+def test_empty_commands_are_skipped():
+	script = SetupScript("p").add("nothing", ["", None]).add("one", ["", "true"])
+	assert [s.name for s in script.steps] == ["one"]
+	assert script.steps[0].cmds == ["true"]
+
+def test_parse_without_leading_newline():
+	# Scripts rendered before the end marker had its own line
+	script = SetupScript("p").add("one", "true")
+	output = f"{MARKER} begin 0 1.0\nx\n{MARKER} end 0 0 1.5\n"
+	results = script.parse(output)
+	assert results[0].code == 0 and results[0].output == ["x"] and results[0].duration == 0.5
+
+def test_archive_holds_the_script():
+	script = SetupScript("p").add("one", "true")
+	with tarfile.open(fileobj = io.BytesIO(script.archive())) as tar:
+		assert tar.extractfile("containedenv-p.sh").read().decode("utf-8") == script.render()
@@ -0,0 +1,81 @@
+from containedenv.buildlog import BuildLog, layer_sizes, owner_comment, size_table, step_owners
+
+DOCKERFILE = "\n".join([
+	"FROM ubuntu:22.04",
+	"ARG JOBS",
+	"USER root",
+	owner_comment("apt", "packages"),
+	"RUN --mount=type=cache,target=/var/cache/apt apt-get update -y && \\",
+	"\tapt-get install -y curl",
+	owner_comment("package", "tool"),
+	"ENV TOOL_HOME /opt/tool",
+	"COPY tool.sh /opt/tool/tool.sh",
+	"RUN make -j$JOBS install",
+	owner_comment("base", "user"),
+	"USER bench",
+]) + "\n"
+
+BASE = [
+	{"CreatedBy" : "/bin/sh -c #(nop)  CMD [\"/bin/bash\"]", "Size" : 0},
+	{"CreatedBy" : "/bin/sh -c #(nop) ADD file:abc in / ", "Size" : 70 * 2**20},
+	{"CreatedBy" : "/bin/sh -c #(nop)  ARG RELEASE", "Size" : 0},
+]
+
+
+def test_step_owners():
+	assert step_owners(DOCKERFILE) == ["base", "base", "base", "apt packages", "package tool", "package tool", "package tool", "base user"]
+
+def test_layer_sizes_classic_history():
+	# Newest first, build arguments in front of RUN commands
+	history = [
+		{"CreatedBy" : "/bin/sh -c #(nop)  USER bench", "Size" : 0},
+		{"CreatedBy" : "|1 JOBS=4 /bin/sh -c make -j$JOBS install", "Size" : 30},
+		{"CreatedBy" : "/bin/sh -c #(nop) COPY file:123 in /opt/tool/tool.sh ", "Size" : 5},
+		{"CreatedBy" : "/bin/sh -c #(nop)  ENV TOOL_HOME=/opt/tool", "Size" : 0},
+		{"CreatedBy" : "|1 JOBS=4 /bin/sh -c apt-get update -y &&  apt-get install -y curl", "Size" : 100},
+		{"CreatedBy" : "/bin/sh -c #(nop)  USER root", "Size" : 0},
+		{"CreatedBy" : "/bin/sh -c #(nop)  ARG JOBS", "Size" : 0},
+	] + BASE
+	layers = layer_sizes(DOCKERFILE, history)
+	assert layers[0].owner == "base image" and layers[0].size == 70 * 2**20
+	assert [(l.owner, l.size) for l in layers[1:]] == [
+		("base", 0), ("base", 0), ("apt packages", 100),
+		("package tool", 0), ("package tool", 5), ("package tool", 30), ("base user", 0)
+	]
+
+def test_layer_sizes_buildkit_history_without_arg():
+	history = [
+		{"CreatedBy" : "USER bench", "Size" : 0},
+		{"CreatedBy" : "RUN |1 JOBS=4 /bin/sh -c make -j$JOBS install # buildkit", "Size" : 30},
+		{"CreatedBy" : "COPY tool.sh /opt/tool/tool.sh # buildkit", "Size" : 5},
+		{"CreatedBy" : "ENV TOOL_HOME=/opt/tool", "Size" : 0},
+		{"CreatedBy" : "RUN |1 JOBS=4 /bin/sh -c apt-get update -y && apt-get install -y curl # buildkit", "Size" : 100},
+		{"CreatedBy" : "USER root", "Size" : 0},
+	] + BASE
+	layers = layer_sizes(DOCKERFILE, history)
+	owners = {l.instruction.split()[0] + " " + l.owner : l.size for l in layers}
+	assert owners["RUN apt packages"] == 100
+	assert owners["COPY package tool"] == 5
+	assert owners["RUN package tool"] == 30
+	assert sum(l.size for l in layers) == 70 * 2**20 + 135
+	assert "total" in size_table(layers)
+
+def test_build_log_steps():
+	log = BuildLog(DOCKERFILE)
+	for chunk in [
+		{"stream" : "Step 1/8 : FROM ubuntu:22.04\n"}, {"stream" : " ---> abc\n"},
+		{"stream" : "Step 4/8 : RUN apt-get update -y\n"}, {"stream" : " ---> Using cache\n"},
+		{"stream" : "Step 7/8 : RUN make -j$JOBS install\n"},
+		{"aux" : {"ID" : "sha256:1"}}, {"stream" : "Successfully built 1\n"}
+	]:
+		log.feed(chunk)
+	log.close()
+	assert [(s.index, s.owner, s.cached) for s in log.steps] == [(1, "base", False), (4, "apt packages", True), (7, "package tool", False)]
+	assert log.image_id == "sha256:1"
+
+def test_build_log_buildkit():
+	log = BuildLog(DOCKERFILE)
+	for line in ["#5 [2/6] RUN make -j$JOBS install", "#5 DONE 1.5s", "#4 [1/6] FROM ubuntu:22.04", "#4 CACHED", "#9 writing image sha256:2 done"]:
+		log.feed_plain(line)
+	assert [(s.owner, s.duration, s.cached) for s in log.steps] == [("package tool", 1.5, False), ("base", 0.0, True)]
+	assert log.image_id == "sha256:2"
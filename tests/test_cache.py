@@ -0,0 +1,36 @@
+from containedenv.cache import build_content_key, read_files
+
+
+def key(**changes) -> str:
+	inputs = dict(
+		dockerfile = "FROM ubuntu:22.04\nRUN true\n",
+		projects = ["p", "q"],
+		packages = ["a", "b"],
+		base_digest = "sha256:base",
+		fragments = {"a.dockerfile" : b"RUN a", "b.dockerfile" : b"RUN b"}
+	)
+	inputs.update(changes)
+	return build_content_key(**inputs)
+
+def test_content_key_does_not_depend_on_input_order():
+	assert key() == key(
+		projects = ["q", "p"],
+		packages = ["b", "a"],
+		fragments = {"b.dockerfile" : b"RUN b", "a.dockerfile" : b"RUN a"}
+	)
+
+def test_content_key_changes_with_every_input():
+	keys = {
+		key(),
+		key(dockerfile = "FROM ubuntu:22.04\nRUN false\n"),
+		key(projects = ["p"]),
+		key(packages = ["a", "c"]),
+		key(base_digest = "sha256:other"),
+		key(fragments = {"a.dockerfile" : b"RUN a", "b.dockerfile" : b"RUN b2"}),
+		key(fragments = {"a.dockerfile" : b"RUN a", "c.dockerfile" : b"RUN b"})
+	}
+	assert len(keys) == 7
+
+def test_read_files(tmp_path):
+	(tmp_path / "a").write_bytes(b"content")
+	assert read_files({"name" : str(tmp_path / "a")}) == {"name" : b"content"}
@@ -0,0 +1,41 @@
+import os
+import pickle
+from containedenv import config as configmodule
+from containedenv.config import compile_config
+
+
+CONFIG = """
+app: {name: t, user: t}
+packages:
+  - {name: tool, image: ["RUN make install"]}
+projects:
+  - {name: p, requires: ["$tool"]}
+"""
+
+def write(tmp_path) -> str:
+	path = tmp_path / "conf.yml"
+	path.write_text(CONFIG)
+	return str(path)
+
+def test_compiled_config_is_reused_while_nothing_changed(tmp_path):
+	path = write(tmp_path)
+	first = compile_config(path, str(tmp_path / "cache"))
+	assert compile_config(path, str(tmp_path / "cache")).package("tool").name == "tool"
+	assert first.project("p").name == "p"
+	[cached] = os.listdir(tmp_path / "cache")
+	with open(tmp_path / "cache" / cached, "rb") as f:
+		assert pickle.load(f)["version"] == configmodule.model_version()
+
+def test_compiled_config_is_ignored_when_the_model_sources_change(tmp_path, monkeypatch):
+	path = write(tmp_path)
+	compile_config(path, str(tmp_path / "cache"))
+	[cached] = os.listdir(tmp_path / "cache")
+	# Poison the entry, it is only returned when the versions match
+	with open(tmp_path / "cache" / cached, "rb") as f:
+		entry = pickle.load(f)
+	entry["config"] = "stale"
+	with open(tmp_path / "cache" / cached, "wb") as f:
+		pickle.dump(entry, f)
+	assert compile_config(path, str(tmp_path / "cache")) == "stale"
+	monkeypatch.setattr(configmodule, "_MODEL_VERSION", "edited")
+	assert compile_config(path, str(tmp_path / "cache")).package("tool").name == "tool"
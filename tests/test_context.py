@@ -0,0 +1,46 @@
+import io
+import tarfile
+import pytest
+from containedenv.context import DOCKERFILE, build_context, context_files, logical_lines
+
+DOCKERFILE_TEXT = """FROM ubuntu:22.04
+ARG SCRIPTS=scripts
+ENV TOOL=tool.sh
+# COPY ignored.txt /
+COPY ${SCRIPTS}/$TOOL /usr/bin/
+COPY --from=builder /opt/a /opt/a
+ADD https://example.com/archive.tar.gz /tmp/
+COPY --chown=root:root data \\
+	/srv/data
+"""
+
+
+def test_logical_lines_join_continuations_and_drop_comments():
+	assert logical_lines("RUN a\\\n\t# comment\n\t&& b\n\n# other\nRUN c") == ["RUN a && b", "RUN c"]
+
+def test_context_files_follow_copy_sources(tmp_path):
+	(tmp_path / "scripts").mkdir()
+	(tmp_path / "scripts" / "tool.sh").write_text("echo")
+	(tmp_path / "data" / "sub").mkdir(parents = True)
+	(tmp_path / "data" / "sub" / "file").write_text("x")
+	(tmp_path / "ignored.txt").write_text("")
+	files = context_files(DOCKERFILE_TEXT, str(tmp_path))
+	assert files == {
+		"scripts/tool.sh" : str(tmp_path / "scripts" / "tool.sh"),
+		"data/sub/file" : str(tmp_path / "data" / "sub" / "file")
+	}
+
+def test_context_files_missing_source(tmp_path):
+	with pytest.raises(FileNotFoundError):
+		context_files("FROM ubuntu\nCOPY missing /\n", str(tmp_path))
+
+def test_build_context_is_reproducible(tmp_path):
+	(tmp_path / "b").write_text("b")
+	(tmp_path / "a").write_text("a")
+	first = build_context("FROM ubuntu\n", {"b" : str(tmp_path / "b"), "a" : str(tmp_path / "a")})
+	second = build_context("FROM ubuntu\n", {"a" : str(tmp_path / "a"), "b" : str(tmp_path / "b")})
+	assert first.getvalue() == second.getvalue()
+	with tarfile.open(fileobj = io.BytesIO(first.getvalue())) as tar:
+		assert tar.getnames() == [DOCKERFILE, "a", "b"]
+		assert tar.extractfile(DOCKERFILE).read() == b"FROM ubuntu\n"
+		assert all(m.mtime == 0 and m.mode == 0o644 for m in tar.getmembers())
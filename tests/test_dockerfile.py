@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("pyrc")
+
+from containedenv.context import logical_lines
+from containedenv.dockerfile import CACHE_MOUNTS, UbuntuDockerFile
+
+
+def render(tmp_path, packages:list, **kwargs) -> list:
+	dockerfile = UbuntuDockerFile(str(tmp_path / "Dockerfile"), "ubuntu:22.04", "root", **kwargs)
+	dockerfile.install(packages, clean = True)
+	dockerfile.close()
+	return logical_lines((tmp_path / "Dockerfile").read_text())
+
+def test_plain(tmp_path):
+	lines = render(tmp_path, ["curl", "git"])
+	assert lines[:2] == ["FROM ubuntu:22.04", "USER root"]
+	assert "apt-get upgrade -y" in lines[2]
+	assert "rm -rf /var/lib/apt/lists/*" in lines[3]
+	assert "docker-clean" not in "\n".join(lines)
+
+def test_cache_mounts_keep_docker_clean_in_the_image(tmp_path):
+	lines = render(tmp_path, ["curl"], cache_mounts = True)
+	runs = [l for l in lines if l.startswith("RUN ")]
+	assert len(runs) == 2
+	for run in runs:
+		assert all(mount in run for mount in CACHE_MOUNTS)
+		# Set aside for the RUN using the mount, then put back
+		assert run.index("mv /etc/apt/apt.conf.d/docker-clean") < run.index("apt-get") < run.index("mv /etc/apt/docker-clean.off")
+	assert "keep-cache" not in "\n".join(lines)
+	assert "/var/lib/apt/lists/*" not in runs[1]
+
+def test_locked_versions(tmp_path):
+	versions = {"curl" : {"curl" : "7.81", "libcurl4" : "7.81"}, "git" : {"git" : "1:2.34"}}
+	lines = render(tmp_path, ["git", "curl", "unknown"], apt_versions = versions)
+	assert "upgrade" not in lines[2]
+	assert "git=1:2.34" in lines[3] and "curl=7.81" in lines[3] and "libcurl4=7.81" in lines[3]
+	assert " unknown" in lines[3]
+
+def test_jobs_is_declared_before_its_first_use(tmp_path):
+	dockerfile = UbuntuDockerFile(str(tmp_path / "Dockerfile"), "ubuntu:22.04", "root")
+	dockerfile.install(["curl"])
+	dockerfile.writelines(["RUN ./configure &&\\", "\t# build", "\tmake -j${JOBS}", "RUN make -j$JOBS install"])
+	dockerfile.stage("ubuntu:22.04", "other")
+	dockerfile.writelines(["RUN echo $JOBS"])
+	dockerfile.close()
+	lines = logical_lines((tmp_path / "Dockerfile").read_text())
+	assert "ARG JOBS" not in lines[:4]
+	assert lines[4:7] == ["ARG JOBS", "RUN ./configure && make -j${JOBS}", "RUN make -j$JOBS install"]
+	# Build arguments are scoped to their stage
+	assert lines[7:] == ["FROM ubuntu:22.04 AS other", "ARG JOBS", "RUN echo $JOBS"]
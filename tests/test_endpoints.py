@@ -0,0 +1,53 @@
+import docker
+import pytest
+from fakedocker import FakeDockerClient
+from containedenv.endpoints import LOCAL_ENDPOINT, Endpoint, Scheduler
+
+
+def factory(clients:dict):
+	# Unknown urls fail like an unreachable daemon, when the client is made
+	def make(url:str):
+		if url not in clients:
+			raise docker.errors.DockerException(f"Error while fetching server API version: {url}")
+		return clients[url]
+	return make
+
+def test_from_urls_makes_clients_lazily():
+	made = []
+	scheduler = Scheduler.from_urls(["tcp://a:2375", "tcp://b:2375"], client = lambda url: made.append(url))
+	assert made == [] and [e.url for e in scheduler.endpoints] == ["tcp://a:2375", "tcp://b:2375"]
+
+def test_probe_leaves_out_unreachable_endpoints(capsys):
+	client = FakeDockerClient()
+	client.containers.run(client.images.pull("ubuntu:22.04").tags[0])
+	scheduler = Scheduler.from_urls(["tcp://127.0.0.1:1", "tcp://b:2375"], client = factory({"tcp://b:2375" : client})).probe()
+	assert [e.url for e in scheduler.endpoints] == ["tcp://b:2375"]
+	assert scheduler.endpoints[0].running == 1
+	assert "tcp://127.0.0.1:1 is unreachable" in capsys.readouterr().out
+
+def test_probe_without_reachable_endpoint():
+	with pytest.raises(RuntimeError):
+		Scheduler.from_urls(["tcp://127.0.0.1:1", "tcp://127.0.0.1:2"], client = factory({})).probe()
+
+def test_place_trades_held_images_against_load():
+	a, b = FakeDockerClient(), FakeDockerClient(base_images = ["tier:1", "app:1"])
+	scheduler = Scheduler.from_urls(["a", "b"], client = factory({"a" : a, "b" : b}))
+	# b holds both images, worth two placements, ties go to the least loaded
+	placed = [scheduler.place(["tier:1", "app:1"]).url for _ in range(4)]
+	assert placed == ["b", "b", "a", "b"]
+	# Without images the least loaded endpoint wins, then the first given
+	assert scheduler.place().url == "a"
+	scheduler.release(scheduler.endpoints[1])
+	assert [e.active for e in scheduler.endpoints] == [2, 2]
+
+def test_place_keeps_containers_where_they_are():
+	a, b = FakeDockerClient(), FakeDockerClient(base_images = ["ubuntu:22.04"])
+	b.containers.run("ubuntu:22.04", name = "env")
+	scheduler = Scheduler.from_urls(["a", "b"], client = factory({"a" : a, "b" : b}))
+	assert scheduler.place(container = "env").url == "b"
+	assert scheduler.place(container = "other").url == "a"
+
+def test_local_endpoints():
+	assert Endpoint(LOCAL_ENDPOINT).is_local() and Endpoint(LOCAL_ENDPOINT).docker_host() is None
+	assert Endpoint("unix:///run/docker.sock").is_local()
+	assert not Endpoint("ssh://builder").is_local() and Endpoint("ssh://builder").docker_host() == "ssh://builder"
@@ -0,0 +1,87 @@
+import threading
+import time
+import pytest
+import yaml
+from synthetic import synthetic_config
+
+pytest.importorskip("pyrc")
+from fakedocker import FakeDockerClient
+from containedenv.__main__ import get_argparser
+from containedenv.endpoints import Endpoint, Scheduler
+from containedenv.engine import ContainedEnv
+from containedenv.fleet import _build_tiers, build_many, summary_table
+
+
+def configs(tmp_path, *apps:str) -> list:
+	# Synthetic configs of the same packages, one per app
+	paths = []
+	for app in apps:
+		config = synthetic_config(packages = 20, depth = 5, projects = 2)
+		config["app"]["name"] = app
+		paths.append(str(tmp_path / f"{app}.yml"))
+		with open(paths[-1], "w") as f:
+			yaml.safe_dump(config, f, sort_keys = False)
+	return paths
+
+def fleet(tmp_path, paths:list, *argv:str, max_builds:int = 2) -> list:
+	args = get_argparser().parse_args(list(argv) + ["--config"] + paths)
+	client = FakeDockerClient(base_images = ["ubuntu:22.04"])
+	return build_many(args, paths, max_builds, scheduler = Scheduler([Endpoint("local", client = client)]))
+
+class Tier(object):
+	def __init__(self, *packages:str) -> None:
+		self.packages = list(packages)
+
+def test_tiers_are_built_after_their_parents():
+	built, lock = [], threading.Lock()
+	class Builder(object):
+		def build_tier(self, tier):
+			time.sleep(0.01)
+			with lock:
+				built.append(tuple(tier.packages))
+	tiers = [Tier("a", "b", "c"), Tier("a"), Tier("x", "y"), Tier("a", "b"), Tier("x")]
+	_build_tiers(Builder(), tiers, max_builds = 4)
+	depths = [len(t) for t in built]
+	assert depths == sorted(depths) and len(built) == 5
+
+def test_at_most_max_builds_at_once(tmp_path, monkeypatch):
+	running, most, lock = [0], [0], threading.Lock()
+	def build_image(self):
+		with lock:
+			running[0] += 1
+			most[0] = max(most[0], running[0])
+		time.sleep(0.05)
+		with lock:
+			running[0] -= 1
+		return self
+	monkeypatch.setattr(ContainedEnv, "build_image", build_image)
+	monkeypatch.setattr(ContainedEnv, "buildlog", None)
+	summaries = fleet(tmp_path, configs(tmp_path, "a", "b", "c", "d", "e"), max_builds = 2)
+	assert [s.status for s in summaries] == ["reused"] * 5
+	assert most[0] == 2
+
+def test_failures_are_summarized(tmp_path, monkeypatch):
+	build = ContainedEnv.build_image
+	def build_image(self):
+		if self.config.appname() == "broken":
+			raise RuntimeError("apt-get install failed\nE: Unable to locate package")
+		return build(self)
+	monkeypatch.setattr(ContainedEnv, "build_image", build_image)
+	paths = configs(tmp_path, "good", "broken") + [str(tmp_path / "missing.yml")]
+	summaries = fleet(tmp_path, paths)
+	assert [(s.app, s.status) for s in summaries] == [("good", "built"), ("broken", "failed"), (None, "failed")]
+	assert summaries[0].steps > 0 and summaries[0].error is None
+	assert summaries[1].error == "apt-get install failed"
+	assert summaries[2].error.startswith("cannot load config")
+	table = summary_table(summaries).splitlines()
+	assert table[0].split() == ["config", "app", "status", "duration", "cached"]
+	assert table[-2:] == [f"{paths[1]}: apt-get install failed", f"{paths[2]}: {summaries[2].error}"]
+
+def test_shared_tiers_are_built_before_the_apps(tmp_path, monkeypatch):
+	order = []
+	build_tier, build_image = ContainedEnv.build_tier, ContainedEnv.build_image
+	monkeypatch.setattr(ContainedEnv, "build_tier", lambda self, tier: order.append("tier") or build_tier(self, tier))
+	monkeypatch.setattr(ContainedEnv, "build_image", lambda self: order.append("app") or build_image(self))
+	summaries = fleet(tmp_path, configs(tmp_path, "a", "b"), "--tiers")
+	assert [s.status for s in summaries] == ["built", "built"]
+	assert "tier" in order and order.index("app") > max(i for i, step in enumerate(order) if step == "tier")
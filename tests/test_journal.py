@@ -0,0 +1,28 @@
+from docker.models.containers import ExecResult
+from fakedocker import FakeDockerClient
+from containedenv.batch import Step
+from containedenv.journal import SetupJournal, step_keys
+
+STEPS = [Step("clone", ["git clone x"], "/w"), Step("build", ["make"], "/w/x"), Step("test", ["make test"], "/w/x")]
+
+
+def test_step_keys_are_chained():
+	keys = step_keys("p", STEPS)
+	changed = step_keys("p", [STEPS[0], Step("build", ["make -j4"], "/w/x"), STEPS[2]])
+	assert len(set(keys)) == 3
+	assert changed[0] == keys[0] and changed[1] != keys[1] and changed[2] != keys[2]
+	assert step_keys("q", STEPS)[0] != keys[0]
+
+def test_journal_skips_recorded_steps():
+	keys = step_keys("p", STEPS)
+	container = FakeDockerClient(base_images = ["ubuntu:22.04"]).containers.run("ubuntu:22.04", name = "c")
+	container.exec_run = lambda cmd, **kwargs: ExecResult(0, f"{keys[0]} p clone\n{keys[1]} p build\n\n".encode("utf-8"))
+	journal = SetupJournal("/home/t/.containedenv/journal").load(container, user = "t")
+	assert journal.pending("p", STEPS) == [(STEPS[2], keys[2])]
+	assert journal.record(keys[2], "p", "test") == f"mkdir -p /home/t/.containedenv && echo '{keys[2]} p test' >> /home/t/.containedenv/journal"
+
+def test_journal_without_file_has_every_step_pending():
+	container = FakeDockerClient(base_images = ["ubuntu:22.04"]).containers.run("ubuntu:22.04", name = "c")
+	container.exec_run = lambda cmd, **kwargs: ExecResult(1, b"cat: journal: No such file or directory")
+	journal = SetupJournal("/journal").load(container)
+	assert [step for step, _ in journal.pending("p", STEPS)] == STEPS
@@ -0,0 +1,113 @@
+import json
+import pytest
+from containedenv.config import Config
+from containedenv.lock import LOCK_VERSION, Lockfile, lock_config, lock_path, parse_inst, parse_resolution, pinned, resolution_script
+
+OUTPUT = """@@containedenv curl
+Inst libssl3 [3.0.2-0ubuntu1.10] (3.0.2-0ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])
+Inst curl (7.81.0-1ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])
+@@containedenv ca-certificates
+@@containedenv bogus
+@@containedenv-failed
+@@containedenv libssl-dev
+Inst libssl3 [3.0.2-0ubuntu1.10] (3.0.2-0ubuntu1.14 Ubuntu:22.04/jammy-security [amd64]) []
+Inst libssl-dev (3.0.2-0ubuntu1.14 Ubuntu:22.04/jammy-security [amd64])
+"""
+TOGETHER = """@@containedenv-all
+Inst libssl3 [3.0.2-0ubuntu1.10] (3.0.2-0ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])
+Inst curl (7.81.0-1ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])
+Inst libssl-dev (3.0.2-0ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])
+"""
+
+
+def test_parse_inst_new_package():
+	assert parse_inst("Inst curl (7.81.0-1ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])") == ("curl", "7.81.0-1ubuntu1.15")
+
+def test_parse_inst_upgrade_takes_new_version():
+	line = "Inst libssl3 [3.0.2-0ubuntu1.10] (3.0.2-0ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])"
+	assert parse_inst(line) == ("libssl3", "3.0.2-0ubuntu1.15")
+
+def test_parse_inst_other_lines():
+	assert parse_inst("Conf curl (7.81.0-1ubuntu1.15 Ubuntu:22.04/jammy-updates [amd64])") is None
+	assert parse_inst("Reading package lists...") is None
+
+def test_parse_resolution():
+	resolved = parse_resolution(OUTPUT + TOGETHER)
+	assert resolved["curl"] == {"libssl3" : "3.0.2-0ubuntu1.15", "curl" : "7.81.0-1ubuntu1.15"}
+	# Already in the base image, nothing to install
+	assert resolved["ca-certificates"] == {}
+	# apt failed on it
+	assert "bogus" not in resolved
+	# Versions of the install of all the packages together
+	assert resolved["libssl-dev"] == {"libssl3" : "3.0.2-0ubuntu1.15", "libssl-dev" : "3.0.2-0ubuntu1.15"}
+	assert all("[" not in v for versions in resolved.values() for v in versions.values())
+
+def test_parse_resolution_of_packages_not_installable_together():
+	with pytest.raises(ValueError):
+		parse_resolution(OUTPUT + "@@containedenv-all\n@@containedenv-failed\n")
+
+def test_resolution_script_checks_apt_status():
+	script = resolution_script(["curl"])
+	assert "PIPESTATUS[0]" in script
+	assert "@@containedenv curl" in script
+	assert "@@containedenv-all" in script and "apt-get install -s -y $ok" in script
+
+def test_pinned():
+	versions = parse_resolution(OUTPUT + TOGETHER)
+	out = pinned(versions, ["curl", "libssl-dev", "ca-certificates", "unknown"])
+	assert out == [
+		"curl=7.81.0-1ubuntu1.15", "libssl3=3.0.2-0ubuntu1.15",
+		"libssl-dev=3.0.2-0ubuntu1.15", "unknown"
+	]
+
+def test_pinned_refuses_conflicting_pins():
+	# Resolved apart, libssl-dev needs another libssl3 than curl
+	with pytest.raises(ValueError):
+		pinned(parse_resolution(OUTPUT), ["curl", "libssl-dev"])
+
+def test_lockfile_roundtrip(tmp_path):
+	path = lock_path(str(tmp_path / "default.yml"))
+	assert path.endswith("default.lock.json")
+	lock = Lockfile.load(path)
+	assert not lock.locked("ubuntu:22.04")
+	assert lock.base("ubuntu:22.04") == "ubuntu:22.04"
+	lock.bases["ubuntu:22.04"] = "ubuntu@sha256:abc"
+	lock.apt["ubuntu:22.04"] = parse_resolution(OUTPUT)
+	lock.save()
+	again = Lockfile.load(path)
+	assert again.base("ubuntu:22.04") == "ubuntu@sha256:abc"
+	assert again.missing("ubuntu:22.04", ["curl", "git"]) == ["git"]
+	assert json.load(open(path))["version"] == LOCK_VERSION
+
+class ResolvingClient(object):
+	# Base image pulls and resolution containers of lock_config
+	def __init__(self) -> None:
+		self.images, self.containers, self.scripts = self, self, []
+
+	def pull(self, name:str):
+		return type("Image", (), {"attrs" : {"RepoDigests" : ["ubuntu@sha256:abc"]}})()
+
+	def run(self, image:str, command:list, **kwargs) -> bytes:
+		self.scripts.append(command[-1])
+		return (OUTPUT + "@@containedenv sudo\n@@containedenv wget\n" + TOGETHER).encode("utf-8")
+
+def test_lock_config_resolves_every_package_again_on_conflicts(tmp_path):
+	pytest.importorskip("pyrc")
+	config = Config.from_dict({
+		"app" : {"name" : "t", "user" : "t"},
+		"packages" : [{"name" : "ssl", "apt_packages" : ["libssl-dev"]}, {"name" : "web", "apt_packages" : ["curl"]}],
+		"projects" : []
+	})
+	config._lockfile = Lockfile(lock_path(str(tmp_path / "t.yml")))
+	config._lockfile.bases["ubuntu:22.04"] = "ubuntu@sha256:abc"
+	config._lockfile.apt["ubuntu:22.04"] = {"sudo" : {}, "wget" : {}}
+	config._lockfile.apt["ubuntu:22.04"].update(parse_resolution(OUTPUT))
+	assert config._lockfile.conflicts("ubuntu:22.04") == ["libssl3"]
+	client = ResolvingClient()
+	lock_config(config, client)
+	# Every package in one resolution, not only the conflicting ones
+	assert "@@containedenv libssl-dev" in client.scripts[0] and "@@containedenv sudo" in client.scripts[0]
+	assert config._lockfile.conflicts("ubuntu:22.04") == []
+	# A consistent lockfile is left as it is
+	lock_config(config, client)
+	assert len(client.scripts) == 1
@@ -0,0 +1,51 @@
+import os
+import subprocess
+from containedenv.mirrors import MIRROR_MOUNT, MirrorCache, clone_command, detach_command
+
+
+def test_clone_command_without_mirror():
+	assert clone_command("https://github.com/a/b.git", "/ws/b") == "git clone https://github.com/a/b.git /ws/b"
+
+def test_clone_command_borrows_from_mirror():
+	cmd = clone_command("https://github.com/a/b.git", "/ws/b", reference = f"{MIRROR_MOUNT}/m.git", depth = 1)
+	assert f"--reference-if-able {MIRROR_MOUNT}/m.git" in cmd
+	assert "--dissociate" not in cmd
+	assert "--depth 1" in cmd
+
+def test_mirror_names(tmp_path):
+	cache = MirrorCache(str(tmp_path))
+	a, b = cache.name("https://github.com/a/repo"), cache.name("https://github.com/b/repo.git")
+	assert a != b and a.endswith("-repo.git") and b.endswith("-repo.git")
+	assert cache.container_path("https://github.com/a/repo") == f"{MIRROR_MOUNT}/{a}"
+
+def origin(tmp_path) -> str:
+	# Repository served through file://, cloned with the transport of remote urls
+	path = tmp_path / "origin"
+	subprocess.run(["git", "init", "-q", str(path)], check = True)
+	subprocess.run(["git", "-C", str(path), "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "--allow-empty", "-m", "init"], check = True)
+	return path.as_uri()
+
+def test_clone_borrows_objects_of_the_mirror(tmp_path):
+	url = origin(tmp_path)
+	cache = MirrorCache(str(tmp_path / "mirrors"))
+	mirror = cache.update(url)
+	assert cache.update(url) == mirror
+	clone = tmp_path / "clone"
+	subprocess.run(clone_command(url, str(clone), reference = mirror), shell = True, check = True, capture_output = True)
+	alternates = clone / ".git" / "objects" / "info" / "alternates"
+	assert alternates.read_text().strip() == os.path.join(mirror, "objects")
+	# Mirrors never prune what clones may borrow
+	config = subprocess.run(["git", "--git-dir", mirror, "config", "gc.pruneExpire"], capture_output = True, text = True)
+	assert config.stdout.strip() == "never"
+
+def test_detached_clone_survives_mirror_removal(tmp_path):
+	url = origin(tmp_path)
+	mirror = MirrorCache(str(tmp_path / "mirrors")).update(url)
+	clone = tmp_path / "clone"
+	subprocess.run(clone_command(url, str(clone), reference = mirror), shell = True, check = True, capture_output = True)
+	subprocess.run(detach_command(str(clone)), shell = True, check = True, capture_output = True)
+	assert not os.path.exists(clone / ".git" / "objects" / "info" / "alternates")
+	subprocess.run(["rm", "-rf", mirror], check = True)
+	subprocess.run(["git", "-C", str(clone), "fsck", "--no-progress"], check = True, capture_output = True)
+	# Nothing to do the second time
+	subprocess.run(detach_command(str(clone)), shell = True, check = True, capture_output = True)
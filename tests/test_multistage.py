@@ -0,0 +1,49 @@
+import os
+import pytest
+from containedenv.config import Config, compile_config, config_dir
+from containedenv.context import split_stages
+from containedenv.packages import PackageManager2
+
+
+def config(packages:list, projects:list) -> Config:
+	return Config.from_dict({"app" : {"name" : "t", "user" : "t"}, "packages" : packages, "projects" : projects})
+
+def test_staged_apt_packages_go_to_the_shared_layer():
+	conf = config(
+		[{"name" : "tool", "apt_packages" : ["libfoo-dev"], "outputs" : ["/opt/tool"], "image" : ["RUN make install"]}],
+		[{"name" : "p", "requires" : ["$tool"]}]
+	)
+	plan = PackageManager2(conf, None).plan(conf.projects, base = ["sudo"], multistage = True)
+	assert [[p.name for p in group] for group in plan.stages] == [["tool"]]
+	assert plan.apt_packages == ["libfoo-dev", "sudo"]
+
+def test_packages_installing_system_packages_are_not_staged():
+	conf = config(
+		[
+			{"name" : "a", "outputs" : ["/opt/a"], "image" : ["RUN apt-get update && apt-get install -y --no-install-recommends libx"]},
+			{"name" : "b", "outputs" : ["/opt/b"], "image" : ["RUN dpkg -i /tmp/b.deb"]},
+			{"name" : "c", "outputs" : ["/opt/c"], "image" : ["RUN echo 'apt is not run here'"]}
+		],
+		[{"name" : "p", "requires" : ["$a", "$b", "$c"]}]
+	)
+	plan = PackageManager2(conf, None).plan(conf.projects, multistage = True)
+	assert [[p.name for p in group] for group in plan.stages] == [["c"]]
+	assert [p.name for p in plan.packages] == ["a", "b"]
+
+def test_default_python39_is_staged_with_its_runtime_libraries(tmp_path):
+	pytest.importorskip("pyrc")
+	from fakedocker import FakeDockerClient
+	from containedenv.__main__ import get_argparser
+	from containedenv.engine import ContainedEnv
+	conf = compile_config(os.path.join(config_dir(), "default.yml"), str(tmp_path))
+	conf.args = get_argparser().parse_args(["--multistage", "-p", "carbon"])
+	env = ContainedEnv(conf, dockerclient = FakeDockerClient(base_images = ["ubuntu:22.04"]))
+	dockerfile, _, _ = env.image_plan()
+	stages = split_stages(dockerfile)
+	base, final = stages[0], stages[-1]
+	assert [s.splitlines()[0] for s in stages[1:]] == ["FROM containedenv-base AS pkg-homebrew", "FROM containedenv-base"]
+	for library in ["libbluetooth-dev", "tk-dev", "uuid-dev"]:
+		assert library in base
+	# Checked where only the copied outputs are
+	assert "COPY --from=pkg-homebrew /usr/local /usr/local" in final
+	assert 'python3 -c "import _tkinter, _uuid"' in final
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("pyrc")
+
+from containedenv.optimize import findings, optimize
+
+
+def test_merges_runs_of_an_owner():
+	out = optimize("FROM ubuntu\nRUN echo a\nRUN echo b\nENV A 1\nENV B 2\n")
+	assert "RUN ( echo a ) && \\\n\t( echo b )" in out
+	assert 'ENV A="1" \\\n\tB="2"' in out
+
+def test_apt_lists_dropped():
+	out = optimize("FROM ubuntu\nRUN apt-get update && apt-get install -y curl\n")
+	assert "rm -rf /var/lib/apt/lists/*" in out
+
+def test_pip_keeps_no_cache_for_any_user():
+	out = optimize("FROM ubuntu\nUSER bench\nRUN python3 -m pip install numpy\nRUN pip3 install scipy\n")
+	assert "pip install --no-cache-dir numpy" in out
+	assert "pip3 install --no-cache-dir scipy" in out
+	assert "/root/.cache/pip" not in out
+
+def test_pip_cache_mount_of_root_is_kept():
+	mount = "--mount=type=cache,target=/root/.cache/pip"
+	out = optimize(f"FROM ubuntu\nRUN {mount} pip install numpy\n")
+	assert "--no-cache-dir" not in out
+	# The mount is root's, other users write their own cache in the layer
+	out = optimize(f"FROM ubuntu\nUSER bench\nRUN {mount} pip install numpy\n")
+	assert "pip install --no-cache-dir numpy" in out
+
+def test_findings():
+	rules = [f.rule for f in findings("FROM ubuntu\nARG V\nARG JOBS\nRUN make -j$JOBS V=$V\nRUN apt-get update\nADD https://x/y /y\nCOPY . /src\n")]
+	assert rules == ["build-arg", "stale-update", "remote-add", "context-copy"]
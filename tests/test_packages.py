@@ -0,0 +1,41 @@
+import pytest
+from containedenv.config import Config, Package
+from containedenv.packages import DependencyError, PackageGraph
+
+
+def graph(edges:dict) -> PackageGraph:
+	return PackageGraph([Package(name = name, requires = requires) for name, requires in edges.items()])
+
+def test_closure_puts_requirements_first():
+	g = graph({"a" : ["$b", "c"], "b" : ["$c"], "c" : []})
+	assert g.closure(["$a"]) == ["c", "b", "a"]
+	assert g.closure(["$b", "$a"]) == ["c", "b", "a"]
+
+def test_sorted_closure_ignores_declaration_order():
+	first = graph({"z" : ["$y", "$x"], "y" : [], "x" : []})
+	second = graph({"x" : [], "y" : [], "z" : ["$x", "$y"]})
+	assert first.closure(["$z"]) != second.closure(["$z"])
+	assert first.sorted_closure(["$z"]) == second.sorted_closure(["$z"]) == ["x", "y", "z"]
+
+def test_cycles_are_reported_with_their_path():
+	with pytest.raises(DependencyError) as error:
+		graph({"a" : ["$b"], "b" : ["$c"], "c" : ["$a"], "d" : []})
+	assert error.value.cycle == ["a", "b", "c", "a"]
+
+def test_unknown_requirements_are_recorded_by_owner():
+	g = graph({"a" : ["$b", "$missing"], "b" : []})
+	assert g.closure(["$a", "$gone"], owner = "project") == ["b", "a"]
+	assert g.unknown == {"a" : ["$missing"], "project" : ["$gone"]}
+
+def test_subtrees_split_independent_packages():
+	g = graph({"a" : ["$c"], "b" : [], "c" : [], "d" : ["$c"]})
+	assert g.subtrees(["a", "b", "c", "d"]) == [["a", "c", "d"], ["b"]]
+
+def test_config_graph_is_built_once():
+	conf = Config.from_dict({
+		"app" : {"name" : "t", "user" : "t"},
+		"packages" : [{"name" : "a", "requires" : ["$b"]}, {"name" : "b"}],
+		"projects" : []
+	})
+	assert conf.graph() is conf.graph()
+	assert conf.package("a").requires == ["$b"]
@@ -0,0 +1,80 @@
+import threading
+from containedenv.cache import CONTENT_KEY_LABEL
+from containedenv.config import GithubProfile
+from containedenv.pool import POOL_KEY_LABEL, pool_key, refill_lock
+
+
+def test_refill_fills_the_pool(environment):
+	environment("--pool", "2").build_image()
+	env = environment("--pool", "2").refill_pool()
+	assert len(env.pool().ready()) == 2
+	# Full, nothing more to do
+	environment("--pool", "2").refill_pool()
+	assert len(env.pool().ready()) == 2
+
+def test_claim_hands_out_a_member(environment):
+	environment("--pool", "1").build_image()
+	environment("--pool", "1").refill_pool()
+	env = environment("--pool", "1").build_image().run_container()
+	assert env.container.labels[POOL_KEY_LABEL] == env.pool().key
+	assert env.container.name == env.config.containername()
+	assert len(env.pool().ready()) == 0
+
+def test_refill_of_an_out_of_date_image_does_nothing(environment):
+	env = environment().build_image().run_container()
+	client = environment.client
+	# The config changed since the image was built
+	client.images.find(env.config.imagename()).labels[CONTENT_KEY_LABEL] = "older"
+	mark = client.recorder.mark()
+	environment("--pool", "2").refill_pool()
+	calls = client.recorder.since(mark)
+	assert calls["api.build"] == 0 and calls["containers.remove"] == 0 and calls["containers.run"] == 0
+	assert client.containers.get(env.config.containername()) is not None
+
+def test_concurrent_refills_do_not_overfill(environment):
+	environment("--pool", "3").build_image()
+	envs = [environment("--pool", "3") for _ in range(4)]
+	threads = [threading.Thread(target = e.refill_pool) for e in envs]
+	[t.start() for t in threads]
+	[t.join() for t in threads]
+	assert len(envs[0].pool().members()) == 3
+
+def test_refill_lock_is_exclusive(tmp_path):
+	order = []
+	def hold(name):
+		with refill_lock("app", str(tmp_path)):
+			order.append(f"{name} in")
+			order.append(f"{name} out")
+	with refill_lock("app", str(tmp_path)):
+		thread = threading.Thread(target = hold, args = ("other",))
+		thread.start()
+		thread.join(0.2)
+		order.append("first out")
+	thread.join()
+	assert order == ["first out", "other in", "other out"]
+
+def test_credentials_are_part_of_the_key(environment):
+	key = environment("--pool", "1").build_image().pool().key
+	assert environment("--pool", "1").build_image().pool().key == key
+	# The token of the profile wins over --ghtoken
+	assert environment("--pool", "1", "--ghtoken", "other").build_image().pool().key == key
+	config = environment("--pool", "1").config
+	profiles = [GithubProfile("bench", "bench@example.com", "1111"), GithubProfile("bench", "other@example.com", "0000"), GithubProfile("other", "bench@example.com", "0000")]
+	keys = [pool_key("image", config.projects, profile, profile.token) for profile in profiles]
+	assert len(set(keys + [pool_key("image", config.projects, GithubProfile("bench", "bench@example.com", "0000"), "0000")])) == 4
+	assert pool_key("image", config.projects, profiles[0], None) != keys[0]
+	assert pool_key("image", config.projects) != keys[0]
+
+def test_token_given_on_the_command_line_is_part_of_the_key(environment):
+	env = environment("--pool", "1").build_image()
+	env.config.github_profile.token = None
+	key = env.pool().key
+	env.args.ghtoken = "1111"
+	assert env.pool().key != key
+
+def test_rebuild_does_not_claim(environment):
+	environment("--pool", "1").build_image()
+	environment("--pool", "1").refill_pool()
+	env = environment("--pool", "1", "--rebuild").build_image().run_container()
+	assert not env.container.name.startswith(f"{env.config.appname()}_pool_")
+	assert len(env.pool().ready()) == 1
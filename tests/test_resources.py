@@ -0,0 +1,29 @@
+import pytest
+from containedenv.config import Resources, parse_size
+
+
+def test_parse_size():
+	assert parse_size("512m") == 512 * 2**20
+	assert parse_size("2g") == 2 * 2**30
+	assert parse_size(None) is None
+
+def test_job_count():
+	assert Resources(jobs = 3).job_count(16) == 3
+	assert Resources(cpus = 2.5).job_count(16) == 3
+	assert Resources(cpus = 8).job_count(4) == 4
+	assert Resources().job_count(16) == 16
+
+def test_build_limits_disable_swap(environment, monkeypatch):
+	env = environment()
+	monkeypatch.setattr(type(env), "resources", lambda self: Resources(cpus = 2, memory = "1g"))
+	calls = []
+	build = environment.client.api.build
+	def recording(*args, **kwargs):
+		calls.append(kwargs)
+		return build(*args, **kwargs)
+	monkeypatch.setattr(environment.client.api, "build", recording)
+	env.build_image()
+	limits = calls[0]["container_limits"]
+	assert limits["memory"] == 2**30
+	assert limits["memswap"] == limits["memory"]
+	assert limits["cpushares"] == 2048
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import pytest
+from containedenv.config import Project
+from containedenv.scheduler import ProjectScheduler, SetupError
+
+
+def projects(**depends) -> list:
+	return [Project(name = name, depends = list(deps)) for name, deps in depends.items()]
+
+def test_dependencies_are_setup_first():
+	order, lock = [], threading.Lock()
+	def setup(project, log):
+		with lock:
+			order.append(project.name)
+	ProjectScheduler(projects(a = [], b = ["a"], c = ["b", "a"], d = []), workers = 4).run(setup)
+	assert order.index("a") < order.index("b") < order.index("c")
+	assert sorted(order) == ["a", "b", "c", "d"]
+
+def test_unselected_dependencies_are_skipped():
+	done = []
+	ProjectScheduler(projects(b = ["a"]), known = ["a", "b"]).run(lambda p, log: done.append(p.name))
+	assert done == ["b"]
+
+def test_unknown_dependencies_are_errors():
+	with pytest.raises(SetupError, match = "unknown project\\(s\\) typo"):
+		ProjectScheduler(projects(a = [], b = ["typo"]), known = ["a", "b"])
+	with pytest.raises(SetupError):
+		ProjectScheduler(projects(b = ["a"]))
+
+def test_cycles():
+	with pytest.raises(ValueError, match = "Cyclic"):
+		ProjectScheduler(projects(a = ["b"], b = ["a"]))
+
+def test_failure_stops_dependents():
+	done = []
+	def setup(project, log):
+		log("working")
+		if project.name == "a":
+			raise RuntimeError("boom")
+		done.append(project.name)
+	with pytest.raises(SetupError) as error:
+		ProjectScheduler(projects(a = [], b = ["a"]), workers = 1).run(setup)
+	assert error.value.project == "a"
+	assert "working" in error.value.log
+	assert done == []
+
+def test_asyncio_dependencies_are_setup_first():
+	order, running, most = [], set(), []
+	async def setup(project, log):
+		running.add(project.name)
+		most.append(len(running))
+		await asyncio.sleep(0)
+		running.discard(project.name)
+		order.append(project.name)
+	asyncio.run(ProjectScheduler(projects(a = [], b = ["a"], c = ["b", "a"], d = [], e = []), workers = 2).arun(setup))
+	assert order.index("a") < order.index("b") < order.index("c")
+	assert sorted(order) == ["a", "b", "c", "d", "e"]
+	assert max(most) == 2
+
+def test_asyncio_failure_stops_dependents():
+	done = []
+	async def setup(project, log):
+		log("working")
+		if project.name == "a":
+			raise RuntimeError("boom")
+		done.append(project.name)
+	with pytest.raises(SetupError) as error:
+		asyncio.run(ProjectScheduler(projects(a = [], b = ["a"]), workers = 1).arun(setup))
+	assert error.value.project == "a"
+	assert "working" in error.value.log
+	assert done == []
@@ -0,0 +1,46 @@
+from fakedocker import FakeContainer
+
+
+def commands(execs) -> list:
+	return [" ".join(c) if isinstance(c, list) else c for c in execs]
+
+def test_snapshot_leaves_credentials_out(environment, monkeypatch):
+	# Commands run in the container by the time it is committed
+	committed = []
+	commit = FakeContainer.commit
+	def recording(self, *args, **kwargs):
+		committed.append(commands(self.execs))
+		return commit(self, *args, **kwargs)
+	monkeypatch.setattr(FakeContainer, "commit", recording)
+
+	env = environment("--snapshot").build_image().run_container()
+	assert len(committed) == 1
+	before, after = committed[0], commands(env.container.execs)[len(committed[0]):]
+	# Written by the setup, removed before the commit
+	written = max(i for i, c in enumerate(before) if "bench:0000@" in c)
+	removed = [i for i, c in enumerate(before) if "rm -f .git/.bench-credentials" in c]
+	assert len(removed) == 4 and min(removed) > written
+	assert all("--unset-all credential.helper" in before[i] for i in removed)
+	# and written again once committed
+	assert sum("bench:0000@" in c for c in after) == 4
+
+def test_start_from_snapshot_restores_credentials(environment):
+	env = environment("--batch", "--snapshot").build_image().run_container()
+	env.container.remove(force = True)
+	env = environment("--batch", "--snapshot").build_image().run_container()
+	assert env.container.image.endswith("-snapshot")
+	executed = commands(env.container.execs)
+	assert sum("bench:0000@" in c for c in executed) == 4
+	assert sum("credential.helper" in c for c in executed) == 4
+
+def test_snapshot_copies_objects_borrowed_from_mirrors(environment, monkeypatch):
+	committed = []
+	commit = FakeContainer.commit
+	def recording(self, *args, **kwargs):
+		committed.append(commands(self.execs))
+		return commit(self, *args, **kwargs)
+	monkeypatch.setattr(FakeContainer, "commit", recording)
+
+	environment("--snapshot").build_image().run_container()
+	repacks = [c for c in committed[0] if "repack -a -d" in c]
+	assert len(repacks) == 1 and repacks[0].count("objects/info/alternates; then") == 4
@@ -0,0 +1,13 @@
+from startup import DEFAULT_CONFIG, FORBIDDEN, SCENARIOS, run
+from containedenv.config import compile_config
+
+
+def test_cli_imports_no_daemon_module():
+	modules = run(SCENARIOS["cli"][0])["modules"]
+	assert [m for m in modules if m.split(".")[0] in FORBIDDEN] == []
+
+def test_compiled_config_loads_without_dataclasses_json():
+	# The first load compiles the config (in the home directory of the test)
+	compile_config(DEFAULT_CONFIG)
+	modules = run(SCENARIOS["config"][0])["modules"]
+	assert [m for m in modules if m.split(".")[0] in FORBIDDEN + ["dataclasses_json", "marshmallow", "yaml"]] == []
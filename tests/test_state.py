@@ -0,0 +1,48 @@
+import os
+import pytest
+from containedenv.state import OfflineClient, State, state_path
+
+
+def test_state_path(tmp_path):
+	assert state_path("app", str(tmp_path)) == os.path.join(str(tmp_path), "app.json")
+	assert state_path("app").endswith(os.path.join("containedenv", "state", "app.json"))
+
+def test_add_image_moves_tags():
+	state = State()
+	state.add_image("sha256:1", ["app:latest", "app:v1"], {})
+	state.add_image("sha256:2", ["app:latest"], {"k" : "v"})
+	assert state.image("app:latest")["id"] == "sha256:2"
+	state.add_image("sha256:3", ["app:v1"], {})
+	# Left without tags, forgotten
+	assert "sha256:1" not in state.images
+
+def test_save_load(tmp_path):
+	state = State()
+	state.add_container("c", "id", "app:latest", {}, ["b", "a"])
+	state.save(str(tmp_path / "s" / "app.json"))
+	again = State.load(str(tmp_path / "s" / "app.json"))
+	assert again.containers["c"]["steps"] == ["a", "b"]
+	assert State.load(str(tmp_path / "missing.json")).containers == {}
+
+def test_offline_client_filters():
+	import docker
+	state = State()
+	state.add_image("sha256:1", ["app:latest"], {"containedenv.key" : "k"})
+	client = OfflineClient(state)
+	assert [i.id for i in client.images.list(filters = {"label" : "containedenv.key=k"})] == ["sha256:1"]
+	assert client.images.list(filters = {"label" : "containedenv.key=x"}) == []
+	with pytest.raises(docker.errors.ImageNotFound):
+		client.images.get("other")
+	with pytest.raises(docker.errors.APIError):
+		client.images.get_registry_data("ubuntu:22.04")
+
+def test_state_written_only_in_statedir(environment, home, tmp_path):
+	env = environment().build_image().run_container()
+	assert os.path.isfile(state_path(env.config.appname(), str(tmp_path / "state")))
+	assert not os.path.exists(os.path.join(str(home), ".cache", "containedenv", "state"))
+
+def test_fake_client_writes_no_state(environment, home):
+	from containedenv.engine import ContainedEnv
+	env = environment()
+	ContainedEnv(env.config, dockerclient = environment.client).build_image()
+	assert not os.path.exists(os.path.join(str(home), ".cache", "containedenv", "state"))
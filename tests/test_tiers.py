@@ -0,0 +1,41 @@
+import pytest
+from containedenv.config import Config
+
+pytest.importorskip("pyrc")
+from containedenv.tiers import TIER_PARENT_LABEL, deepest_tier, shared_prefixes, tier_chain, tier_sequence
+
+
+def config(packages:list) -> Config:
+	return Config.from_dict({"app" : {"name" : "t", "user" : "t"}, "packages" : packages, "projects" : []})
+
+BASE = [{"name" : "a", "apt_packages" : ["liba"]}, {"name" : "b", "image" : ["RUN echo b"]}]
+
+def test_tier_sequence_tokens_follow_package_definitions():
+	first = tier_sequence(config(BASE), ["a", "b"])
+	second = tier_sequence(config(BASE + [{"name" : "c"}]), ["a", "b", "c"])
+	changed = tier_sequence(config([BASE[0], {"name" : "b", "image" : ["RUN echo B"]}]), ["a", "b"])
+	assert first[0] == "ubuntu:22.04"
+	assert second[:3] == first
+	assert changed[:2] == first[:2] and changed[2] != first[2]
+
+def test_shared_prefixes_are_the_deepest_shared_ones():
+	sequences = [["u", "a", "b", "c"], ["u", "a", "b", "d"], ["u", "a", "e"], ["u", "f"]]
+	assert shared_prefixes(sequences) == [("u",), ("u", "a"), ("u", "a", "b")]
+	assert shared_prefixes([["u", "a"]]) == []
+
+def test_tier_chain_builds_each_tier_on_the_deepest_shorter_one():
+	conf = config(BASE + [{"name" : "c", "image" : ["RUN echo c"]}])
+	apps = [(conf, tier_sequence(conf, ["a", "b", "c"])), (conf, tier_sequence(conf, ["a", "b"]))]
+	prefixes = [tuple(apps[1][1][:2]), tuple(apps[1][1])]
+	tiers = tier_chain(prefixes, apps, {"ubuntu:22.04" : "sha256:base"})
+	lower, upper = tiers[prefixes[0]], tiers[prefixes[1]]
+	assert lower.parent is None and lower.packages == ["a"]
+	assert upper.parent is lower and upper.packages == ["a", "b"]
+	assert upper.dockerfile.startswith(f"FROM {lower.tag()}")
+	assert upper.labels()[TIER_PARENT_LABEL] == lower.tag()
+	assert "RUN echo b" in upper.dockerfile and "liba" not in upper.dockerfile
+	assert deepest_tier(tiers, apps[0][1]) is upper
+	assert deepest_tier(tiers, ["debian:12"]) is None
+	# Keys are chained, a new base digest invalidates every tier
+	rebuilt = tier_chain(prefixes, apps, {"ubuntu:22.04" : "sha256:newer"})
+	assert rebuilt[prefixes[0]].key != lower.key and rebuilt[prefixes[1]].key != upper.key
@@ -0,0 +1,68 @@
+import json
+import threading
+import pytest
+from containedenv import trace
+from containedenv.trace import enable, span, traced
+
+
+@pytest.fixture(autouse = True)
+def disabled(monkeypatch):
+	# Every test starts without a tracer, and leaves none behind
+	monkeypatch.setattr(trace, "_tracer", None)
+
+def events(tracer, phase:str = "X") -> list:
+	return [e for e in tracer.to_dict()["traceEvents"] if e["ph"] == phase]
+
+def test_disabled_spans_do_nothing():
+	with span("build", image = "a") as s:
+		assert s.set(size = 1) is s
+	assert trace.tracer() is None
+	assert span("other") is s
+
+def test_nested_spans():
+	tracer = enable()
+	with span("setup", projects = 2):
+		with span("setup.project", project = "a") as s:
+			s.set(steps = 3)
+	outer, inner = events(tracer)
+	assert (outer["name"], inner["name"]) == ("setup", "setup.project")
+	assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+	assert inner["args"] == {"project" : "a", "steps" : 3}
+	assert inner["cat"] == "setup"
+
+def test_errors_are_recorded():
+	tracer = enable()
+	with pytest.raises(KeyError):
+		with span("lock"):
+			raise KeyError("curl")
+	assert events(tracer)[0]["args"]["error"] == "KeyError: 'curl'"
+
+def test_chrome_trace_file(tmp_path):
+	tracer = enable()
+	with span("build", tags = ["a", "b"], cached = False):
+		thread = threading.Thread(target = lambda: span("pull").__enter__().__exit__(None, None, None), name = "puller")
+		thread.start()
+		thread.join()
+	tracer.write(str(tmp_path / "trace.json"))
+	data = json.loads((tmp_path / "trace.json").read_text())
+	assert data["displayTimeUnit"] == "ms"
+	complete = [e for e in data["traceEvents"] if e["ph"] == "X"]
+	assert [e["name"] for e in complete] == ["build", "pull"]
+	for event in complete:
+		assert set(event) == {"name", "cat", "ph", "ts", "dur", "pid", "tid", "args"}
+	# Values JSON can not hold as is are strings
+	assert complete[0]["args"] == {"tags" : "['a', 'b']", "cached" : False}
+	names = {e["tid"] : e["args"]["name"] for e in data["traceEvents"] if e["ph"] == "M"}
+	assert names[complete[1]["tid"]] == "puller"
+	assert names[complete[0]["tid"]] == threading.current_thread().name
+
+def test_traced():
+	@traced("compile")
+	def compile(path:str) -> str:
+		"""Compiles"""
+		return path.upper()
+	assert compile("a") == "A"
+	tracer = enable()
+	assert compile("b") == "B"
+	assert [e["name"] for e in events(tracer)] == ["compile"]
+	assert compile.__name__ == "compile" and compile.__doc__ == "Compiles"